@@ -19,7 +19,7 @@ class Automod(commands.Cog):
         self.bot: KidneyBot = bot
 
     async def check_whitelist(self, member_or_channel: discord.Member | discord.TextChannel) -> bool:
-        doc = await self.bot.database.automodsettings.get(member_or_channel.guild.id)
+        doc = await self.bot.database.automodsettings.get(member_or_channel.guild.id, readonly=True)
         if doc is None:
             return False
         return member_or_channel.id in (doc.whitelist or [])
@@ -23,8 +23,9 @@ class Autorole(commands.Cog):
 
     @tasks.loop(seconds=60)
     async def autorole_loop(self):
+        settings = await self.bot.database.autorolesettings.get_many((guild.id for guild in self.bot.guilds), readonly=True)
         for guild in self.bot.guilds:
-            doc = await self.bot.database.autorolesettings.get(guild.id)
+            doc = settings.get(guild.id)
             if doc is None:
                 continue
             for role in (doc.roles or []):
@@ -15,6 +15,7 @@ import utils.types as types
 from utils.checks import is_bot_owner
 from utils.database import Database, Schemas
 from utils.kidney_bot import KidneyBot
+from utils.transactions import TransactionDeclined
 
 
 class Item:
@@ -43,26 +44,30 @@ items: list[Item] = []
 
 
 async def bean_bomb(interaction: discord.Interaction):
+    bot = cast(KidneyBot, interaction.client)
     amount = random.randint(0, 100)
     users = []
     channel = interaction.channel
     if channel and isinstance(channel, (discord.TextChannel, discord.Thread)):
-        async for message in channel.history(limit=100):
-            if message.author.id in users:
-                continue
+        since = interaction.created_at.timestamp() - 60
+        recent = bot.recent_activity.authors(channel.id, since)
+        if recent is not None:
+            users = recent
+        else:
+            # The bot wasn't listening for all of the last minute
+            async for message in channel.history(limit=100):
+                if message.author.id in users:
+                    continue
 
-            if message.author.bot:
-                continue
+                if message.author.bot:
+                    continue
 
-            if message.created_at.timestamp() < interaction.created_at.timestamp() - 60:
-                continue
+                if message.created_at.timestamp() < since:
+                    continue
 
-            users.append(message.author.id)
+                users.append(message.author.id)
 
-            bot = cast(KidneyBot, interaction.client)
-            user = UserProfile(bot, bot.database, message.author)
-            await user.async_init()
-            await user.add_currency(amount, 'wallet')
+        await bot.transactions.reward({str(user_id): amount for user_id in users}, reason='bean_bomb')
 
     await interaction.followup.send(f'Everyone in the channel got {amount} beans!')
 
@@ -93,16 +98,12 @@ class PhoneView(discord.ui.View):
     async def pizza(self, interaction: discord.Interaction, button: discord.ui.Button):
         await interaction.response.defer()
         bot = cast(KidneyBot, interaction.client)
-        profile = UserProfile(bot, bot.database, interaction.user)
-        await profile.async_init()
-        if await profile.wallet() < 20:
+        try:
+            await bot.transactions.buy(str(interaction.user.id), 'pizza', 20)
+        except TransactionDeclined:
             await self.interaction.followup.send('You don\'t have enough beans!', ephemeral=True)
             return
 
-        await profile.add_currency(-20, 'wallet')
-
-        await profile.add_item(next(i for i in items if i.id == 'pizza'))
-
         await self.interaction.followup.send('You ordered a pizza for 20 beans!')
 
     @discord.ui.button(label='Prank call the developer', style=discord.ButtonStyle.secondary)
@@ -139,6 +140,8 @@ ItemIDsLiteral = Literal['bean_bomb - 100', 'padlock - 100', 'bolt_cutters - 250
 items_per_page = 5
 num_pages = (len(items) + items_per_page - 1) // items_per_page
 
+leaderboard_per_page = 10
+
 class PageDropdown(discord.ui.Select):
     def __init__(self):
         options = [discord.SelectOption(label=str(i+1), value=str(i+1)) for i in range(num_pages)]
@@ -204,68 +207,89 @@ class Shop(discord.ui.View):
 
 
 class UserProfile:
+    """A user's currency document, read once per command.
+
+    `async_init` loads a snapshot that `wallet`, `bank` and `inventory` read
+    from; `refresh` reloads it. `add_currency`, `add_item` and `remove_item`
+    only queue changes, which show up in those reads right away, and `commit`
+    writes them all in one update.
+    """
+
     def __init__(self, bot: KidneyBot, database: Database, user: discord.User | discord.Member):
         self.bot: KidneyBot = bot
         self.database: Database = database
         self.user: discord.User | discord.Member = user
+        self.doc: Schemas.Currency | None = None
+        # Queued changes: wallet/bank deltas, item id → count delta
+        self._wallet = 0
+        self._bank = 0
+        self._items: dict[str, int] = {}
 
     async def async_init(self):
-        await self.bot.add_currency(self.user, 0, 'wallet')
-
-    async def wallet(self) -> int:
-        doc = await self.database.currency.get(str(self.user.id))
-        return int(doc.wallet or 0) if doc else 0
-
-    async def bank(self) -> int:
-        doc = await self.database.currency.get(str(self.user.id))
-        return int(doc.bank or 0) if doc else 0
-
-    async def inventory(self) -> dict:
-        doc = await self.database.currency.get(str(self.user.id))
-        if doc is None:
-            return {}
-        inv = doc.inventory
-        if not isinstance(inv, dict):
-            doc.inventory = {}
-            await self.database.currency.save(doc)
-            return {}
-        return inv
-
-    async def add_item(self, item: Item):
-        doc = await self.database.currency.get(str(self.user.id))
-        if doc is None:
-            await self.bot.add_currency(self.user, 0, 'wallet')
-            doc = await self.database.currency.get(str(self.user.id))
-        if doc is None:
-            return
-
-        inventory = doc.inventory if isinstance(doc.inventory, dict) else {}
-        inventory[item.id] = inventory.get(item.id, 0) + 1
-        doc.inventory = inventory
-        await self.database.currency.save(doc)
-
-    async def remove_item(self, id: str, amount: int = 1):
-        doc = await self.database.currency.get(str(self.user.id))
-        if doc is None:
-            return
-
-        inventory = doc.inventory if isinstance(doc.inventory, dict) else {}
-        count = max(0, inventory.get(id, 0) - amount)
-        inventory[id] = count
-        doc.inventory = inventory
-        await self.database.currency.save(doc)
-
-    async def doc(self) -> Schemas.Currency | None:
-        return await self.database.currency.get(str(self.user.id))
-
-    async def add_currency(self, amount: int, location: str):
+        await self.refresh()
+
+    async def refresh(self):
+        """Reload the snapshot. Queued changes are kept."""
+        # The cached instance itself: it's only read, never modified
+        self.doc = await self.database.currency.get(str(self.user.id), readonly=True)
+        if self.doc is not None and isinstance(self.doc.inventory, list):
+            # Left by old versions; items are counted with $inc on inventory.<id>
+            self.doc = await self.database.currency.update(str(self.user.id), set={'inventory': {}},
+                                                           return_document=True)
+
+    @property
+    def wallet(self) -> int:
+        return (int(self.doc.wallet or 0) if self.doc else 0) + self._wallet
+
+    @property
+    def bank(self) -> int:
+        return (int(self.doc.bank or 0) if self.doc else 0) + self._bank
+
+    @property
+    def inventory(self) -> dict:
+        inventory = dict(self.doc.inventory) if self.doc and isinstance(self.doc.inventory, dict) else {}
+        for id, delta in self._items.items():
+            inventory[id] = inventory.get(id, 0) + delta
+        return inventory
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self._wallet or self._bank or any(self._items.values()))
+
+    def add_item(self, item: Item, amount: int = 1):
+        self._items[item.id] = self._items.get(item.id, 0) + amount
+
+    def remove_item(self, id: str, amount: int = 1):
+        self._items[id] = self._items.get(id, 0) - amount
+
+    def add_currency(self, amount: int, location: str):
         location = location.lower()
         if location not in ['wallet', 'bank']:
             raise ValueError(
                 f"Parameter \"location\" must be 'wallet' or 'bank' got: {location}")
 
         logging.info(f'Adding {amount} beans to {self.user.display_name}\'s {location}')
-        await self.bot.add_currency(self.user, amount, location)
+        if location == 'wallet':
+            self._wallet += amount
+        else:
+            self._bank += amount
+
+    async def commit(self, guarded: bool = True, reason: str | None = None):
+        """Write the queued changes in one update and take the result as the new
+        snapshot. With `guarded`, the update only applies if every balance and
+        item it takes from covers it, and raises TransactionDeclined otherwise.
+        Either way the queue is emptied. `reason` goes into the ledger."""
+        if not self.has_changes:
+            return
+        wallet, bank, items = self._wallet, self._bank, self._items
+        self._wallet = self._bank = 0
+        self._items = {}
+        if guarded:
+            self.doc = await self.bot.transactions.charge(str(self.user.id), wallet=wallet, bank=bank, items=items,
+                                                          reason=reason)
+        else:
+            self.doc = await self.bot.transactions.credit(str(self.user.id), wallet=wallet, bank=bank, items=items,
+                                                          reason=reason)
 
 
 class Economy(commands.Cog):
@@ -275,18 +299,30 @@ class Economy(commands.Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
+        self.bot.recent_activity.start()
         logging.info('Economy cog loaded.')
 
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        self.bot.recent_activity.record(message)
+
     @commands.command()
     @is_bot_owner()
     async def resetuser(self, ctx: commands.Context, user: discord.User):
+        doc = await self.bot.database.currency.get(str(user.id), readonly=True)
         await self.bot.database.currency.delete(str(user.id))
+        self.bot.leaderboard.discard(str(user.id))
+        if doc is not None:
+            inventory = doc.inventory if isinstance(doc.inventory, dict) else {}
+            self.bot.ledger.record(str(user.id), wallet=-(doc.wallet or 0), bank=-(doc.bank or 0),
+                                   items={item: -n for item, n in inventory.items() if isinstance(n, int)},
+                                   reason='reset')
         await ctx.send('User removed successfully!')
 
     @commands.command()
     @is_bot_owner()
     async def addmoney(self, ctx: commands.Context, user: discord.User, amount: int):
-        await self.bot.add_currency(user, amount, 'wallet')
+        await self.bot.add_currency(user, amount, 'wallet', reason='addmoney')
 
     @app_commands.command(name="beg", description='Imagine being that beanless lol. 30 second cooldown.')
     @app_commands.allowed_installs(guilds=True, users=True)
@@ -294,7 +330,7 @@ class Economy(commands.Cog):
     async def beg(self, interaction: discord.Interaction):
         await interaction.response.defer()
         amount = random.randint(0, 100)
-        await self.bot.add_currency(interaction.user, amount, 'wallet')
+        await self.bot.add_currency(interaction.user, amount, 'wallet', reason='beg')
         await interaction.followup.send(f'You gained {amount} from begging!')
 
     @app_commands.command(name="balance", description='View your bean count')
@@ -307,8 +343,8 @@ class Economy(commands.Cog):
         await profile.async_init()
 
         embed = discord.Embed(title=f"{user.display_name}'s balance", color=0x00ff00)
-        embed.add_field(name="Wallet", value=f"{await profile.wallet()} beans", inline=False)
-        embed.add_field(name="Bank", value=f"{await profile.bank()} beans", inline=False)
+        embed.add_field(name="Wallet", value=f"{profile.wallet} beans", inline=False)
+        embed.add_field(name="Bank", value=f"{profile.bank} beans", inline=False)
         embed.set_footer(text=user.name, icon_url=user.display_avatar.url)
         await interaction.followup.send(embed=embed)
 
@@ -326,20 +362,24 @@ class Economy(commands.Cog):
             amount_value = int(amount)
         except Exception:
             if amount.lower() == 'all':
-                amount_value = int(await profile.wallet())
+                amount_value = profile.wallet
             elif amount.lower() == 'half':
-                amount_value = int(await profile.wallet()) // 2
+                amount_value = profile.wallet // 2
             else:
                 await interaction.followup.send('Value must be a number, "all", or "half"', ephemeral=True)
                 return
 
-        if amount_value <= int(await profile.wallet()):
-            await self.bot.add_currency(interaction.user, -amount_value, 'wallet')
-            await self.bot.add_currency(interaction.user, amount_value, 'bank')
-            await interaction.followup.send(f'Deposited {amount_value} beans')
-        else:
+        if amount_value < 0:
+            await interaction.followup.send('Value must not be negative', ephemeral=True)
+            return
+
+        try:
+            await self.bot.transactions.deposit(str(interaction.user.id), amount_value)
+        except TransactionDeclined:
             await interaction.followup.send('You are trying to deposit more beans than you have!',
                                                     ephemeral=True)
+            return
+        await interaction.followup.send(f'Deposited {amount_value} beans')
 
     @app_commands.command(name="withdraw", description="Withdraw beans")
     @app_commands.allowed_installs(guilds=True, users=True)
@@ -355,20 +395,24 @@ class Economy(commands.Cog):
             amount_value = int(amount)
         except Exception:
             if amount.lower() == 'all':
-                amount_value = int(await profile.bank())
+                amount_value = profile.bank
             elif amount.lower() == 'half':
-                amount_value = int(await profile.bank()) // 2
+                amount_value = profile.bank // 2
             else:
                 await interaction.followup.send('Value must be a number, "all", or "half"', ephemeral=True)
                 return
 
-        if amount_value <= int(await profile.bank()):
-            await self.bot.add_currency(interaction.user, amount_value, 'wallet')
-            await self.bot.add_currency(interaction.user, -amount_value, 'bank')
-            await interaction.followup.send(content=f'Withdrew {amount_value} beans')
-        else:
+        if amount_value < 0:
+            await interaction.followup.send('Value must not be negative', ephemeral=True)
+            return
+
+        try:
+            await self.bot.transactions.withdraw(str(interaction.user.id), amount_value)
+        except TransactionDeclined:
             await interaction.followup.send('You are trying to withdraw more beans than you have!',
                                                     ephemeral=True)
+            return
+        await interaction.followup.send(content=f'Withdrew {amount_value} beans')
 
     @app_commands.command(name='rob',
                           description='Rob someone of their beans and make them very mad. 30 second cooldown.')
@@ -383,40 +427,65 @@ class Economy(commands.Cog):
         target_profile = UserProfile(self.bot, self.bot.database, target)
         await target_profile.async_init()
 
-        if int(await target_profile.wallet()) <= 11:
+        async def commit_items():
+            # Fines are owed regardless; the padlock may have been broken by
+            # someone else in the meantime.
+            await profile.commit(guarded=False, reason='rob')
+            try:
+                await target_profile.commit(reason='rob')
+            except TransactionDeclined:
+                pass
+
+        if target_profile.wallet <= 11:
             await interaction.followup.send('They have no beans!', ephemeral=True)
         else:
             if interaction.user.id == target.id:
-                amount = random.randint(0, int(await profile.wallet() // 6))
-                await profile.add_currency(-amount, 'wallet')
+                amount = random.randint(0, profile.wallet // 6)
+                profile.add_currency(-amount, 'wallet')
+                try:
+                    await profile.commit(reason='rob')
+                except TransactionDeclined:
+                    amount = 0
                 await interaction.followup.send(f"You tried to rob yourself and lost {amount} beans. Good job.")
                 return
-            if int(await profile.wallet()) <= 50:
+            if profile.wallet <= 50:
                 await interaction.followup.send('You don\'t have enough money in your wallet!', ephemeral=True)
                 return
-            user_inventory = await profile.inventory()
-            target_inventory = await target_profile.inventory()
-            if 'padlock' in target_inventory:
-                if 'bolt_cutters' not in user_inventory:
+            user_inventory = profile.inventory
+            target_inventory = target_profile.inventory
+            if target_inventory.get('padlock'):
+                if not user_inventory.get('bolt_cutters'):
                     await interaction.followup.send('They have a padlock on their wallet! You were caught, and lost 50 beans!', ephemeral=True)
-                    await profile.add_currency(-50, 'wallet')
-                    await target_profile.remove_item('padlock')
+                    profile.add_currency(-50, 'wallet')
+                    target_profile.remove_item('padlock')
+                    await commit_items()
                     try:
                         await target.send(f"{interaction.user.name} tried to rob you, but you had a padlock on your wallet! They lost 50 beans, and your padlock broke.")
                     except Exception:
                         pass
                     return
                 else:
-                    await target_profile.remove_item('padlock')
-                    await profile.remove_item('bolt_cutters')
-                    # bolt cutters consumed
-            amount = random.randint(0, int(await target_profile.wallet() // 6))
+                    # Consumed up front, so two robberies at once can't share one pair
+                    profile.remove_item('bolt_cutters')
+                    try:
+                        await profile.commit(reason='rob')
+                    except TransactionDeclined:
+                        await interaction.followup.send('You don\'t have any bolt cutters!', ephemeral=True)
+                        return
+                    target_profile.remove_item('padlock')
+            amount = random.randint(0, target_profile.wallet // 6)
             if amount < 2:
                 await interaction.followup.send('You were caught! You pay 50 beans in fines.')
-                await profile.add_currency(-50, 'wallet')
+                profile.add_currency(-50, 'wallet')
+                await commit_items()
                 return
-            await target_profile.add_currency(-amount, 'wallet')
-            await profile.add_currency(amount, 'wallet')
+            try:
+                await self.bot.transactions.transfer(str(target.id), str(interaction.user.id), amount)
+            except TransactionDeclined:
+                await interaction.followup.send('They have no beans!', ephemeral=True)
+                return
+            finally:
+                await commit_items()
 
             if USED_BOLT_CUTTERS:
                 await interaction.followup.send(f"{target.mention} had a padlock on their wallet, \
@@ -443,15 +512,16 @@ you got {amount} beans!")
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
         await profile.async_init()
         item_obj: Item = next(i for i in items if i.id == item.split(' ')[0])
-        inv = await profile.inventory()
+        inv = profile.inventory
         if item_obj.id in inv and inv[item_obj.id] >= item_obj.max_quantity:
             await interaction.followup.send('You have reached the maximum quantity of this item!', ephemeral=True)
             return
-        if int(await profile.wallet()) < item_obj.price:
+        try:
+            await self.bot.transactions.buy(str(interaction.user.id), item_obj.id, item_obj.price,
+                                            item_obj.max_quantity)
+        except TransactionDeclined:
             await interaction.followup.send('You don\'t have enough beans!', ephemeral=True)
             return
-        await profile.add_currency(-item_obj.price, 'wallet')
-        await profile.add_item(item_obj)
 
         await interaction.followup.send(f'You bought a {item_obj.name} for {item_obj.price} beans!')
 
@@ -463,20 +533,26 @@ you got {amount} beans!")
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
         await profile.async_init()
         item_obj: Item = next(i for i in items if i.id == item)
-        inventory = await profile.inventory()
+        inventory = profile.inventory
         if item not in inventory or inventory[item] == 0:
             await interaction.followup.send('You don\'t have that item!', ephemeral=True)
             return
-        await item_obj.use(interaction)
         if item_obj.one_time:
-            await profile.remove_item(item_obj.id)
+            # Taken out before it's used, so it can't be used twice at once
+            profile.remove_item(item_obj.id)
+            try:
+                await profile.commit(reason='use')
+            except TransactionDeclined:
+                await interaction.followup.send('You don\'t have that item!', ephemeral=True)
+                return
+        await item_obj.use(interaction)
 
     @use.autocomplete('item')
     async def item_autocomplete(self, interaction: discord.Interaction, current: str):
         items = []
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
         await profile.async_init()
-        inventory = await profile.inventory()
+        inventory = profile.inventory
         for item in inventory:
             if inventory[item] == 0:
                 continue
@@ -489,7 +565,7 @@ you got {amount} beans!")
         await interaction.response.defer()
         profile = UserProfile(self.bot, self.bot.database, interaction.user)
         await profile.async_init()
-        inventory = await profile.inventory()
+        inventory = profile.inventory
         embed = discord.Embed(title=f"{interaction.user.display_name}'s inventory", color=0x00ff00)
         i = 0
         for item in inventory:
@@ -508,21 +584,46 @@ you got {amount} beans!")
     @app_commands.describe(amount="Numerical value")
     async def pay(self, interaction: discord.Interaction, target: discord.User, amount: int):
         await interaction.response.defer()
-        profile = UserProfile(self.bot, self.bot.database, interaction.user)
-        await profile.async_init()
-        target_profile = UserProfile(self.bot, self.bot.database, target)
-        await target_profile.async_init()
-        if int(await profile.wallet()) < amount:
-            await interaction.followup.send('You don\'t have enough beans!', ephemeral=True)
-            return
-        elif interaction.user.id == target.id:
+        if interaction.user.id == target.id:
             await interaction.followup.send('You can\'t pay yourself!', ephemeral=True)
             return
+        elif amount <= 0:
+            await interaction.followup.send('You can only pay a positive amount!', ephemeral=True)
+            return
 
-        await profile.add_currency(-amount, 'wallet')
-        await target_profile.add_currency(amount, 'wallet')
+        try:
+            await self.bot.transactions.transfer(str(interaction.user.id), str(target.id), amount)
+        except TransactionDeclined:
+            await interaction.followup.send('You don\'t have enough beans!', ephemeral=True)
+            return
         await interaction.followup.send(f'You paid {amount} beans to {target.mention}')
 
+    @app_commands.command(name='leaderboard', description='See who has the most beans')
+    @app_commands.allowed_installs(guilds=True, users=True)
+    @app_commands.describe(scope="Everyone, or only this server's members", page="Page number")
+    async def leaderboard(self, interaction: discord.Interaction,
+                          scope: Literal['global', 'server'] = 'global', page: int = 1):
+        await interaction.response.defer()
+        page = max(page, 1)
+        if scope == 'server':
+            if interaction.guild is None:
+                await interaction.followup.send('The server leaderboard only works in a server!', ephemeral=True)
+                return
+            ranked = await self.bot.leaderboard.guild_page(
+                [member.id for member in interaction.guild.members], page - 1, leaderboard_per_page)
+            title = f'{interaction.guild.name} leaderboard'
+        else:
+            ranked = await self.bot.leaderboard.page(page - 1, leaderboard_per_page)
+            title = 'Global leaderboard'
+
+        embed = discord.Embed(title=title, color=0x00ff00)
+        start = (page - 1) * leaderboard_per_page + 1
+        embed.description = '\n'.join(f'**{rank}.** <@{user_id}> - {net_worth} beans'
+                                       for rank, (user_id, net_worth) in enumerate(ranked, start)) \
+            or 'Nobody on this page yet!'
+        embed.set_footer(text=f'Page {page}')
+        await interaction.followup.send(embed=embed)
+
 
 async def setup(bot: KidneyBot):
     await bot.add_cog(Economy(bot))
@@ -60,7 +60,7 @@ class WarningsView(discord.ui.View):
             self.add_item(discord.ui.Button(label='No warnings - User not in guild', style=discord.ButtonStyle.secondary, disabled=True))
             return
 
-        doc = await self.bot.database.warnings.get(self.target.id, guild_id=self.target.guild.id)
+        doc = await self.bot.database.warnings.get(self.target.id, readonly=True, guild_id=self.target.guild.id)
         if doc is None:
             self.num_pages = 0
             self.warns = []
@@ -163,13 +163,13 @@ class Moderation(commands.Cog):
             raise ValueError('guild and user cannot both be None')
 
         if guild is not None:
-            doc = await self.bot.database.guild_config.get(guild.id)
+            doc = await self.bot.database.guild_config.get(guild.id, readonly=True)
             if doc is not None:
                 if doc.ephemeral_setting_overpowers_user_setting or user is None:
                     return bool(doc.ephemeral_moderation_messages)
 
         if user is not None:
-            doc2 = await self.bot.database.user_config.get(user.id)
+            doc2 = await self.bot.database.user_config.get(user.id, readonly=True)
             if doc2 is not None:
                 return bool(doc2.ephemeral_moderation_messages)
 
@@ -581,9 +581,6 @@ class Moderation(commands.Cog):
                 "You cannot moderate users higher than you", ephemeral=True)
             return
 
-        doc = await self.bot.database.warnings.get(user.id, guild_id=interaction.guild.id) or \
-              Schemas.WarnSchema(user.id, interaction.guild.id, warns=[])
-
         warn_dict = {
             "reason": reason,
             "timestamp": int(interaction.created_at.timestamp()),
@@ -591,10 +588,9 @@ class Moderation(commands.Cog):
             "id": str(uuid4())
         }
 
-        warns_list = doc.warns or []
-        warns_list.append(warn_dict)
-        doc.warns = warns_list
-        await self.bot.database.warnings.save(doc)
+        doc = await self.bot.database.warnings.update(user.id, push={"warns": warn_dict}, return_document=True,
+                                                      guild_id=interaction.guild.id)
+        warns_list = (doc.warns if doc is not None else None) or [warn_dict]
 
         dm_embed = discord.Embed(title=f"You have been warned in {interaction.guild}", color=discord.Color.red())
         dm_embed.add_field(name="Reason", value=reason, inline=False)
@@ -703,26 +699,14 @@ class Moderation(commands.Cog):
                 "You cannot moderate users higher than you", ephemeral=True)
             return
 
-        doc = await self.bot.database.warnings.get(user.id, guild_id=interaction.guild.id)
+        # Matches only if the user has that warn in this guild, so a missing one changes nothing
+        doc = await self.bot.database.warnings.update_if(user.id, {'warns.id': warn_id},
+                                                         pull={'warns': {'id': warn_id}},
+                                                         guild_id=interaction.guild.id)
         if doc is None:
-            await interaction.followup.send("This user has no warnings", ephemeral=True)
-            return
-
-        warns_list = doc.warns or []
-        warn_found = False
-        for i, warn in enumerate(warns_list):
-            if warn['id'] == warn_id:
-                del warns_list[i]
-                warn_found = True
-                break
-
-        if not warn_found:
             await interaction.followup.send("Warn not found", ephemeral=True)
             return
 
-        doc.warns = warns_list
-        await self.bot.database.warnings.save(doc)
-
         await interaction.followup.send("Warn deleted", ephemeral=await self.get_ephemeral_messages(interaction.guild))
 
 
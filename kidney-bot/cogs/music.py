@@ -912,8 +912,8 @@ class Music(commands.Cog):
         t0 = time.perf_counter()
         count = 0
         try:
-            docs = await self.bot.database.music_queues.all()
-            for doc in docs:
+            docs = await self.bot.database.music_queues.get_many(guild.id for guild in self.bot.guilds)
+            for doc in docs.values():
                 await self._restore_one(doc)
                 count += 1
         except Exception as e:
@@ -149,7 +149,7 @@ class Other(commands.Cog):
 
         embed = discord.Embed(title='Guild Settings Overview', color=discord.Color.blue())
 
-        ams = await self.bot.database.automodsettings.get(interaction.guild.id)
+        ams = await self.bot.database.automodsettings.get(interaction.guild.id, readonly=True)
         if ams is not None:
             whitelist = []
             for uid in (ams.whitelist or []):
@@ -159,7 +159,7 @@ class Other(commands.Cog):
             log_channel = interaction.guild.get_channel(ams.log_channel) if ams.log_channel else None
             embed.add_field(name='Auto Mod', value=f'Log Channel: {log_channel.mention if log_channel else None}\nWhitelist: {", ".join(whitelist)}')
 
-        ars = await self.bot.database.autorolesettings.get(interaction.guild.id)
+        ars = await self.bot.database.autorolesettings.get(interaction.guild.id, readonly=True)
         if ars is not None:
             roles = []
             for role_data in (ars.roles or []):
@@ -249,14 +249,18 @@ class Other(commands.Cog):
                 users.append(guild.owner)
                 ids.append(guild.owner_id)
 
-        user_configs = await self.bot.database.user_config.query_many({'announce_level': {'$gte': announce_level}})
+        # Read the ids up front so the cursor isn't held open across fetch_user calls
+        opted_in = [cfg.user_id async for cfg in self.bot.database.user_config.iter(
+            {'announce_level': {'$gte': announce_level}}, fields=('announce_level',))]
 
-        for user_cfg in user_configs:
-            if user_cfg.user_id and int(user_cfg.user_id) not in ids:
-                users.append(await self.bot.fetch_user(user_cfg.user_id))
-                ids.append(int(user_cfg.user_id))
+        for user_id in opted_in:
+            if user_id and int(user_id) not in ids:
+                users.append(await self.bot.fetch_user(user_id))
+                ids.append(int(user_id))
 
         ids = []
+        configs = await self.bot.database.user_config.get_many(
+            (user.id for user in users), fields=('announce_level',))
 
         successfully_sent = 0
         not_sent = 0
@@ -264,7 +268,7 @@ class Other(commands.Cog):
 
         for user in users:
             if int(user.id) not in ids:
-                user_config = await self.bot.database.user_config.get(user.id)
+                user_config = configs.get(user.id)
 
                 if user_config is None:
                     user_config = Schemas.UserConfig(
@@ -4,6 +4,8 @@
 
 import asyncio
 import datetime
+import io
+import json
 import logging
 import os
 import random
@@ -145,7 +147,7 @@ async def on_guild_join(guild: discord.Guild):
         logging.error("Bot user is None, cannot send welcome message.")
         return
 
-    doc = await bot.database.serverbans.query_one({"id": guild.id})
+    doc = await bot.database.serverbans.get(guild.id, readonly=True)
     if doc is not None:
         embed = discord.Embed(
             title=f"{guild} is banned.",
@@ -414,6 +416,11 @@ async def reloadconfig(ctx: commands.Context):
         await ctx.reply(f"{bot.get_lang_string("main.couldnt_reload_config")}\n`{e}`")
         return
 
+    bot.database.cache_options = bot.config.cache_options
+    bot.database.query_metrics.slow_query_ms = bot.config.slow_query_ms
+    if bot.database.connected:
+        bot.database.apply_cache_options()
+
     await ctx.reply(bot.get_lang_string("main.reloaded_config"))
 
 
@@ -421,10 +428,71 @@ async def reloadconfig(ctx: commands.Context):
 @is_bot_owner()
 async def clearcache(ctx: commands.Context):
     """Clear the bot's cache."""
+    entries = freed = evictions = 0
     for collection in bot.database.collections:
+        stats = collection.cache.stats()
+        entries += stats['entries']
+        freed += stats['bytes']
+        evictions += stats['evictions']
         collection.cache.clear()
 
-    await ctx.reply("Cache cleared.")
+    await ctx.reply(f"Cache cleared ({entries} entries, ~{freed / 1024:.0f} KiB; "
+                    f"{evictions} LRU evictions since startup).")
+
+
+@bot.command()
+@is_bot_owner()
+async def cachestats(ctx: commands.Context):
+    """Show per-collection cache hit/miss counters."""
+    lines = []
+    for collection in bot.database.collections:
+        stats = collection.cache.stats()
+        documents = await collection.count(estimated=True)
+        lines.append(
+            f"{collection.collection.name}: ~{documents} documents, "
+            f"{stats['entries']} cached (~{stats['bytes'] / 1024:.0f} KiB), "
+            f"{stats['absent_entries']} absent, "
+            f"{stats['hits']} hits, {stats['negative_hits']} negative hits, {stats['misses']} misses "
+            f"({stats['hit_ratio']:.0%}), {stats['stale_hits']} stale, {stats['evictions']} evicted"
+        )
+        if stats['max_entries'] is not None or stats['max_bytes'] is not None:
+            max_kib = f"{stats['max_bytes'] / 1024:.0f} KiB" if stats['max_bytes'] else "∞"
+            lines.append(f"  limits: {stats['max_entries'] or '∞'} entries, {max_kib}")
+        if collection.write_behind is not None:
+            writes = collection.write_stats()
+            lines.append(
+                f"  write-behind: {writes['pending']} pending, {writes['buffered_writes']} saves → "
+                f"{writes['flushed_writes']} writes ({writes['coalescing_ratio']:.1f}x), "
+                f"{writes['flushes']} flushes, avg {writes['avg_flush_ms']:.1f} ms"
+            )
+
+    await ctx.reply("```\n" + "\n".join(lines) + "\n```")
+
+
+@bot.command()
+@is_bot_owner()
+async def dbstats(ctx: commands.Context, reset: bool = False):
+    """Show MongoDB latency per collection and command, with the full metrics as JSON."""
+    metrics = bot.database.metrics()
+    queries = metrics['queries']
+    lines = [
+        f"{queries['commands']} commands, {queries['commands_per_second']:.1f}/s over the last minute "
+        f"({queries['avg_commands_per_second']:.1f}/s since start), "
+        f"{queries['slow_queries']} slower than {queries['slow_query_ms']:g} ms",
+        f"{'operation':<32}{'count':>8}{'avg':>8}{'p95':>8}{'max':>9}",
+    ]
+    # Busiest first, by total time spent
+    by_name: dict[str, dict[str, float]] = queries['operations']
+    operations = sorted(by_name.items(), key=lambda item: -item[1]['total_ms'])
+    for name, op in operations[:15]:
+        lines.append(f"{name:<32}{op['count']:>8}{op['avg_ms']:>8.1f}{op['p95_ms']:>8.0f}{op['max_ms']:>9.1f}")
+    if len(operations) > 15:
+        lines.append(f"... {len(operations) - 15} more in the attached file")
+
+    file = discord.File(io.BytesIO(json.dumps(metrics, indent=2).encode()), filename="metrics.json")
+    await ctx.reply("```\n" + "\n".join(lines) + "\n```", file=file)
+    if reset:
+        bot.database.query_metrics.reset()
 
 
 @bot.command()
@@ -567,11 +635,11 @@ async def main():
                     task.cancel()
 
         # async with bot exits here: __aexit__ calls bot.close() which unloads cogs
-        # (music cog saves queue state to MongoDB before returning), then we close the client.
+        # (music cog saves queue state to MongoDB before returning), then we flush buffered
+        # writes and close the client.
     finally:
         logging.info("Shutting down...")
-        if bot.database.connected:
-            await bot.database.client.close()  # type: ignore
+        await bot.database.close()
         logging.info("Shutdown complete.")
 
 
@@ -0,0 +1,78 @@
+# Recent channel activity
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import time
+from collections import OrderedDict
+
+import discord
+
+
+class RecentActivity:
+    """Who posted where in the last `window` seconds, fed from on_message, so
+    commands that reward a channel's recent chatters don't have to page through
+    its history over REST.
+
+    Only covers the time since `start` (called on ready): messages sent while the
+    bot was offline never reached it. Channels are trimmed as they are written and
+    read, and swept once per `window` so quiet ones don't linger.
+    """
+
+    def __init__(self, window: float = 120) -> None:
+        self.window = window
+        # channel id → author id → time of their latest message there, oldest first
+        self._channels: dict[int, OrderedDict[int, float]] = {}
+        self._since = float('inf')
+        self._sweep_task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        """Mark the buffer as complete from now on, and start the periodic sweep."""
+        self._since = time.time()
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    def stop(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+    def record(self, message: discord.Message) -> None:
+        if message.author.bot:
+            return
+        sent = message.created_at.timestamp()
+        authors = self._channels.setdefault(message.channel.id, OrderedDict())
+        authors[message.author.id] = sent
+        authors.move_to_end(message.author.id)
+        self._trim(message.channel.id, sent - self.window)
+
+    def authors(self, channel_id: int, since: float) -> list[int] | None:
+        """Ids of the users (not bots) who posted in the channel at or after `since`
+        (a Unix timestamp), or None if the buffer doesn't reach back that far."""
+        if since < self._since or since < time.time() - self.window:
+            return None
+        self.sweep()
+        return [author for author, sent in self._channels.get(channel_id, {}).items() if sent >= since]
+
+    def sweep(self) -> int:
+        """Drop what fell out of the window from every channel, and the channels
+        left empty. Returns how many channels were dropped."""
+        cutoff = time.time() - self.window
+        before = len(self._channels)
+        for channel_id in list(self._channels):
+            self._trim(channel_id, cutoff)
+        return before - len(self._channels)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.window)
+            self.sweep()
+
+    def _trim(self, channel_id: int, cutoff: float) -> None:
+        authors = self._channels.get(channel_id)
+        if authors is None:
+            return
+        while authors and next(iter(authors.values())) < cutoff:
+            authors.popitem(last=False)
+        if not authors:
+            del self._channels[channel_id]
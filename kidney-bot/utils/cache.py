@@ -1,57 +1,207 @@
 import logging
+import sys
 import time
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+
+def _without_id(doc: dict) -> dict:
+    return {k: v for k, v in doc.items() if k != "_id"}
+
+
+def approx_size(value: Any) -> int:
+    """Rough deep size of a BSON-like document in bytes (sys.getsizeof of every
+    dict, list, key and scalar). Good enough for a memory budget, not exact."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + approx_size(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += approx_size(v)
+    return size
 
 
 class Cache:
     """
-    O(1) document cache keyed on a single primary field.
+    O(1) document cache keyed on a primary field, or on a tuple of fields for
+    compound keys (e.g. ("user_id", "guild_id"), keyed by the tuple of values).
 
-    Only serves cache hits for simple single-key queries (e.g. {guild_id: 123}).
+    Only serves cache hits for simple primary-key queries (e.g. {guild_id: 123}).
     Queries with extra filter fields are passed through to the database so the
     cache never returns stale partial matches.
 
+    Given a `decode` function, each entry also memoizes its decoded form (see
+    lookup_decoded), so hot keys are decoded once per cache fill rather than once
+    per read. Callers must not mutate what it returns.
+
+    Lookups that found nothing in the database can be remembered as "known absent"
+    with their own (usually shorter) TTL, so guilds without a settings document
+    don't cost a round-trip on every action. Adding or removing a key clears its
+    absent marker.
+
+    With `max_entries` and/or `max_bytes` set, the least recently used documents
+    are evicted once either limit is exceeded. Sizes are estimated from the raw
+    document (see approx_size). Absent markers are capped at `max_entries` too,
+    oldest first.
+
     All methods are synchronous — no asyncio needed for dict operations.
     Call cleanup() periodically (the Database class drives this via one shared task).
+    Every entry in a cache shares one TTL, so insertion order is expiry order:
+    cleanup() pops expired entries off the front of that queue and stops at the
+    first live one, touching only what actually expired.
+
+    Expired documents can be kept a while longer for callers that prefer an old
+    value to waiting on the database: up to `stale_ttl` seconds past the TTL for
+    stale-while-revalidate, and up to `stale_if_error` seconds for when the
+    database is unreachable (see lookup_stale). With `refresh_ahead` set (a
+    fraction of the TTL), refresh_due() flags entries read at least
+    `refresh_min_reads` times once they are that far into their TTL.
     """
 
-    def __init__(self, primary_key: str, ttl: int = 300):
+    def __init__(self, primary_key: str | tuple[str, ...], ttl: int = 300, negative_ttl: int = 60,
+                 decode: Callable[[dict], Any] | None = None,
+                 max_entries: int | None = None, max_bytes: int | None = None,
+                 stale_ttl: float = 0, stale_if_error: float = 0,
+                 refresh_ahead: float | None = None, refresh_min_reads: int = 3):
         self._pk = primary_key
+        self._fields: tuple[str, ...] = (primary_key,) if isinstance(primary_key, str) else tuple(primary_key)
         self._ttl = ttl
-        # primary_key_value → {"value": doc, "ts": float}
-        self._store: dict = {}
+        self._negative_ttl = negative_ttl
+        self._decode = decode
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._stale_ttl = stale_ttl
+        self._stale_if_error = stale_if_error
+        self._refresh_ahead = refresh_ahead
+        self._refresh_min_reads = refresh_min_reads
+        # primary_key_value → {"value": doc, "ts": float, "obj": decoded doc or None,
+        # "reads": hits since filled, "size": approx bytes}, least recently used first
+        self._store: OrderedDict = OrderedDict()
+        # The same keys, oldest insertion first (update() keeps a key's place)
+        self._expiry: OrderedDict = OrderedDict()
+        # primary_key_value → ts of the lookup that found nothing, oldest first
+        self._absent: OrderedDict = OrderedDict()
+        # _id → primary_key_value, for the cached documents whose _id is known
+        self._ids: dict = {}
+        self._bytes = 0
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+
+    def set_limits(self, max_entries: int | None = None, max_bytes: int | None = None) -> None:
+        """Change the size limits (None = unbounded), evicting right away if needed."""
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._evict()
+
+    def set_staleness(self, stale_ttl: float = 0, stale_if_error: float = 0,
+                      refresh_ahead: float | None = None) -> None:
+        self._stale_ttl = stale_ttl
+        self._stale_if_error = stale_if_error
+        self._refresh_ahead = refresh_ahead
 
     # ── write ──────────────────────────────────────────────────────────────────
 
-    def add(self, doc: dict) -> None:
-        key = doc.get(self._pk)
+    def add(self, doc: dict, decoded: Any = None) -> None:
+        key = self.key_of(doc)
         if key is None:
             return
-        self._store[key] = {"value": doc, "ts": time.monotonic()}
+        self._absent.pop(key, None)
+        self._put(key, {"value": doc, "ts": time.monotonic(), "obj": decoded, "reads": 0})
 
     def add_many(self, docs: list[dict]) -> None:
         for doc in docs:
             self.add(doc)
 
+    def add_absent(self, query: dict) -> None:
+        """Remember that the database has no document for this simple {pk: val} query."""
+        pk_val = self._query_key(query)
+        if pk_val is None:
+            return
+        self._pop(pk_val)
+        self._absent.pop(pk_val, None)
+        self._absent[pk_val] = time.monotonic()
+        if self._max_entries is not None and len(self._absent) > self._max_entries:
+            self._absent.popitem(last=False)
+
     def update(self, query: dict, update: dict) -> None:
+        """Apply a Mongo-style update to the cached doc, if there is one.
+
+        Supports $set, $unset, $inc, $push (including $each) and $pull of plain
+        values, with dotted field paths. Anything else drops the entry so the next
+        read refetches it.
+        """
         item = self._get_item(query)
         if item is None:
             return
         doc = item["value"].copy()
-        if "$set" in update:
-            doc.update(update["$set"])
-        if "$unset" in update:
-            for k in update["$unset"]:
-                doc.pop(k, None)
-        pk_val = query[self._pk]
-        self._store[pk_val] = {"value": doc, "ts": item["ts"]}
+        try:
+            for op, fields in update.items():
+                for path, value in fields.items():
+                    parent, field = self._parent(doc, path)
+                    if op == "$set":
+                        parent[field] = value
+                    elif op == "$unset":
+                        parent.pop(field, None)
+                    elif op == "$inc":
+                        parent[field] = parent.get(field, 0) + value
+                    elif op == "$push":
+                        values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                        parent[field] = [*parent.get(field, []), *values]
+                    elif op == "$pull" and not isinstance(value, dict):
+                        parent[field] = [v for v in parent.get(field, []) if v != value]
+                    else:
+                        raise TypeError(op)
+        except (TypeError, ValueError, AttributeError):
+            self.remove(query)
+            return
+        self._put(self._query_key(query), {"value": doc, "ts": item["ts"], "obj": None, "reads": item["reads"]})
+
+    def refresh(self, doc: dict) -> bool:
+        """Replace the entry for this document's key with `doc`, but only if the
+        cache holds that key (as a document or absent marker) and the content
+        differs. For changes made elsewhere; returns whether anything changed."""
+        key = self.key_of(doc)
+        item = self._store.get(key)
+        if item is None:
+            if key not in self._absent:
+                return False
+        elif _without_id(item["value"]) == _without_id(doc):
+            return False
+        self.add(doc)
+        return True
+
+    def remove_id(self, doc_id: Any) -> Any:
+        """Drop the entry whose document has this `_id` and return its key, or None
+        if no cached document is known by it. A save keeps the `_id` of the document
+        it replaces in the cache, but a key first cached from a save has none."""
+        pk_val = self._ids.get(doc_id)
+        if pk_val is not None:
+            self._pop(pk_val)
+        return pk_val
+
+    def keys(self) -> list:
+        """Every key the cache holds, as a document or an absent marker."""
+        return [*self._store, *self._absent]
 
     def remove(self, query: dict) -> None:
-        pk_val = query.get(self._pk)
+        """Drop the entry for the key in `query` (extra fields are ignored)."""
+        pk_val = self.key_of(query)
         if pk_val is not None:
-            self._store.pop(pk_val, None)
+            self._pop(pk_val)
+            self._absent.pop(pk_val, None)
 
     def clear(self) -> None:
         self._store.clear()
+        self._expiry.clear()
+        self._absent.clear()
+        self._ids.clear()
+        self._bytes = 0
 
     # ── read ───────────────────────────────────────────────────────────────────
 
@@ -60,28 +210,191 @@ class Cache:
         item = self._get_item(query)
         return item["value"] if item is not None else None
 
+    def lookup(self, query: dict) -> tuple[bool, dict | None]:
+        """Return (hit, doc) and update the hit/miss counters.
+
+        (True, doc) is a cached document, (True, None) a cached "known absent"
+        entry, and (False, None) means the caller has to ask the database.
+        """
+        hit, item = self._lookup_item(query)
+        return hit, item["value"] if item is not None else None
+
+    def lookup_decoded(self, query: dict) -> tuple[bool, Any]:
+        """Like lookup(), but returns the memoized decoded doc instead of the raw one."""
+        hit, item = self._lookup_item(query)
+        if item is None:
+            return hit, None
+        return True, self._decoded(item)
+
+    def lookup_stale(self, query: dict, on_error: bool = False) -> Any:
+        """Return the decoded doc of an expired entry that is still within its
+        stale window (`stale_if_error` with on_error, else `stale_ttl`), or None."""
+        item = self._store.get(self._query_key(query))
+        if item is None:
+            return None
+        overdue = time.monotonic() - item["ts"] - self._ttl
+        if not 0 < overdue <= (self._stale_if_error if on_error else self._stale_ttl):
+            return None
+        self.stale_hits += 1
+        return self._decoded(item)
+
+    def refresh_due(self, query: dict) -> bool:
+        """Whether a cached entry is read often enough, and close enough to
+        expiring, that it should be refetched in the background now."""
+        if self._refresh_ahead is None:
+            return False
+        item = self._store.get(self._query_key(query))
+        return (item is not None and item["reads"] >= self._refresh_min_reads
+                and time.monotonic() - item["ts"] > self._ttl * self._refresh_ahead)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "entries": len(self._store),
+            "absent_entries": len(self._absent),
+            "bytes": self._bytes,
+            "max_entries": self._max_entries,
+            "max_bytes": self._max_bytes,
+            "evictions": self.evictions,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
     # ── maintenance ────────────────────────────────────────────────────────────
 
     def cleanup(self) -> int:
         now = time.monotonic()
-        expired = [k for k, v in self._store.items() if now - v["ts"] > self._ttl]
-        for k in expired:
-            del self._store[k]
-        if expired:
-            logging.debug(f"Cache({self._pk}): evicted {len(expired)} expired entries")
-        return len(expired)
+        removed = 0
+        while self._expiry:
+            key = next(iter(self._expiry))
+            if now - self._store[key]["ts"] <= self._ttl + self._retention:
+                break
+            self._pop(key)
+            removed += 1
+        while self._absent:
+            key, ts = next(iter(self._absent.items()))
+            if now - ts <= self._negative_ttl:
+                break
+            del self._absent[key]
+            removed += 1
+        if removed:
+            logging.debug(f"Cache({self._pk}): evicted {removed} expired entries")
+        return removed
+
+    def key_of(self, doc: dict) -> Any:
+        """The cache key for a document (or query): the primary key value, a tuple
+        of values for compound keys, or None if any of them is missing."""
+        if len(self._fields) == 1:
+            return doc.get(self._pk)
+        key = tuple(doc.get(field) for field in self._fields)
+        return None if None in key else key
 
     # ── internal ───────────────────────────────────────────────────────────────
 
-    def _get_item(self, query: dict):
-        """Return raw cache item only for simple single-pk queries."""
-        if len(query) != 1 or self._pk not in query:
+    def _query_key(self, query: dict) -> Any:
+        """The cache key for a query on exactly the primary key fields, else None."""
+        if len(query) != len(self._fields):
             return None
-        pk_val = query[self._pk]
+        return self.key_of(query)
+
+    @property
+    def _retention(self) -> float:
+        """How long past the TTL an entry is kept for stale reads."""
+        return max(self._stale_ttl, self._stale_if_error)
+
+    def _decoded(self, item: dict) -> Any:
+        if item["obj"] is None and self._decode is not None:
+            item["obj"] = self._decode(item["value"])
+        return item["obj"]
+
+    def _put(self, pk_val: Any, item: dict) -> None:
+        old = self._store.pop(pk_val, None)
+        if old is not None:
+            self._bytes -= old["size"]
+        if old is None or old["ts"] != item["ts"]:
+            self._expiry.pop(pk_val, None)
+            self._expiry[pk_val] = None
+        # Documents written by this process don't carry their _id, the one read before does
+        item["id"] = item["value"].get("_id", old["id"] if old is not None else None)
+        if old is not None and old["id"] is not None and old["id"] != item["id"]:
+            del self._ids[old["id"]]
+        if item["id"] is not None:
+            self._ids[item["id"]] = pk_val
+        item["size"] = approx_size(item["value"])
+        self._store[pk_val] = item
+        self._bytes += item["size"]
+        self._evict()
+
+    def _pop(self, pk_val: Any) -> None:
+        item = self._store.pop(pk_val, None)
+        if item is not None:
+            self._bytes -= item["size"]
+            del self._expiry[pk_val]
+            if item["id"] is not None:
+                del self._ids[item["id"]]
+
+    def _evict(self) -> None:
+        while self._store and (
+                (self._max_entries is not None and len(self._store) > self._max_entries)
+                or (self._max_bytes is not None and self._bytes > self._max_bytes)):
+            pk_val, item = self._store.popitem(last=False)
+            del self._expiry[pk_val]
+            if item["id"] is not None:
+                del self._ids[item["id"]]
+            self._bytes -= item["size"]
+            self.evictions += 1
+        if self._max_entries is not None:
+            while len(self._absent) > self._max_entries:
+                self._absent.popitem(last=False)
+
+    def _get_item(self, query: dict):
+        """Return raw cache item only for simple primary-key queries."""
+        pk_val = self._query_key(query)
         item = self._store.get(pk_val)
         if item is None:
             return None
-        if time.monotonic() - item["ts"] > self._ttl:
-            del self._store[pk_val]
+        age = time.monotonic() - item["ts"]
+        if age > self._ttl:
+            if age > self._ttl + self._retention:
+                self._pop(pk_val)
             return None
+        self._store.move_to_end(pk_val)
         return item
+
+    @staticmethod
+    def _parent(doc: dict, path: str) -> tuple[dict, str]:
+        """Resolve a dotted path to (containing dict, last key), copying each nested
+        dict on the way so the previously cached doc is never mutated."""
+        *parents, field = path.split(".")
+        for key in parents:
+            child = doc.get(key)
+            child = dict(child) if child is not None else {}
+            doc[key] = child
+            doc = child
+        return doc, field
+
+    def _lookup_item(self, query: dict) -> tuple[bool, dict | None]:
+        """Counted lookup: (True, item), (True, None) for known absent, or (False, None)."""
+        item = self._get_item(query)
+        if item is not None:
+            self.hits += 1
+            item["reads"] += 1
+            return True, item
+        if self._is_absent(query):
+            self.negative_hits += 1
+            return True, None
+        self.misses += 1
+        return False, None
+
+    def _is_absent(self, query: dict) -> bool:
+        pk_val = self._query_key(query)
+        ts = self._absent.get(pk_val)
+        if ts is None:
+            return False
+        if time.monotonic() - ts > self._negative_ttl:
+            del self._absent[pk_val]
+            return False
+        return True
@@ -0,0 +1,108 @@
+# Cross-process cache invalidation
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+from collections.abc import Iterable
+from typing import Any
+
+from pymongo.errors import ConnectionFailure, OperationFailure
+
+# Server error codes
+CHANGE_STREAMS_UNSUPPORTED = 40573  # standalone server, no oplog
+CHANGE_STREAM_HISTORY_LOST = 286    # resume token fell off the oplog
+CHANGE_STREAM_FATAL = 280
+
+
+class ChangeWatcher:
+    """Keeps each Collection's cache in step with writes made by other processes
+    (other shards, the dashboard).
+
+    Watches the whole database with one change stream. Inserts, replaces and
+    updates refresh keys this process has cached (using the post-change document),
+    deletes drop them. The resume token is kept, so a dropped connection resumes
+    without missing events; if the token is too old to resume from, every cache
+    is cleared instead.
+
+    Standalone servers have no change streams; there the watcher falls back to
+    refetching every cached key each `poll_interval` seconds.
+    """
+
+    def __init__(self, db: Any, collections: Iterable[Any], poll_interval: float = 30,
+                 retry_delay: float = 5) -> None:
+        self._db = db
+        self._collections = {col.collection.name: col for col in collections}
+        self._poll_interval = poll_interval
+        self._retry_delay = retry_delay
+        self.resume_token: Any = None
+        self.polling = False
+        self.events = 0
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self._watch()
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    break
+                if e.code in (CHANGE_STREAM_HISTORY_LOST, CHANGE_STREAM_FATAL):
+                    logging.warning(f'Change stream cannot resume ({e}), clearing caches and starting over')
+                    self._clear_all()
+                    self.resume_token = None
+                else:
+                    logging.error(f'Change stream failed, retrying: {e}')
+                    await asyncio.sleep(self._retry_delay)
+            except ConnectionFailure as e:
+                logging.warning(f'Change stream disconnected, resuming: {e}')
+                await asyncio.sleep(self._retry_delay)
+        await self._poll()
+
+    async def _watch(self) -> None:
+        pipeline = [{'$match': {'ns.coll': {'$in': list(self._collections)}}}]
+        async with await self._db.watch(pipeline, full_document='updateLookup',
+                                        resume_after=self.resume_token) as stream:
+            if self.resume_token is None:
+                logging.info(f'Watching {len(self._collections)} collections for changes from other processes')
+            async for change in stream:
+                self.apply(change)
+                # An invalidate event ends the stream and can't be resumed after
+                self.resume_token = None if change['operationType'] == 'invalidate' else stream.resume_token
+
+    def apply(self, change: dict) -> None:
+        self.events += 1
+        operation = change['operationType']
+        col = self._collections.get(change.get('ns', {}).get('coll'))
+        if operation == 'invalidate' or (col is None and operation in ('dropDatabase', 'rename')):
+            self._clear_all()
+            return
+        if col is None:
+            return
+
+        if operation in ('insert', 'replace', 'update'):
+            doc = change.get('fullDocument')
+            if doc is not None:
+                col.apply_external(doc)
+            else:
+                # Deleted again before the update could be looked up
+                col.apply_external_delete(change['documentKey'])
+        elif operation == 'delete':
+            col.apply_external_delete(change['documentKey'])
+        elif operation in ('drop', 'rename'):
+            col.cache.clear()
+
+    async def _poll(self) -> None:
+        self.polling = True
+        logging.info(f'Change streams unavailable on a standalone server, '
+                     f'revalidating cached documents every {self._poll_interval:g}s instead')
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            for col in self._collections.values():
+                try:
+                    await col.revalidate()
+                except Exception as e:
+                    logging.warning(f'{col.collection.name}: cache revalidation failed: {e}')
+
+    def _clear_all(self) -> None:
+        for col in self._collections.values():
+            col.cache.clear()
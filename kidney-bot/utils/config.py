@@ -11,6 +11,16 @@ import sys
 import yaml
 
 from utils.database import convert_except_none
+from utils.local_storage import BACKENDS
+
+CACHE_OPTIONS: dict[str, type] = {
+    'max_entries': int,
+    'max_bytes': int,
+    'stale_ttl': float,
+    'stale_if_error': float,
+    'refresh_ahead': float,
+    'count_ttl': float,
+}
 
 
 class Config:
@@ -40,9 +50,15 @@ class Config:
             if self.token is None or self.token == "" or self.token == "SET ME!!":
                 raise ValueError('Bot token must be set in config.json')
 
-            # Database string is required
-            self.dbstring: str = self.conf_json['dbstring']
-            if self.dbstring is None or self.dbstring == "" or self.dbstring == "SET ME!!":
+            # mongodb, or an embedded sqlite/memory store for small self-hosted instances
+            self.storage: str = self.conf_json.get('storage') or 'mongodb'
+            if self.storage not in BACKENDS:
+                raise ValueError(f'storage must be one of {", ".join(BACKENDS)}, not {self.storage!r}')
+            self.storage_path: str = self.conf_json.get('storage_path') or 'kidney-bot.sqlite3'
+
+            # Database string is required for MongoDB
+            self.dbstring: str = self.conf_json.get('dbstring') or ''
+            if self.storage == 'mongodb' and self.dbstring in ("", "SET ME!!"):
                 raise ValueError('Database string must be set in config.json')
 
             # Owner ID is required
@@ -93,6 +109,23 @@ class Config:
             if not (self.spotify_client_id and self.spotify_client_secret):
                 logging.warning('Spotify credentials not configured — Spotify links will be disabled.')
 
+            # Apply writes made by other bot processes / the dashboard to the caches
+            self.watch_changes: bool = bool(self.conf_json.get('watch_changes', False))
+            self.watch_poll_interval: float = convert_except_none(
+                self.conf_json.get('watch_poll_interval') or None, float) or 30
+
+            self.slow_query_ms: float = convert_except_none(self.conf_json.get('slow_query_ms') or None, float) or 100
+
+            # Per-collection cache options: {"default" | collection name: {option: value}}
+            self.cache_options: dict[str, dict[str, float | None]] = {}
+            for name, options in (self.conf_json.get('cache') or {}).items():
+                if name.startswith('_') or not isinstance(options, dict):
+                    continue
+                self.cache_options[name] = {
+                    key: convert_except_none(options[key] if options[key] != '' else None, type_)
+                    for key, type_ in CACHE_OPTIONS.items() if key in options
+                }
+
             with open(self.langfile) as f:
                 self.lang = yaml.safe_load(f)
 
@@ -106,10 +139,13 @@ class Config:
         if self.token != self.conf_json['token']:
             raise ValueError('Token changed, please restart kidney-bot.')
 
-        if self.dbstring != self.conf_json['dbstring']:
+        if self.dbstring != (self.conf_json.get('dbstring') or ''):
             raise ValueError(
                 'Database string changed, please restart kidney-bot.')
 
+        if self.storage != (self.conf_json.get('storage') or 'mongodb'):
+            raise ValueError('Storage backend changed, please restart kidney-bot.')
+
         self.load()
 
     def get_primary_owner_id(self) -> int:
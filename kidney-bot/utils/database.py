@@ -3,13 +3,20 @@
 # Full license at LICENSE.md
 
 import asyncio
+import functools
 import logging
-from typing import Any, TypeVar, cast
+import time
+from collections.abc import AsyncIterator, Callable, Iterable
+from typing import Any, ClassVar, Self, TypeVar, cast, dataclass_transform, overload
 
-from pymongo import ASCENDING, AsyncMongoClient
-from pymongo.errors import OperationFailure
+from pymongo import ASCENDING, DESCENDING, AsyncMongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, OperationFailure
 
 from utils.cache import Cache
+from utils.change_watcher import ChangeWatcher
+from utils.local_storage import LocalClient
+from utils.migrations import FieldMigration, Migration, MigrationRunner
+from utils.query_metrics import QueryMetrics
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 
@@ -28,20 +35,212 @@ def remove_none_values(dictionary: dict) -> dict:
     return {k: v for k, v in dictionary.items() if v is not None}
 
 
+def _clone(value: Any) -> Any:
+    """Copy nested lists/dicts (the only mutable values schemas hold), share the rest."""
+    if type(value) is list:
+        return [_clone(v) for v in value]
+    if type(value) is dict:
+        return {k: _clone(v) for k, v in value.items()}
+    return value
+
+
+def _read_only(self: Any, name: str, value: Any = None) -> None:
+    raise AttributeError(f'{type(self).__name__} is a read-only view shared with the cache; '
+                         'call .copy() to get a modifiable instance')
+
+
+@functools.cache
+def _frozen_variant(cls: type) -> type:
+    return type(f'Frozen{cls.__name__}', (cls,), {
+        '__slots__': (), '__setattr__': _read_only, '__delattr__': _read_only, '_mutable_class': cls,
+    })
+
+
 # ── Schemas ───────────────────────────────────────────────────────────────────
 
+class Field:
+    """One schema field. `convert` is applied to non-None values when a schema is
+    built or decoded (None keeps the value as-is; containers are copied). `aliases`
+    are legacy document field names, read when the field itself is missing.
+    Fields with a `default_factory` get it instead of None and are always written;
+    the others pass `default=None`, which is the only default they can have.
+
+    Typed as returning Any so `name: int | None = Field(int, default=None)` checks,
+    like `dataclasses.field`."""
+    __slots__ = ('aliases', 'convert', 'default_factory')
+    convert: type | None
+    aliases: tuple[str, ...]
+    default_factory: Callable[[], Any] | None
+
+    def __new__(cls, convert: type | None = None, *, default: None = None, aliases: tuple[str, ...] = (),
+                default_factory: Callable[[], Any] | None = None) -> Any:
+        self = super().__new__(cls)
+        self.convert = convert
+        self.aliases = aliases
+        self.default_factory = default_factory
+        return self
+
+
+# Converted by a type check plus constructor call, instead of copied
+_SCALARS = (int, float, str, bool)
+
+
+def _slot(name: str, field: Field) -> str:
+    """Container fields are stored under another slot, behind a copy-on-access property."""
+    return name if field.convert in _SCALARS else f'_slot_{name}'
+
+
+def _codec_source(fields: dict[str, Field]) -> str:
+    """Source of a factory returning __init__, from_dict, to_dict and copy
+    specialized to `fields`: straight-line attribute stores, no per-field
+    function calls or dict rebuilds. Helpers and converters are closure
+    variables, which are cheaper to load than globals.
+
+    For container fields it also returns a getter/setter pair each and `_unshare`:
+    a copy of a frozen instance shares its containers (`_shared`) until one of them
+    is read or assigned, and then clones them all."""
+    def convert(i: int, field: Field) -> list[str]:
+        lines = []
+        if field.convert in _SCALARS:
+            lines.append(f'if _v is not None and _v.__class__ is not _t{i}: _v = _convert(_v, _t{i})')
+        elif field.convert is not None:
+            lines.append(f'if _v is not None: _v = _t{i}(_v)')
+        if field.default_factory is not None:
+            lines.append(f'if _v is None: _v = _d{i}()')
+        return lines
+
+    containers = [(i, name, _slot(name, field)) for i, (name, field) in enumerate(fields.items())
+                  if field.convert not in _SCALARS]
+    params = ', '.join(f'{name}=None' for name in fields)
+    init = [f'def __init__(self, {params}):']
+    decode = ['def from_dict(cls, data):',
+              '    if data is None:',
+              '        return cls()',
+              '    self = _new(cls)',
+              '    _get = data.get']
+    encode = ['def to_dict(self):', '    _d = {}']
+    copy = ['def copy(self):', '    _c = _new(self._mutable_class or self.__class__)']
+    unshare = ['def _unshare(self):', '    self._shared = False']
+    accessors = []
+
+    for i, (name, field) in enumerate(fields.items()):
+        slot = _slot(name, field)
+        init += [f'    _v = {name}'] + [f'    {line}' for line in convert(i, field)] + [f'    self.{slot} = _v']
+
+        decode.append(f'    _v = _get({name!r})')
+        decode += [f'    if _v is None: _v = _get({alias!r})' for alias in field.aliases]
+        decode += [f'    {line}' for line in convert(i, field)] + [f'    self.{slot} = _v']
+
+        if field.default_factory is not None:
+            encode.append(f'    _d[{name!r}] = self.{slot}')
+        else:
+            encode += [f'    _v = self.{slot}', f'    if _v is not None: _d[{name!r}] = _v']
+
+        if slot == name:
+            copy.append(f'    _c.{name} = self.{name}')
+
+    if containers:
+        # Nothing mutates a frozen instance's containers, so its copies can borrow them
+        copy.append('    if self._mutable_class is not None or self._shared:')
+        copy += [f'        _c.{slot} = self.{slot}' for _, _, slot in containers]
+        copy += ['        _c._shared = True', '    else:']
+        copy += [f'        _c.{slot} = _clone(self.{slot})' for _, _, slot in containers]
+        copy.append('        _c._shared = False')
+        for i, _, slot in containers:
+            unshare.append(f'    self.{slot} = _clone(self.{slot})')
+            accessors += [f'def _get{i}(self):',
+                          '    if self._shared: self._unshare()',
+                          f'    return self.{slot}',
+                          f'def _set{i}(self, _v):',
+                          '    if self._shared: self._unshare()',
+                          f'    self.{slot} = _v']
+    else:
+        copy.append('    _c._shared = False')
+
+    init += ['    self._projection = None', '    self._shared = False']
+    decode += ['    self._projection = None', '    self._shared = False', '    return self']
+    encode.append('    return _d')
+    copy += ['    _c._projection = self._projection', '    return _c']
+    properties = ', '.join(f'{name!r}: (_get{i}, _set{i})' for i, name, _ in containers)
+    converters = ''.join(f', _t{i}, _d{i}' for i in range(len(fields)))
+    body = '\n'.join(f'    {line}' for line in init + decode + encode + copy + unshare + accessors)
+    return (f'def _make(_new, _convert, _clone{converters}):\n{body}\n'
+            f'    return __init__, from_dict, to_dict, copy, _unshare, {{{properties}}}\n')
+
+
+@dataclass_transform(field_specifiers=(Field,))
+class _SchemaMeta(type):
+    """Turns `name = Field(...)` class attributes into `__slots__` and generates
+    the class's codecs (see _codec_source). The generated functions implement the
+    typed `__init__`, `from_dict`, `to_dict` and `copy` that type checkers see
+    (the dataclass-style `__init__`, and BaseSchema's declarations)."""
+
+    def __new__(mcs, name: str, bases: tuple[type, ...], namespace: dict[str, Any]) -> type:
+        own = {key: value for key, value in namespace.items() if isinstance(value, Field)}
+        if own:
+            for key in own:
+                del namespace[key]
+            fields: dict[str, Field] = {}
+            for base in bases:
+                fields.update(getattr(base, '_fields', {}))
+            fields.update(own)
+            scope: dict[str, Any] = {}
+            exec(_codec_source(fields), scope)
+            converters = [value for field in fields.values() for value in (field.convert, field.default_factory)]
+            init, from_dict, to_dict, copy, unshare, accessors = scope['_make'](
+                object.__new__, convert_except_none, _clone, *converters)
+            namespace.update(__slots__=tuple(_slot(key, field) for key, field in own.items()),
+                             _fields=fields, _stored_as={key: (key, *field.aliases) for key, field in fields.items()},
+                             __init__=init, from_dict=classmethod(from_dict),
+                             to_dict=to_dict, copy=copy, _unshare=unshare)
+            namespace.update({key: property(*pair) for key, pair in accessors.items()})
+        return super().__new__(mcs, name, bases, namespace)
+
+
 class Schemas:
-    class BaseSchema:
+    class BaseSchema(metaclass=_SchemaMeta):
+        """Declare fields as `name: type = Field(...)`; instances are slotted, and
+        __init__ (positional in declaration order), from_dict, to_dict and copy
+        are generated for each schema."""
+        __slots__ = ('_projection', '_shared')
+        _fields: ClassVar[dict[str, Field]] = {}
+        # Field name → every document field it is read from (its own name, then aliases)
+        _stored_as: ClassVar[dict[str, tuple[str, ...]]] = {}
+        _mutable_class: ClassVar[type | None] = None
+
         def __init__(self) -> None:
-            pass
+            # Fields a projected read loaded (see Collection.get); None for full documents
+            self._projection: frozenset[str] | None = None
+            # Container fields still borrowed from the frozen instance this was copied from
+            self._shared = False
 
         @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.BaseSchema':
+        def from_dict(cls, data: dict | None) -> Self:
             raise NotImplementedError
 
         def to_dict(self) -> dict:
             raise NotImplementedError
 
+        @property
+        def is_partial(self) -> bool:
+            """True if read with `fields=...`: fields outside the projection are just unset."""
+            return self._projection is not None
+
+        def copy(self) -> Self:
+            """Independent, modifiable copy (nested lists/dicts included), without
+            re-running field conversion. Also turns a frozen view back into a normal instance.
+            A copy of a frozen instance clones the lists/dicts on first access, not up front."""
+            raise NotImplementedError
+
+        def freeze(self) -> Self:
+            """Make this instance read-only in place: assigning attributes raises.
+            Nested lists/dicts are not locked, so treat them as read-only too."""
+            if self._mutable_class is None:
+                # Borrowed containers are as read-only as the ones it owns from here on
+                self._shared = False
+                self.__class__ = _frozen_variant(self.__class__)
+            return self
+
         def __str__(self) -> str:
             d = self.to_dict()
             inner = ', '.join(f'{k}={v}' for k, v in d.items())
@@ -57,221 +256,84 @@ class Schemas:
             return getattr(self, key)
 
     class AutoModSettings(BaseSchema):
-        def __init__(self, guild_id: int | None = None, log_channel: int | None = None,
-                     whitelist: list[int] | None = None) -> None:
-            self.guild_id: int | None = convert_except_none(guild_id, int)
-            self.log_channel: int | None = convert_except_none(log_channel, int)
-            self.whitelist: list[int] | None = convert_except_none(whitelist, list)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.AutoModSettings':
-            if data is None:
-                return cls()
-            guild_id = data.get('guild_id') or data.get('guild')
-            return cls(guild_id, data.get('log_channel'), data.get('whitelist'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({
-                'guild_id': self.guild_id, 'log_channel': self.log_channel,
-                'whitelist': self.whitelist,
-            })
+        guild_id: int | None = Field(int, default=None, aliases=('guild',))
+        log_channel: int | None = Field(int, default=None)
+        whitelist: list[int] | None = Field(list, default=None)
 
     class Currency(BaseSchema):
-        def __init__(self, user_id: str | None = None, wallet: int | None = None,
-                     bank: int | None = None, inventory: dict | None = None) -> None:
-            self.user_id: str | None = convert_except_none(user_id, str)
-            self.wallet: int | None = convert_except_none(wallet, int)
-            self.bank: int | None = convert_except_none(bank, int)
-            self.inventory: dict | None = inventory
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.Currency':
-            # support legacy 'userID' field name
-            if data is None:
-                return cls()
-            user_id = data.get('user_id') or data.get('userID')
-            return cls(user_id, data.get('wallet'), data.get('bank'), data.get('inventory'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({
-                'user_id': self.user_id, 'wallet': self.wallet,
-                'bank': self.bank, 'inventory': self.inventory,
-            })
+        user_id: str | None = Field(str, default=None, aliases=('userID',))
+        wallet: int | None = Field(int, default=None)
+        bank: int | None = Field(int, default=None)
+        # item id → count; old versions left lists behind, see UserProfile.refresh
+        inventory: dict | list | None = Field(default=None)
+        # wallet + bank, kept up to date by utils.transactions for the leaderboard index
+        net_worth: int | None = Field(int, default=None)
+
+    class LedgerEntry(BaseSchema):
+        # One currency change; see utils.ledger
+        user_id: str | None = Field(str, default=None)
+        wallet: int | None = Field(int, default=None)
+        bank: int | None = Field(int, default=None)
+        items: dict | None = Field(default=None)
+        reason: str | None = Field(str, default=None)
+        counterparty: str | None = Field(str, default=None)
+        at: float | None = Field(float, default=None)
+
+    class LedgerSnapshot(BaseSchema):
+        user_id: str | None = Field(str, default=None)
+        wallet: int | None = Field(int, default=None)
+        bank: int | None = Field(int, default=None)
+        inventory: dict | None = Field(default=None)
+        # Ledger entries timestamped before this are included in the totals above
+        through: float | None = Field(float, default=None)
 
     class ScammerList(BaseSchema):
-        def __init__(self, user_id: int | None = None, time: int | None = None,
-                     reason: str | None = None) -> None:
-            self.user_id: int | None = convert_except_none(user_id, int)
-            self.time: int | None = convert_except_none(time, int)
-            self.reason: str | None = convert_except_none(reason, str)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.ScammerList':
-            # support legacy 'user' field name
-            if data is None:
-                return cls()
-            user_id = data.get('user_id') or data.get('user')
-            return cls(user_id, data.get('time'), data.get('reason'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({'user_id': self.user_id, 'time': self.time, 'reason': self.reason})
+        user_id: int | None = Field(int, default=None, aliases=('user',))
+        time: int | None = Field(int, default=None)
+        reason: str | None = Field(str, default=None)
 
     class ServerBans(BaseSchema):
-        def __init__(self, id: int | None = None, name: int | None = None,
-                     owner: int | None = None, reason: str | None = None) -> None:
-            self.id: int | None = convert_except_none(id, int)
-            self.name: int | None = convert_except_none(name, int)
-            self.owner: int | None = convert_except_none(owner, int)
-            self.reason: str | None = convert_except_none(reason, str)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.ServerBans':
-            if data is None:
-                return cls()
-            return cls(data.get('id'), data.get('name'), data.get('owner'), data.get('reason'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({'id': self.id, 'name': self.name, 'owner': self.owner, 'reason': self.reason})
+        id: int | None = Field(int, default=None)
+        name: int | None = Field(int, default=None)
+        owner: int | None = Field(int, default=None)
+        reason: str | None = Field(str, default=None)
 
     class RoleSchema(BaseSchema):
-        def __init__(self, id: int | None = None, delay: int | None = None) -> None:
-            self.id: int | None = convert_except_none(id, int)
-            self.delay: int | None = convert_except_none(delay, int)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.RoleSchema':
-            if data is None:
-                return cls()
-            return cls(data.get('id'), data.get('delay'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({'id': self.id, 'delay': self.delay})
+        id: int | None = Field(int, default=None)
+        delay: int | None = Field(int, default=None)
 
     class AutoRoleSettings(BaseSchema):
-        def __init__(self, guild_id: int | None = None,
-                     roles: list | None = None,
-                     bots_get_roles: bool | None = None) -> None:
-            self.guild_id: int | None = convert_except_none(guild_id, int)
-            self.roles: list | None = roles
-            self.bots_get_roles: bool | None = convert_except_none(bots_get_roles, bool)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.AutoRoleSettings':
-            if data is None:
-                return cls()
-            guild_id = data.get('guild_id') or data.get('guild')
-            # support legacy 'BotsGetRoles' field name
-            bots_get_roles = data.get('bots_get_roles') if data.get('bots_get_roles') is not None else data.get('BotsGetRoles')
-            return cls(guild_id, data.get('roles'), bots_get_roles)
-
-        def to_dict(self) -> dict:
-            return remove_none_values({
-                'guild_id': self.guild_id,
-                'roles': self.roles,
-                'bots_get_roles': self.bots_get_roles,
-            })
+        guild_id: int | None = Field(int, default=None, aliases=('guild',))
+        roles: list | None = Field(default=None)
+        bots_get_roles: bool | None = Field(bool, default=None, aliases=('BotsGetRoles',))
 
     class ExceptionSchema(BaseSchema):
-        def __init__(self, user_id: int | None = None, always_report_errors: bool | None = None) -> None:
-            self.user_id: int | None = convert_except_none(user_id, int)
-            self.always_report_errors: bool | None = convert_except_none(always_report_errors, bool)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.ExceptionSchema':
-            if data is None:
-                return cls()
-            return cls(data.get('user_id'), data.get('always_report_errors'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({'user_id': self.user_id, 'always_report_errors': self.always_report_errors})
+        user_id: int | None = Field(int, default=None)
+        always_report_errors: bool | None = Field(bool, default=None)
 
     class UserConfig(BaseSchema):
-        def __init__(self, user_id: int | None = None, announce_level: int | None = None,
-                     ephemeral_moderation_messages: bool | None = None) -> None:
-            self.user_id: int | None = convert_except_none(user_id, int)
-            self.announce_level: int | None = convert_except_none(announce_level, int)
-            self.ephemeral_moderation_messages: bool | None = convert_except_none(ephemeral_moderation_messages, bool)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.UserConfig':
-            if data is None:
-                return cls()
-            return cls(data.get('user_id'), data.get('announce_level'), data.get('ephemeral_moderation_messages'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({
-                'user_id': self.user_id, 'announce_level': self.announce_level,
-                'ephemeral_moderation_messages': self.ephemeral_moderation_messages,
-            })
+        user_id: int | None = Field(int, default=None)
+        announce_level: int | None = Field(int, default=None)
+        ephemeral_moderation_messages: bool | None = Field(bool, default=None)
 
     class GuildConfig(BaseSchema):
-        def __init__(self, guild_id: int | None = None,
-                     ephemeral_moderation_messages: bool | None = None,
-                     ephemeral_setting_overpowers_user_setting: bool | None = None) -> None:
-            self.guild_id: int | None = convert_except_none(guild_id, int)
-            self.ephemeral_moderation_messages: bool | None = convert_except_none(ephemeral_moderation_messages, bool)
-            self.ephemeral_setting_overpowers_user_setting: bool | None = convert_except_none(
-                ephemeral_setting_overpowers_user_setting, bool)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.GuildConfig':
-            if data is None:
-                return cls()
-            return cls(data.get('guild_id'), data.get('ephemeral_moderation_messages'),
-                       data.get('ephemeral_setting_overpowers_user_setting'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({
-                'guild_id': self.guild_id,
-                'ephemeral_moderation_messages': self.ephemeral_moderation_messages,
-                'ephemeral_setting_overpowers_user_setting': self.ephemeral_setting_overpowers_user_setting,
-            })
+        guild_id: int | None = Field(int, default=None)
+        ephemeral_moderation_messages: bool | None = Field(bool, default=None)
+        ephemeral_setting_overpowers_user_setting: bool | None = Field(bool, default=None)
 
     class WarnSchema(BaseSchema):
-        def __init__(self, user_id: int | None = None, guild_id: int | None = None,
-                     warns: list[dict] | None = None) -> None:
-            self.user_id: int | None = convert_except_none(user_id, int)
-            self.guild_id: int | None = convert_except_none(guild_id, int)
-            self.warns: list[dict] | None = warns
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.WarnSchema':
-            if data is None:
-                return cls()
-            return cls(data.get('user_id'), data.get('guild_id'), data.get('warns'))
-
-        def to_dict(self) -> dict:
-            return remove_none_values({'user_id': self.user_id, 'guild_id': self.guild_id, 'warns': self.warns})
+        user_id: int | None = Field(int, default=None)
+        guild_id: int | None = Field(int, default=None)
+        warns: list[dict] | None = Field(default=None)
 
     class MusicQueue(BaseSchema):
-        def __init__(self, guild_id: int | None = None, voice_channel_id: int | None = None,
-                     text_channel_id: int | None = None, current: dict | None = None,
-                     queue: list | None = None, loop_mode: str | None = None,
-                     volume: float | None = None) -> None:
-            self.guild_id: int | None = convert_except_none(guild_id, int)
-            self.voice_channel_id: int | None = convert_except_none(voice_channel_id, int)
-            self.text_channel_id: int | None = convert_except_none(text_channel_id, int)
-            self.current: dict | None = current
-            self.queue: list = queue if queue is not None else []
-            self.loop_mode: str | None = convert_except_none(loop_mode, str)
-            self.volume: float | None = convert_except_none(volume, float)
-
-        @classmethod
-        def from_dict(cls, data: dict | None) -> 'Schemas.MusicQueue':
-            if data is None:
-                return cls()
-            return cls(data.get('guild_id'), data.get('voice_channel_id'), data.get('text_channel_id'),
-                       data.get('current'), data.get('queue', []), data.get('loop_mode'), data.get('volume'))
-
-        def to_dict(self) -> dict:
-            d = remove_none_values({
-                'guild_id': self.guild_id, 'voice_channel_id': self.voice_channel_id,
-                'text_channel_id': self.text_channel_id, 'current': self.current,
-                'loop_mode': self.loop_mode, 'volume': self.volume,
-            })
-            d['queue'] = self.queue
-            return d
-
+        guild_id: int | None = Field(int, default=None)
+        voice_channel_id: int | None = Field(int, default=None)
+        text_channel_id: int | None = Field(int, default=None)
+        current: dict | None = Field(default=None)
+        queue: list = Field(default_factory=list)
+        loop_mode: str | None = Field(str, default=None)
+        volume: float | None = Field(float, default=None)
 
 T = TypeVar('T', bound=Schemas.BaseSchema)
 
@@ -282,115 +344,815 @@ class Collection[T: Schemas.BaseSchema]:
     """Typed async wrapper around a pymongo collection with an O(1) pk cache.
 
     All methods accept and return schema objects — raw dicts never leave this class.
+    The cache keeps each document's decoded schema, frozen. Reads hand out a
+    `copy()` of it, so callers can mutate and `save` what they get without touching
+    the cache; callers that only read can pass `readonly=True` to get the cached
+    instance itself and skip the copy.
+    Misses on simple pk lookups are cached too (for `negative_ttl` seconds), since
+    most guilds never create most settings documents.
+
+    `primary_key` may be a tuple of fields for compound keys. Methods still take
+    the first field's value positionally and the others as keyword filters, e.g.
+    `warnings.get(user_id, guild_id=guild_id)`; a lookup naming exactly the key
+    fields is cached under the tuple of values. `get_many` takes those tuples.
+
+    With `write_behind` set (in seconds), `save` only updates the cache and buffers
+    the document; saves to the same key within that window are coalesced and
+    written together in one `bulk_write`. Reads see buffered documents, and
+    `update`/`delete` flush the buffer first so their effects are ordered after it,
+    as do `query_one`/`query_many` and filtered `get`s, which go to the database.
+    It is off by default; only collections that can afford to lose the last few
+    seconds of writes on a crash should turn it on.
     """
 
-    def __init__(self, collection: Any, primary_key: str,
+    def __init__(self, collection: Any, primary_key: str | tuple[str, ...],
                  schema_class: type[T],
                  cache_ttl: int = 300,
-                 legacy_pk: str | None = None) -> None:
+                 negative_ttl: int = 60,
+                 legacy_pk: str | None = None,
+                 write_behind: float | None = None,
+                 count_ttl: float = 10) -> None:
         self.collection = collection
-        self._pk = primary_key
+        self._pk_fields: tuple[str, ...] = (primary_key,) if isinstance(primary_key, str) else tuple(primary_key)
+        self._pk = self._pk_fields[0]
+        if legacy_pk is not None and len(self._pk_fields) > 1:
+            raise ValueError('legacy_pk is only supported for single-field primary keys')
         self._legacy_pk = legacy_pk
         self._schema: type[T] = schema_class
-        self.cache: Cache = Cache(primary_key, ttl=cache_ttl)
+        self.cache: Cache = Cache(primary_key, ttl=cache_ttl, negative_ttl=negative_ttl,
+                                  decode=self._frozen_from_doc)
+        # Internal state is keyed like the cache: the pk value, or a tuple of values
+        # for compound keys.
+        # Keys whose document is known to use the new primary key field
+        self._migrated: set[Any] = set()
+        # key → shared fetch for concurrent get() misses on that key
+        self._inflight: dict[Any, asyncio.Future] = {}
+        self._generation = 0
+        # key → update()/update_if() calls on it still waiting for the server, and
+        # keys where such calls overlapped (their results may arrive out of order)
+        self._updating: dict[Any, int] = {}
+        self._contended: set[Any] = set()
+        # count() results: filter → (time counted, count); cleared by every write
+        self.count_ttl = count_ttl
+        self._counts: dict[str, tuple[float, int]] = {}
+
+        self._write_behind = write_behind
+        # key → latest unflushed document for that key
+        self._pending: dict[Any, dict] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        self._buffered_writes = 0
+        self._flushed_writes = 0
+        self._flushes = 0
+        self._flush_seconds = 0.0
+        self._last_flush_seconds = 0.0
+
+    @property
+    def legacy_pk(self) -> str | None:
+        return self._legacy_pk
+
+    @property
+    def write_behind(self) -> float | None:
+        return self._write_behind
+
+    def disable_legacy_pk(self) -> None:
+        """Stop falling back to `legacy_pk` once no document uses it any more."""
+        if self._legacy_pk is not None:
+            logging.info(f'{self.collection.name}: legacy {self._legacy_pk!r} lookups disabled')
+        self._legacy_pk = None
+        self._migrated.clear()
 
     def _from_doc(self, doc: dict) -> T:
-        return cast(T, self._schema.from_dict(doc))
-
-    async def get(self, pk_value: Any, **extra_filters: Any) -> T | None:
-        """Return the schema for this primary key, or None if not found."""
-        query = {self._pk: pk_value, **extra_filters}
+        return self._schema.from_dict(doc)
+
+    def _frozen_from_doc(self, doc: dict) -> T:
+        return self._from_doc(doc).freeze()
+
+    def _partial_from_doc(self, doc: dict, fields: frozenset[str]) -> T:
+        obj = self._from_doc(doc)
+        obj._projection = fields
+        return obj
+
+    def _projection(self, fields: Iterable[str]) -> tuple[frozenset[str], dict]:
+        """(field set, Mongo projection) for a partial read; key fields are always included.
+        The projection names every document field the wanted fields are read from,
+        aliases included, so documents still using legacy names decode the same."""
+        wanted = frozenset(fields).union(self._pk_fields)
+        stored_as = self._schema._stored_as
+        projection = dict.fromkeys((name for field in wanted for name in stored_as.get(field, (field,))), 1)
+        if self._legacy_pk:
+            projection[self._legacy_pk] = 1
+        return wanted, {**projection, '_id': 0}
+
+    def _query(self, key: Any) -> dict:
+        """The {field: value} filter selecting the document with this cache key."""
+        if len(self._pk_fields) == 1:
+            return {self._pk: key}
+        return dict(zip(self._pk_fields, key, strict=True))
+
+    def _exact_key(self, query: dict) -> Any:
+        """The cache key if `query` names exactly the primary key fields, else None."""
+        return self.cache.key_of(query) if len(query) == len(self._pk_fields) else None
+
+    def _forget(self, query: dict) -> None:
+        """Drop whatever the cache holds for documents a write to `query` may have hit."""
+        if self.cache.key_of(query) is None:
+            # Only part of a compound key: any cached document could match
+            self.cache.clear()
+        else:
+            self.cache.remove(query)
 
-        # Only use the cache for simple pk-only lookups
-        if not extra_filters:
-            cached = self.cache.get_one(query)
-            if cached is not None:
-                return self._from_doc(cached)
+    @overload
+    @staticmethod
+    def _hand_out(obj: T, readonly: bool) -> T: ...
 
-        doc = await self.collection.find_one(query)
+    @overload
+    @staticmethod
+    def _hand_out(obj: None, readonly: bool) -> None: ...
 
-        if doc is None and self._legacy_pk and not extra_filters:
-            doc = await self.collection.find_one({self._legacy_pk: pk_value})
+    @staticmethod
+    def _hand_out(obj: T | None, readonly: bool) -> T | None:
+        if obj is None or readonly:
+            return obj
+        return obj.copy()
+
+    async def get(self, pk_value: Any, readonly: bool = False, fields: Iterable[str] | None = None,
+                  **extra_filters: Any) -> T | None:
+        """Return the schema for this primary key, or None if not found.
+
+        With `readonly=True` the result may be the frozen instance shared with the
+        cache: attribute assignment raises, and nested lists/dicts must not be modified.
+
+        With `fields`, a cache miss fetches only those fields and returns a partial
+        schema (`is_partial`) that is never cached and can't be saved. Cache hits
+        still return the full cached document.
+        """
+        query = {self._pk: pk_value, **extra_filters}
 
+        # Only use the cache for lookups on exactly the primary key
+        key = self._exact_key(query)
+        if key is None:
+            if fields is not None:
+                return await self.query_one(query, fields=fields)
+            if self._pending:
+                await self.flush()
+            doc = await self.collection.find_one(query)
+            return self._from_doc(doc) if doc is not None else None
+
+        if fields is not None:
+            return await self._get_partial(key, query, fields, readonly)
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            return self._hand_out(self._frozen_from_doc(pending), readonly)
+
+        hit, cached = self.cache.lookup_decoded(query)
+        if hit:
+            if cached is not None and self.cache.refresh_due(query):
+                self._start_fetch(key)  # refresh-ahead, nobody waits on it
+            return self._hand_out(cached, readonly)
+
+        stale = self.cache.lookup_stale(query)
+        fetch = self._start_fetch(key)
+        if stale is not None:
+            # Stale-while-revalidate: the fetch refills the cache in the background
+            return self._hand_out(stale, readonly)
+
+        # shield() keeps one cancelled caller from cancelling the shared fetch
+        try:
+            obj = await asyncio.shield(fetch)
+        except ConnectionFailure as e:
+            stale = self.cache.lookup_stale(query, on_error=True)
+            if stale is None:
+                raise
+            logging.warning(f'{self.collection.name}: database unreachable, serving stale {query}: {e}')
+            return self._hand_out(stale, readonly)
+        return self._hand_out(obj, readonly)
+
+    async def _get_partial(self, key: Any, query: dict, fields: Iterable[str], readonly: bool) -> T | None:
+        pending = self._pending.get(key)
+        if pending is not None:
+            return self._hand_out(self._frozen_from_doc(pending), readonly)
+        hit, cached = self.cache.lookup_decoded(query)
+        if hit:
+            return self._hand_out(cached, readonly)
+
+        wanted, projection = self._projection(fields)
+        generation = self._generation
+        doc = await self.collection.find_one(query, projection)
+        if doc is None and self._legacy_pk:
+            doc = await self.collection.find_one({self._legacy_pk: key}, projection)
         if doc is None:
+            # Absence holds for the whole document, so that much can be cached
+            if generation == self._generation:
+                self.cache.add_absent(query)
             return None
-        if not extra_filters:
-            self.cache.add(doc)
-        return self._from_doc(doc)
+        return self._partial_from_doc(doc, wanted)
+
+    def _start_fetch(self, key: Any) -> asyncio.Future:
+        """Concurrent fetches for the same key share a single database read."""
+        fetch = self._inflight.get(key)
+        if fetch is None:
+            fetch = asyncio.ensure_future(self._fetch(key, self._generation))
+            self._inflight[key] = fetch
+            fetch.add_done_callback(functools.partial(self._fetch_done, key))
+        return fetch
+
+    async def _fetch(self, key: Any, generation: int) -> T | None:
+        query = self._query(key)
+        doc = await self.collection.find_one(query)
+
+        if doc is not None:
+            if self._legacy_pk:
+                self._migrated.add(key)
+        elif self._legacy_pk:
+            doc = await self.collection.find_one({self._legacy_pk: key})
+
+        obj = self._frozen_from_doc(doc) if doc is not None else None
+        # A save/delete that landed while we were waiting makes this result stale
+        if generation == self._generation:
+            if doc is None:
+                self.cache.add_absent(query)
+            else:
+                self.cache.add(doc, obj)
+        return obj
+
+    def _fetch_done(self, key: Any, fetch: asyncio.Future) -> None:
+        if self._inflight.get(key) is fetch:
+            del self._inflight[key]
+        # Errors are delivered to every waiter; mark them retrieved in case
+        # every waiter was cancelled before the fetch finished.
+        if not fetch.cancelled():
+            fetch.exception()
+
+    def apply_external(self, doc: dict) -> None:
+        """Take in a document changed by another process, if this one caches its key."""
+        key = self.cache.key_of(doc)
+        if key is None or key in self._pending:
+            return  # a legacy document, or our own buffered save is newer
+        if self.cache.refresh(doc):
+            self._invalidate_reads(key)
+
+    def apply_external_delete(self, doc_key: dict) -> None:
+        """Forget a document another process deleted, given the change event's
+        `documentKey`: its `_id`, plus the shard key on sharded collections. Falls
+        back to the primary key when the cache doesn't know the document's `_id`."""
+        key = self.cache.remove_id(doc_key.get('_id'))
+        if key is None:
+            key = self.cache.key_of(doc_key)
+            if key is None:
+                return
+            self.cache.remove(doc_key)
+        self._invalidate_reads(key)
+
+    async def revalidate(self, chunk_size: int = 500) -> None:
+        """Refetch every cached key and take in whatever changed since it was
+        cached. The fallback for servers without change streams."""
+        keys = [key for key in self.cache.keys() if key not in self._pending]
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            generation = self._generation
+            found = await self._find_keys(chunk)
+            if generation != self._generation:
+                continue  # a write landed meanwhile; check again next time
+            for key in chunk:
+                doc = found.get(key)
+                if doc is not None:
+                    self.apply_external(doc)
+                elif key not in self._pending:
+                    self.cache.add_absent(self._query(key))
+
+    def _invalidate_reads(self, key: Any) -> None:
+        """Call after a write lands: reads still in flight may have seen the old
+        document, so they must not fill the cache or be joined by new callers."""
+        self._generation += 1
+        self._counts.clear()
+        if key is None:
+            self._inflight.clear()
+        else:
+            self._inflight.pop(key, None)
+
+    async def get_many(self, pk_values: Iterable[Any], chunk_size: int = 1000,
+                       readonly: bool = False, fields: Iterable[str] | None = None) -> dict[Any, T]:
+        """Return {pk: schema} for every key that exists. Keys not found are omitted.
+
+        Cached and known-absent keys are answered locally; the rest are fetched with
+        one `$in` query per `chunk_size` keys (plus one on `legacy_pk` for leftovers).
+        Compound keys are passed as tuples and fetched with `$or` instead.
+        `readonly` and `fields` work as in `get`.
+        """
+        results: dict[Any, T] = {}
+        missing: list[Any] = []
+        for pk_value in dict.fromkeys(pk_values):
+            pending = self._pending.get(pk_value)
+            if pending is not None:
+                results[pk_value] = self._hand_out(self._frozen_from_doc(pending), readonly)
+                continue
+            hit, cached = self.cache.lookup_decoded(self._query(pk_value))
+            if not hit:
+                missing.append(pk_value)
+            elif cached is not None:
+                results[pk_value] = self._hand_out(cached, readonly)
+
+        wanted, projection = self._projection(fields) if fields is not None else (None, None)
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            generation = self._generation
+            found = await self._find_keys(chunk, projection)
+            if self._legacy_pk:
+                self._migrated.update(found)
+
+            leftover = [v for v in chunk if v not in found]
+            if leftover and self._legacy_pk:
+                found.update(await self._find_in(self._legacy_pk, leftover, projection))
+
+            fill_cache = generation == self._generation
+            for pk_value in chunk:
+                doc = found.get(pk_value)
+                if doc is None:
+                    if fill_cache:
+                        self.cache.add_absent(self._query(pk_value))
+                    continue
+                if wanted is not None:
+                    results[pk_value] = self._partial_from_doc(doc, wanted)
+                    continue
+                if not fill_cache:
+                    results[pk_value] = self._from_doc(doc)
+                    continue
+                obj = self._frozen_from_doc(doc)
+                self.cache.add(doc, obj)
+                results[pk_value] = self._hand_out(obj, readonly)
+        return results
+
+    async def _find_keys(self, keys: list[Any], projection: dict | None = None) -> dict[Any, dict]:
+        if len(self._pk_fields) == 1:
+            return await self._find_in(self._pk, keys, projection)
+        cursor = self.collection.find({'$or': [self._query(key) for key in keys]}, projection)
+        docs = await cursor.to_list(length=None)
+        return {key: doc for doc in docs if (key := self.cache.key_of(doc)) is not None}
+
+    async def _find_in(self, field: str, values: list[Any], projection: dict | None = None) -> dict[Any, dict]:
+        cursor = self.collection.find({field: {'$in': values}}, projection)
+        docs = await cursor.to_list(length=None)
+        return {doc[field]: doc for doc in docs if doc.get(field) is not None}
 
     async def all(self, limit: int = 1000) -> list[T]:
-        """Return all documents in the collection as schema objects."""
+        """Return all documents in the collection as schema objects, at most
+        `limit` of them; use `iter` to go through more."""
         cursor = self.collection.find({})
         if limit:
             cursor = cursor.limit(limit)
         docs = await cursor.to_list(length=limit)
-        self.cache.add_many(docs)
-        return [self._from_doc(d) for d in docs]
+        self._warn_if_truncated(docs, limit)
+        results = []
+        for doc in docs:
+            obj = self._frozen_from_doc(doc)
+            self.cache.add(doc, obj)
+            results.append(obj.copy())
+        return results
+
+    async def iter(self, filter: dict | None = None, batch_size: int = 500,
+                   fill_cache: bool = True, fields: Iterable[str] | None = None) -> AsyncIterator[T]:
+        """Stream every matching document as a schema, `batch_size` documents per
+        round-trip, decoding each batch only as it is reached. Unlike `all` and
+        `query_many` there is no limit.
+
+        Pass `fill_cache=False` for bulk scans, so they don't push hot entries out
+        of the cache. With `fields`, only those fields are fetched and partial
+        schemas are yielded (never cached). Documents with an unflushed write-behind
+        save are yielded as saved.
+        """
+        wanted, projection = self._projection(fields) if fields is not None else (None, None)
+        cursor = self.collection.find(filter or {}, projection, batch_size=batch_size)
+        while True:
+            generation = self._generation
+            docs = await cursor.to_list(length=batch_size)
+            if not docs:
+                return
+            # A write during the round-trip may have made part of this batch stale
+            cacheable = fill_cache and wanted is None and generation == self._generation
+            for doc in docs:
+                pending = self._pending.get(self.cache.key_of(doc))
+                if pending is not None:
+                    yield self._frozen_from_doc(pending).copy()
+                    continue
+                if wanted is not None:
+                    yield self._partial_from_doc(doc, wanted)
+                    continue
+                if not cacheable:
+                    yield self._from_doc(doc)
+                    continue
+                obj = self._frozen_from_doc(doc)
+                self.cache.add(doc, obj)
+                yield obj.copy()
 
     async def save(self, schema: T) -> None:
-        """Upsert by primary key. Migrates legacy field names on first write."""
-        doc = schema.to_dict()
-        pk_val = doc.get(self._pk)
-
-        existing_id = None
-        existing = await self.collection.find_one({self._pk: pk_val})
-        if existing is None and self._legacy_pk:
-            existing = await self.collection.find_one({self._legacy_pk: pk_val})
-        if existing is not None:
-            existing_id = existing['_id']
-
-        if existing_id is not None:
-            await self.collection.replace_one({'_id': existing_id}, doc)
+        """Upsert by primary key. Migrates legacy field names on first write.
+
+        Keys known to be stored under the new primary key (seen by a read or an
+        earlier save) take a single atomic upsert. Others first try a plain replace
+        on the new key and only look for a legacy document if that matched nothing.
+        """
+        if schema.is_partial:
+            raise ValueError(f'Refusing to save a partial {type(schema).__name__} '
+                             '(read with fields=...), it would drop the other fields')
+        # The cache keeps its own copy so later mutations of `schema` can't leak into it
+        stored = schema.copy().freeze()
+        doc = stored.to_dict()
+        pk_val = self.cache.key_of(doc)
+        if pk_val is None and len(self._pk_fields) > 1:
+            raise ValueError(f'{type(schema).__name__} needs {", ".join(self._pk_fields)} set to be saved')
+
+        if self._write_behind is not None:
+            self._buffer(pk_val, doc, stored)
+            return
+
+        if self._legacy_pk and pk_val not in self._migrated:
+            result = await self.collection.replace_one(self._query(pk_val), doc)
+            if result.matched_count == 0:
+                legacy = await self.collection.find_one({self._legacy_pk: pk_val})
+                if legacy is not None:
+                    await self.collection.replace_one({'_id': legacy['_id']}, doc)
+                else:
+                    await self._upsert(pk_val, doc)
+        else:
+            await self._upsert(pk_val, doc)
+        if self._legacy_pk:
+            self._migrated.add(pk_val)
+
+        self._invalidate_reads(pk_val)
+        self.cache.add(doc, stored)
+
+    async def _upsert(self, pk_val: Any, doc: dict) -> None:
+        try:
+            await self.collection.replace_one(self._query(pk_val), doc, upsert=True)
+        except DuplicateKeyError:
+            # Two upserts raced to insert the same key and the unique index rejected
+            # the loser; the document exists now, so retrying replaces it instead.
+            await self.collection.replace_one(self._query(pk_val), doc, upsert=True)
+
+    def _buffer(self, pk_val: Any, doc: dict, stored: T) -> None:
+        self._pending[pk_val] = doc
+        self._buffered_writes += 1
+        self._invalidate_reads(pk_val)
+        self.cache.add(doc, stored)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(cast(float, self._write_behind))
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f'{self.collection.name}: write-behind flush failed, retrying: {e}')
+            if self._pending and self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Write every buffered document in one unordered `bulk_write`."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            t0 = time.perf_counter()
+            try:
+                await self._migrate_legacy_keys(list(pending))
+                await self.collection.bulk_write(
+                    [ReplaceOne(self._query(pk_val), doc, upsert=True) for pk_val, doc in pending.items()],
+                    ordered=False)
+            except BaseException:
+                # Keep anything not superseded by a newer save for the next attempt
+                self._pending = {**pending, **self._pending}
+                raise
+
+            elapsed = time.perf_counter() - t0
+            self._flushes += 1
+            self._flushed_writes += len(pending)
+            self._flush_seconds += elapsed
+            self._last_flush_seconds = elapsed
+
+    def write_stats(self) -> dict:
+        """Write-behind counters: how many saves were coalesced and how long flushes take."""
+        return {
+            "pending": len(self._pending),
+            "buffered_writes": self._buffered_writes,
+            "flushed_writes": self._flushed_writes,
+            "coalescing_ratio": self._buffered_writes / self._flushed_writes if self._flushed_writes else 0.0,
+            "flushes": self._flushes,
+            "avg_flush_ms": self._flush_seconds / self._flushes * 1000 if self._flushes else 0.0,
+            "last_flush_ms": self._last_flush_seconds * 1000,
+        }
+
+    async def update(self, pk_value: Any, *, inc: dict | None = None, set: dict | None = None,
+                     push: dict | None = None, pull: dict | None = None,
+                     return_document: bool = False, session: Any = None, **extra_filters: Any) -> T | None:
+        """Atomically apply field-level changes with one `update_one(upsert=True)`.
+
+        Unlike `save`, this never reads the document first, so concurrent updates
+        can't overwrite each other. Returns the updated schema (one
+        `find_one_and_update` instead) if `return_document` is set, otherwise None.
+        `session` is passed on to pymongo, e.g. to run inside a transaction.
+        """
+        update = self._update_spec(inc, set, push, pull)
+        query = {self._pk: pk_value, **extra_filters}
+        key = await self._prepare_update(query)
+        options = {'session': session} if session is not None else {}
+
+        doc = None
+        self._begin_update(key)
+        try:
+            if return_document:
+                doc = await self.collection.find_one_and_update(
+                    query, update, upsert=True, return_document=ReturnDocument.AFTER, **options)
+            else:
+                await self.collection.update_one(query, update, upsert=True, **options)
+        finally:
+            contended = self._end_update(key)
+        return self._updated(query, key, update, doc, contended)
+
+    async def update_if(self, pk_value: Any, condition: dict, *, inc: dict | None = None,
+                        set: dict | None = None, push: dict | None = None, pull: dict | None = None,
+                        session: Any = None, **extra_filters: Any) -> T | None:
+        """Like `update`, but only applied if the document also matches the filter
+        `condition` (e.g. `{'wallet': {'$gte': 50}}`). The server checks and applies
+        it in one `find_one_and_update`, so nothing can change in between.
+
+        Returns the updated schema, or None if the document doesn't exist or
+        doesn't match; nothing is upserted.
+        """
+        update = self._update_spec(inc, set, push, pull)
+        query = {self._pk: pk_value, **extra_filters}
+        key = await self._prepare_update(query)
+        options = {'session': session} if session is not None else {}
+
+        self._begin_update(key)
+        try:
+            doc = await self.collection.find_one_and_update(
+                {**query, **condition}, update, return_document=ReturnDocument.AFTER, **options)
+        finally:
+            contended = self._end_update(key)
+        if doc is None:
+            # Most likely the cached copy is behind whatever made the condition fail
+            if key is not None and key not in self._pending:
+                self.forget(pk_value, **extra_filters)
+            return None
+        return self._updated(query, key, update, doc, contended)
+
+    async def inc_many(self, changes: dict[Any, dict[str, int]]) -> None:
+        """`update(key, inc=...)` for many keys at once, {key: {field: delta}}, sent
+        as one unordered `bulk_write` of upserts however many keys there are.
+        Cached copies take the change like they do for `update`."""
+        changes = {key: inc for key, inc in changes.items() if inc}
+        if not changes:
+            return
+        if self._write_behind is not None:
+            await self.flush()
+        await self._migrate_legacy_keys(list(changes))
+
+        for key in changes:
+            self._begin_update(key)
+        try:
+            await self.collection.bulk_write(
+                [UpdateOne(self._query(key), {'$inc': inc}, upsert=True) for key, inc in changes.items()],
+                ordered=False)
+        except BaseException:
+            # Some of the updates may have landed
+            for key in changes:
+                self._invalidate_reads(key)
+                self._forget(self._query(key))
+            raise
+        finally:
+            contended = {key for key in changes if self._end_update(key)}
+        for key, inc in changes.items():
+            self._updated(self._query(key), key, {'$inc': inc}, None, key in contended)
+
+    @staticmethod
+    def _update_spec(inc: dict | None, set: dict | None, push: dict | None, pull: dict | None) -> dict:
+        update = {op: fields for op, fields in
+                  (('$inc', inc), ('$set', set), ('$push', push), ('$pull', pull)) if fields}
+        if not update:
+            raise ValueError('update() needs at least one of inc, set, push or pull')
+        return update
+
+    async def _prepare_update(self, query: dict) -> Any:
+        """Order a partial update after buffered saves and legacy key migration.
+        Returns the cache key if `query` is an exact key lookup."""
+        key = self._exact_key(query)
+        if self._write_behind is not None:
+            await self.flush()
+        if key is not None:
+            await self._migrate_legacy_key(key)
+        return key
+
+    def _begin_update(self, key: Any) -> None:
+        if key is None:
+            return
+        if key in self._updating:
+            self._contended.add(key)
+        self._updating[key] = self._updating.get(key, 0) + 1
+
+    def _end_update(self, key: Any) -> bool:
+        """Returns whether another update of the same key overlapped this one."""
+        if key is None:
+            return False
+        contended = key in self._contended
+        self._updating[key] -= 1
+        if not self._updating[key]:
+            del self._updating[key]
+            self._contended.discard(key)
+        return contended
+
+    def _updated(self, query: dict, key: Any, update: dict, doc: dict | None,
+                 contended: bool = False) -> T | None:
+        """Bring the cache in line with an update that landed; `doc` is the updated
+        document if the server returned it."""
+        obj = self._frozen_from_doc(doc) if doc is not None else None
+        self._invalidate_reads(self.cache.key_of(query))
+        if key is None or contended:
+            # Not an exact key lookup, so the cached doc may or may not be the one
+            # changed; or other updates of the key overlapped this one, and the
+            # server may have applied them in either order.
+            self._forget(query)
+        elif obj is not None:
+            self.cache.add(cast(dict, doc), obj)
+        elif self.cache.get_one(query) is not None:
+            self.cache.update(query, update)
         else:
-            await self.collection.insert_one(doc)
+            # Drops a "known absent" marker: the upsert may just have created the doc
+            self.cache.remove(query)
+        return self._hand_out(obj, readonly=False)
+
+    def forget(self, pk_value: Any, **extra_filters: Any) -> None:
+        """Drop whatever is cached for this key, so the next read goes to the
+        database. For writes the cache can't follow, like an aborted transaction."""
+        query = {self._pk: pk_value, **extra_filters}
+        self._invalidate_reads(self.cache.key_of(query))
+        self._forget(query)
 
-        self.cache.add(doc)
+    async def _migrate_legacy_key(self, pk_val: Any) -> None:
+        """Move a legacy document onto the new primary key before a partial update,
+        so the upsert modifies it instead of inserting a second document."""
+        if not self._legacy_pk or pk_val in self._migrated:
+            return
+        try:
+            await self.collection.update_one(
+                {self._legacy_pk: pk_val, self._pk: {'$exists': False}},
+                {'$set': {self._pk: pk_val}, '$unset': {self._legacy_pk: ''}})
+        except DuplicateKeyError:
+            pass  # a document under the new key already exists and wins
+        self._migrated.add(pk_val)
+
+    async def _migrate_legacy_keys(self, pk_vals: list[Any]) -> None:
+        """`_migrate_legacy_key` for many keys, in one `bulk_write`."""
+        if not self._legacy_pk:
+            return
+        pk_vals = [pk_val for pk_val in pk_vals if pk_val not in self._migrated]
+        if not pk_vals:
+            return
+        try:
+            await self.collection.bulk_write(
+                [UpdateOne({self._legacy_pk: pk_val, self._pk: {'$exists': False}},
+                           {'$set': {self._pk: pk_val}, '$unset': {self._legacy_pk: ''}}) for pk_val in pk_vals],
+                ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys mean a document under the new key already exists and wins
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+        self._migrated.update(pk_vals)
 
     async def delete(self, pk_value: Any, **extra_filters: Any) -> None:
         """Delete by primary key."""
         query = {self._pk: pk_value, **extra_filters}
+        if self._write_behind is not None:
+            await self.flush()
         result = await self.collection.delete_one(query)
         if result.deleted_count == 0 and self._legacy_pk and not extra_filters:
             await self.collection.delete_one({self._legacy_pk: pk_value})
-        self.cache.remove({self._pk: pk_value})
+        key = self.cache.key_of(query)
+        self._migrated.discard(key)
+        self._invalidate_reads(key)
+        self._forget(query)
 
     async def exists(self, pk_value: Any, **extra_filters: Any) -> bool:
         return await self.get(pk_value, **extra_filters) is not None
 
-    async def count(self, **filters: Any) -> int:
-        return await self.collection.count_documents(filters)
-
-    async def query_one(self, filter_dict: dict) -> T | None:
-        """Escape hatch for complex queries. Returns a schema object."""
-        doc = await self.collection.find_one(filter_dict)
-        if doc is None:
-            return None
-        return self._from_doc(doc)
-
-    async def query_many(self, filter_dict: dict, limit: int = 1000) -> list[T]:
-        """Escape hatch for complex queries. Returns a list of schema objects."""
-        cursor = self.collection.find(filter_dict)
+    async def count(self, *, estimated: bool = False, **filters: Any) -> int:
+        """Number of documents matching `filters`.
+
+        Results are cached for `count_ttl` seconds; any write through this
+        Collection drops them. `estimated=True` reads the count from collection
+        metadata instead of scanning, which is cheap but can be off after an
+        unclean shutdown, and can't be filtered.
+        """
+        if estimated and filters:
+            raise ValueError('estimated counts cannot be filtered')
+        cache_key = 'estimated' if estimated else repr(sorted(filters.items()))
+        cached = self._counts.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < self.count_ttl:
+            return cached[1]
+
+        if self._pending:
+            await self.flush()  # so buffered inserts are counted
+        generation = self._generation
+        if estimated:
+            count = await self.collection.estimated_document_count()
+        else:
+            count = await self.collection.count_documents(filters)
+        if generation == self._generation:
+            self._counts[cache_key] = (time.monotonic(), count)
+        return count
+
+    async def query_one(self, filter_dict: dict, fields: Iterable[str] | None = None) -> T | None:
+        """Escape hatch for complex queries. Returns a schema object (partial with `fields`)."""
+        if self._pending:
+            await self.flush()
+        if fields is None:
+            doc = await self.collection.find_one(filter_dict)
+            return self._from_doc(doc) if doc is not None else None
+        wanted, projection = self._projection(fields)
+        doc = await self.collection.find_one(filter_dict, projection)
+        return self._partial_from_doc(doc, wanted) if doc is not None else None
+
+    async def query_many(self, filter_dict: dict, limit: int = 1000,
+                         fields: Iterable[str] | None = None, sort: list[tuple[str, int]] | None = None,
+                         skip: int = 0) -> list[T]:
+        """Escape hatch for complex queries. Returns a list of at most `limit`
+        schema objects (partial with `fields`); use `iter` to go through more.
+        With `sort` (pymongo style), that's the first `limit` after skipping `skip`,
+        which the server can read straight off a matching index."""
+        if self._pending:
+            await self.flush()
+        options: dict[str, Any] = {}
+        if sort:
+            options['sort'] = sort
+        if skip:
+            options['skip'] = skip
+        wanted, projection = self._projection(fields) if fields is not None else (None, None)
+        cursor = self.collection.find(filter_dict, projection, **options)
         if limit:
             cursor = cursor.limit(limit)
         docs = await cursor.to_list(length=limit)
-        return [self._from_doc(d) for d in docs]
+        if not sort:
+            # A sorted query asks for the top `limit`, being cut off there is the point
+            self._warn_if_truncated(docs, limit)
+        if wanted is None:
+            return [self._from_doc(d) for d in docs]
+        return [self._partial_from_doc(d, wanted) for d in docs]
+
+    def _warn_if_truncated(self, docs: list, limit: int) -> None:
+        if limit and len(docs) >= limit:
+            logging.warning(f'{self.collection.name}: result cut off at {limit} documents, use iter() to read them all')
 
 
 # ── Database ──────────────────────────────────────────────────────────────────
 
 class Database:
-    def __init__(self, dbstring: str) -> None:
+    # Used for any cache option config.json doesn't set
+    DEFAULT_CACHE_OPTIONS: dict[str, float | None] = {
+        'count_ttl': 10,
+        'stale_ttl': 30,
+        'stale_if_error': 600,
+        'refresh_ahead': 0.8,
+    }
+
+    def __init__(self, dbstring: str, cache_options: dict[str, dict[str, float | None]] | None = None,
+                 slow_query_ms: float = 100, watch_changes: bool = False, watch_poll_interval: float = 30,
+                 storage: str = 'mongodb', storage_path: str | None = None) -> None:
+        """`cache_options` maps a collection name (or 'default') to its cache
+        options; see Config.cache_options. Commands slower than `slow_query_ms`
+        are logged. With `watch_changes`, writes made by other processes are
+        applied to the caches (see ChangeWatcher). `storage` is 'mongodb'
+        (`dbstring`), or 'sqlite' (at `storage_path`) / 'memory' for an
+        embedded store; see utils.local_storage."""
         self.dbstring = dbstring
+        self.storage = storage
+        self.storage_path = storage_path
+        self.cache_options = cache_options or {}
+        self.query_metrics = QueryMetrics(slow_query_ms)
+        self.watch_changes = watch_changes
+        self.watch_poll_interval = watch_poll_interval
+        self.change_watcher: ChangeWatcher | None = None
+        # Multi-document transactions need a replica set or a sharded cluster
+        self.supports_transactions = False
         self.connected = False
         self._cleanup_task: asyncio.Task | None = None
+        self._migration_task: asyncio.Task | None = None
+        self._watch_task: asyncio.Task | None = None
+        # Names of the migrations that have finished, and who to tell when one does
+        self.finished_migrations: set[str] = set()
+        self.migration_listeners: list[Callable[[Migration], None]] = []
 
     async def connect(self) -> None:
         if self.connected:
             return
 
         logging.info('Connecting to database.')
-        self.client: AsyncMongoClient = AsyncMongoClient(
-            self.dbstring, serverSelectionTimeoutMS=5000)
+        if self.storage == 'mongodb':
+            self.client: AsyncMongoClient | LocalClient = AsyncMongoClient(
+                self.dbstring, serverSelectionTimeoutMS=5000, event_listeners=[self.query_metrics])
+        else:
+            self.client = LocalClient(self.storage, self.storage_path)
 
         try:
             await self.client.server_info()
@@ -400,6 +1162,9 @@ class Database:
 
         logging.info('Connected to database.')
         self.connected = True
+        if self.storage == 'mongodb':
+            topology = cast(AsyncMongoClient, self.client).topology_description.topology_type_name
+            self.supports_transactions = topology in ('ReplicaSetWithPrimary', 'Sharded', 'LoadBalanced')
 
         db = self.client.data
 
@@ -420,19 +1185,78 @@ class Database:
         self.guild_config: Collection[Schemas.GuildConfig] = Collection(
             db.guild_config, 'guild_id', Schemas.GuildConfig)
         self.warnings: Collection[Schemas.WarnSchema] = Collection(
-            db.warnings, 'user_id', Schemas.WarnSchema)
+            db.warnings, ('user_id', 'guild_id'), Schemas.WarnSchema)
         self.music_queues: Collection[Schemas.MusicQueue] = Collection(
-            db.music_queues, 'guild_id', Schemas.MusicQueue)
+            db.music_queues, 'guild_id', Schemas.MusicQueue, write_behind=2.0)
+        self.ledger_snapshots: Collection[Schemas.LedgerSnapshot] = Collection(
+            db.ledger_snapshots, 'user_id', Schemas.LedgerSnapshot)
+        # Append-only and never looked up by key, so not cached; see utils.ledger
+        self.ledger_entries = db.ledger
 
         self.collections: list[Collection] = [
             self.automodsettings,
             self.currency, self.scammer_list, self.serverbans,
             self.autorolesettings, self.exceptions, self.user_config,
             self.guild_config, self.warnings, self.music_queues,
+            self.ledger_snapshots,
         ]
+        self.apply_cache_options()
 
         await self._ensure_indexes(db)
         self._cleanup_task = asyncio.create_task(self._cache_cleanup_loop())
+        self._migration_task = asyncio.create_task(MigrationRunner(db).run(self._migration_complete))
+        if self.watch_changes and self.storage == 'mongodb':
+            self.change_watcher = ChangeWatcher(db, self.collections, self.watch_poll_interval)
+            self._watch_task = asyncio.create_task(self.change_watcher.run())
+
+    def apply_cache_options(self) -> None:
+        default = {**self.DEFAULT_CACHE_OPTIONS, **self.cache_options.get('default', {})}
+        for col in self.collections:
+            options = {**default, **self.cache_options.get(col.collection.name, {})}
+            # 0 or empty means unbounded, like a missing value; config values may be floats
+            max_entries, max_bytes = options.get('max_entries'), options.get('max_bytes')
+            col.cache.set_limits(int(max_entries) if max_entries else None, int(max_bytes) if max_bytes else None)
+            col.cache.set_staleness(options.get('stale_ttl') or 0, options.get('stale_if_error') or 0,
+                                    options.get('refresh_ahead'))
+            col.count_ttl = options.get('count_ttl') or 0
+
+    async def warm_up(self, guild_ids: list[int], chunk_size: int = 500) -> dict[str, int]:
+        """Preload the guild-scoped settings of these guilds into the cache, so the
+        first events after a restart don't all miss at once. Guilds without a
+        document are cached as absent. Returns documents found per collection."""
+        t0 = time.perf_counter()
+        collections = [self.automodsettings, self.autorolesettings, self.guild_config, self.serverbans]
+        found = await asyncio.gather(*(
+            col.get_many(guild_ids, chunk_size=chunk_size, readonly=True) for col in collections))
+        counts = {col.collection.name: len(docs) for col, docs in zip(collections, found, strict=True)}
+        logging.info(f'Cache warm-up for {len(guild_ids)} guilds took {(time.perf_counter() - t0) * 1000:.0f} ms: '
+                     + ', '.join(f'{name} {n}' for name, n in counts.items()))
+        return counts
+
+    def metrics(self) -> dict:
+        """Snapshot of query latency, cache and write-behind counters, JSON-serializable."""
+        return {
+            'queries': self.query_metrics.stats(),
+            'collections': {
+                col.collection.name: {
+                    'cache': col.cache.stats(),
+                    **({'write_behind': col.write_stats()} if col.write_behind is not None else {}),
+                }
+                for col in getattr(self, 'collections', [])
+            },
+            **({'change_watcher': {'mode': 'polling' if self.change_watcher.polling else 'change_stream',
+                                   'events': self.change_watcher.events}}
+               if self.change_watcher is not None else {}),
+        }
+
+    def _migration_complete(self, migration: Migration) -> None:
+        for col in self.collections:
+            if (isinstance(migration, FieldMigration) and col.collection.name == migration.collection
+                    and col.legacy_pk == migration.legacy_field):
+                col.disable_legacy_pk()
+        self.finished_migrations.add(migration.name)
+        for listener in self.migration_listeners:
+            listener(migration)
 
     @staticmethod
     async def _create_index(collection: Any, keys: Any, **options: Any) -> None:
@@ -459,11 +1283,38 @@ class Database:
         await self._create_index(db.autorolesettings, 'guild_id', unique=True, sparse=True)
         await self._create_index(db.guild_config, 'guild_id', unique=True, sparse=True)
         await self._create_index(db.currency, 'user_id', unique=True, sparse=True)
+        await self._create_index(db.currency, [('net_worth', DESCENDING)])
         await self._create_index(db.scammer_list, 'user_id', unique=True, sparse=True)
         await self._create_index(db.user_config, 'user_id', unique=True, sparse=True)
         await self._create_index(db.exceptions, 'user_id', unique=True, sparse=True)
-        await self._create_index(db.warnings, [('user_id', ASCENDING), ('guild_id', ASCENDING)])
+        warnings_key = [('user_id', ASCENDING), ('guild_id', ASCENDING)]
+        try:
+            await self._create_index(db.warnings, warnings_key, unique=True)
+        except OperationFailure as e:
+            if e.code != 11000:
+                raise
+            # Older versions could write several documents per (user, guild)
+            logging.warning('warnings has duplicate (user_id, guild_id) documents, '
+                            'keeping a non-unique index until they are merged')
+            await self._create_index(db.warnings, warnings_key)
         await self._create_index(db.music_queues, 'guild_id', unique=True, sparse=True)
+        await self._create_index(db.ledger_snapshots, 'user_id', unique=True, sparse=True)
+        await self._create_index(db.ledger, [('user_id', ASCENDING), ('at', ASCENDING)])
+        await self._create_index(db.ledger, 'at')
+
+    async def close(self) -> None:
+        """Flush buffered writes, stop background tasks and close the client."""
+        if not self.connected:
+            return
+        for task in filter(None, [self._cleanup_task, self._migration_task, self._watch_task]):
+            task.cancel()
+        for col in self.collections:
+            try:
+                await col.flush()
+            except Exception as e:
+                logging.error(f'Failed to flush {col.collection.name} on shutdown: {e}')
+        await self.client.close()
+        self.connected = False
 
     async def _cache_cleanup_loop(self) -> None:
         while True:
@@ -9,8 +9,12 @@ import discord
 from discord.ext import commands
 
 import utils.types as types
+from utils.activity import RecentActivity
 from utils.config import Config
-from utils.database import Database, Schemas
+from utils.database import Database
+from utils.leaderboard import Leaderboard
+from utils.ledger import Ledger
+from utils.transactions import Transactions
 
 
 def get_prefix(bot: 'KidneyBot', message: discord.Message) -> list[str]:
@@ -31,35 +35,49 @@ class KidneyBot(commands.Bot):
         )
         KidneyBot.instance = self
 
-        self.database: Database = Database(self.config.dbstring)
+        self.database: Database = Database(self.config.dbstring, self.config.cache_options,
+                                            self.config.slow_query_ms, self.config.watch_changes,
+                                            self.config.watch_poll_interval, self.config.storage,
+                                            self.config.storage_path)
+        self.leaderboard: Leaderboard = Leaderboard(self.database)
+        self.ledger: Ledger = Ledger(self.database)
+        self.transactions: Transactions = Transactions(self.database, self.leaderboard, self.ledger)
+        self.recent_activity: RecentActivity = RecentActivity()
 
     async def setup_hook(self):
+        # Runs after login but before the gateway connects, so nothing is dispatched yet
+        if self.database.connected:
+            try:
+                guild_ids = [guild.id async for guild in self.fetch_guilds(limit=None)]
+                await self.database.warm_up(guild_ids)
+            except Exception as e:
+                logging.warning(f'Cache warm-up failed, continuing with a cold cache: {e}')
+            try:
+                await self.leaderboard.rebuild()
+            except Exception as e:
+                logging.warning(f'Leaderboard rebuild failed, it will be retried on first use: {e}')
+            self.ledger.start()
         await self.tree.sync()
 
+    async def close(self):
+        # Cogs are unloaded first, so whatever they write on the way out is recorded too
+        await super().close()
+        self.recent_activity.stop()
+        await self.ledger.close()
 
-    async def add_currency(self, user: types.AnyUser, value: int, location: str) -> None:
-        """Add currency to a user's wallet or bank."""
-        doc = await self.database.currency.get(str(user.id))
-        if doc is not None:
-            if location == 'wallet':
-                doc.wallet = (doc.wallet or 0) + value
-            elif location == 'bank':
-                doc.bank = (doc.bank or 0) + value
-            await self.database.currency.save(doc)
-        else:
-            wallet, bank = (0, 0)
-            if location == 'wallet':
-                wallet = value
-            elif location == 'bank':
-                bank = value
-            await self.database.currency.save(Schemas.Currency(
-                user_id=str(user.id), wallet=wallet, bank=bank))
+    async def add_currency(self, user: types.AnyUser, value: int, location: str, reason: str | None = None) -> None:
+        """Add currency to a user's wallet or bank. Unconditional; use
+        `self.transactions` for changes that must not overdraw."""
+        if location not in ('wallet', 'bank'):
+            raise ValueError(f"location must be 'wallet' or 'bank', got: {location}")
+        wallet, bank = (value, 0) if location == 'wallet' else (0, value)
+        await self.transactions.credit(str(user.id), wallet=wallet, bank=bank, reason=reason)
 
     async def log(self, guild: discord.Guild, actiontype: str, action: str, reason: str | None, user: types.AnyUser,
                   target: types.AnyUser | None = None, message: discord.Message | None = None,
                   color: discord.Color | None = None) -> discord.Message | None:
         """Log an action to the configured log channel for a guild."""
-        doc = await self.database.automodsettings.get(guild.id)
+        doc = await self.database.automodsettings.get(guild.id, readonly=True)
         if doc is None or doc.log_channel is None:
             return None
 
@@ -0,0 +1,150 @@
+# Economy leaderboard
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import bisect
+import logging
+from collections.abc import Iterable
+
+from pymongo import DESCENDING
+
+from utils.database import Database, Schemas
+from utils.migrations import Migration
+
+# Ranking entry: (-net_worth, user_id), so ascending order is richest first
+_Entry = tuple[int, str]
+
+# Fills in net_worth on documents written before it was stored
+NET_WORTH_MIGRATION = 'currency.net_worth'
+
+
+class Leaderboard:
+    """The richest users by net worth (wallet + bank), kept in memory.
+
+    Holds up to `size` users. `rebuild` loads them with one query on the
+    `net_worth` index, and from then on `record` (called by Transactions for
+    every currency write) keeps the list current without touching the database.
+
+    Users outside the list are only known to be worth at most `_floor`, which
+    rises to the worth of whoever is pushed off the end. A listed user that drops
+    below it leaves the list, since whoever should take their place is unknown;
+    if that thins the list out to under half of `size`, the next read rebuilds it.
+    Pages the list covers are slices of it; pages past it, and guild pages it
+    can't fill, are read off the index with skip/limit. Nothing is sorted beyond
+    the users on the page.
+
+    Until the net_worth migration has finished, documents without the field are
+    missing from the index, so the list is never taken to be complete; it is
+    rebuilt once the migration is done.
+    """
+
+    def __init__(self, database: Database, size: int = 1000) -> None:
+        self.database = database
+        self.size = size
+        self._entries: list[_Entry] = []
+        self._worth: dict[str, int] = {}
+        # Nothing is known about anyone until the first rebuild
+        self._floor: float = float('inf')
+        # Writes recorded while a rebuild's query is out, applied on top of its result
+        self._replay: dict[str, int | None] | None = None
+        self._lock = asyncio.Lock()
+        self._rebuild_task: asyncio.Task | None = None
+        database.migration_listeners.append(self._migration_complete)
+
+    @property
+    def complete(self) -> bool:
+        """Whether every user is in the list."""
+        return self._floor == float('-inf')
+
+    def _migration_complete(self, migration: Migration) -> None:
+        if migration.name == NET_WORTH_MIGRATION:
+            self._rebuild_task = asyncio.create_task(self._rebuild_after_migration())
+
+    async def _rebuild_after_migration(self) -> None:
+        try:
+            await self.rebuild()
+        except Exception as e:
+            logging.warning(f'Leaderboard rebuild after the net_worth migration failed, '
+                            f'it will be retried on first use: {e}')
+
+    def record(self, user_id: str, net_worth: int) -> None:
+        """Take in a user's new net worth."""
+        if self._replay is not None:
+            self._replay[user_id] = net_worth
+        self._apply(user_id, net_worth)
+
+    def discard(self, user_id: str) -> None:
+        """Forget a user whose currency document was deleted."""
+        if self._replay is not None:
+            self._replay[user_id] = None
+        self._apply(user_id, None)
+
+    def _apply(self, user_id: str, net_worth: int | None) -> None:
+        old = self._worth.pop(user_id, None)
+        if old is not None:
+            del self._entries[bisect.bisect_left(self._entries, (-old, user_id))]
+        if net_worth is None or net_worth < self._floor:
+            return
+        bisect.insort(self._entries, (-net_worth, user_id))
+        self._worth[user_id] = net_worth
+        if len(self._entries) > self.size:
+            worth, dropped = self._entries.pop()
+            del self._worth[dropped]
+            self._floor = max(self._floor, -worth)
+
+    async def rebuild(self) -> None:
+        """Reload the top `size` users from the `net_worth` index."""
+        async with self._lock:
+            currency = self.database.currency
+            self._replay = {}
+            try:
+                await currency.flush()
+                docs = await currency.query_many({}, limit=self.size, fields=('net_worth',),
+                                                  sort=[('net_worth', DESCENDING)])
+                # Documents written before net_worth existed sort last until the
+                # migration or their next write brings them in.
+                self._entries = sorted((-doc.net_worth, doc.user_id) for doc in docs
+                                       if doc.net_worth is not None and doc.user_id is not None)
+                self._worth = {user_id: -worth for worth, user_id in self._entries}
+                if len(docs) < self.size and NET_WORTH_MIGRATION in self.database.finished_migrations:
+                    self._floor = float('-inf')
+                else:
+                    self._floor = -self._entries[-1][0] if self._entries else float('inf')
+                replay = self._replay
+            finally:
+                self._replay = None
+            for user_id, net_worth in replay.items():
+                self._apply(user_id, net_worth)
+        logging.info(f'Leaderboard rebuilt with {len(self._entries)} users')
+
+    async def _ensure_loaded(self) -> None:
+        if not self.complete and len(self._entries) < self.size // 2:
+            await self.rebuild()
+
+    async def page(self, page: int, per_page: int = 10) -> list[tuple[str, int]]:
+        """(user_id, net_worth) of the users ranked `page * per_page + 1` onwards."""
+        await self._ensure_loaded()
+        start = page * per_page
+        if self.complete or start + per_page <= len(self._entries):
+            return [(user_id, -worth) for worth, user_id in self._entries[start:start + per_page]]
+        return self._ranked(await self.database.currency.query_many(
+            {}, limit=per_page, fields=('net_worth',), sort=[('net_worth', DESCENDING)], skip=start))
+
+    async def guild_page(self, member_ids: Iterable[int | str], page: int,
+                         per_page: int = 10) -> list[tuple[str, int]]:
+        """Like `page`, counting only the given users (a guild's members)."""
+        await self._ensure_loaded()
+        members = {str(member_id) for member_id in member_ids}
+        start = page * per_page
+        ranked = [(user_id, -worth) for worth, user_id in self._entries if user_id in members]
+        if self.complete or start + per_page <= len(ranked) or len(ranked) == len(members):
+            return ranked[start:start + per_page]
+        # Sorts only the guild's members, via the user_id index
+        return self._ranked(await self.database.currency.query_many(
+            {'user_id': {'$in': list(members)}}, limit=per_page, fields=('net_worth',),
+            sort=[('net_worth', DESCENDING)], skip=start))
+
+    @staticmethod
+    def _ranked(docs: list[Schemas.Currency]) -> list[tuple[str, int]]:
+        return [(doc.user_id, doc.net_worth or 0) for doc in docs if doc.user_id is not None]
@@ -0,0 +1,200 @@
+# Append-only currency ledger
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+import time
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from utils.database import Database, Schemas
+
+
+class Ledger:
+    """Append-only history of every currency change.
+
+    Transactions records each change it makes as an entry: the user, the wallet,
+    bank and item deltas, a reason and the time. Entries are buffered and written
+    together with one `insert_many`, `flush_interval` seconds after the first one
+    or as soon as `batch_size` are waiting.
+
+    `balance` derives a user's balances from the ledger alone: their snapshot in
+    `ledger_snapshots` plus the entries since. `compact` (run every
+    `compact_interval` seconds once `start`ed) folds entries older than `keep`
+    seconds into the snapshots and deletes them, which keeps that tail short.
+
+    Commands keep reading balances from the currency document, the cached
+    result of the same changes, which is also what charges are checked against.
+    The ledger is there to audit and replay it. Its history starts when it was
+    introduced, so a balance held from before then shows up as a constant
+    difference between the two.
+
+    The ledger is best-effort: an entry is queued after its change has been
+    written, outside any transaction that wrote it, and sits in memory until the
+    next flush. A process that dies in between loses those entries while the
+    balances keep the changes, which then also shows up as a difference between
+    `balance` and the currency document. Failed flushes are retried.
+    """
+
+    def __init__(self, database: Database, batch_size: int = 500, flush_interval: float = 1.0,
+                 keep: float = 7 * 24 * 3600, compact_interval: float = 3600) -> None:
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keep = keep
+        self.compact_interval = compact_interval
+        self._pending: list[dict] = []
+        self._flush_task: asyncio.Task | None = None
+        # Started when a full batch is waiting, without waiting for `_flush_task`
+        self._batch_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        # Set after a failed flush: some of the entries it gave back may be stored already
+        self._unsure = False
+        self._compact_lock = asyncio.Lock()
+        self._compact_task: asyncio.Task | None = None
+
+    def record(self, user_id: str, *, wallet: int = 0, bank: int = 0, items: dict[str, int] | None = None,
+               reason: str | None = None, counterparty: str | None = None) -> None:
+        """Queue an entry for a change that was just written. It is stored by the
+        next flush, not before this returns."""
+        items = {item: n for item, n in (items or {}).items() if n}
+        if not (wallet or bank or items):
+            return
+        entry = Schemas.LedgerEntry(user_id=user_id, wallet=wallet or None, bank=bank or None,
+                                    items=items or None, reason=reason, counterparty=counterparty,
+                                    at=time.time()).to_dict()
+        # Assigned here so a retried insert_many can tell which entries made it
+        entry['_id'] = ObjectId()
+        self._pending.append(entry)
+        if len(self._pending) >= self.batch_size and (self._batch_task is None or self._batch_task.done()):
+            self._batch_task = asyncio.create_task(self._flush_now())
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self._flush_now()
+
+    async def _flush_now(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f'Ledger flush failed, retrying: {e}')
+            if self._pending and self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def flush(self) -> None:
+        """Write every buffered entry in one `insert_many`."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            try:
+                if self._unsure:
+                    stored = {doc['_id'] async for doc in self.database.ledger_entries.find(
+                        {'_id': {'$in': [entry['_id'] for entry in pending]}}, {'_id': 1})}
+                    pending = [entry for entry in pending if entry['_id'] not in stored]
+                if pending:
+                    await self.database.ledger_entries.insert_many(pending, ordered=False)
+            except BaseException:
+                self._pending = pending + self._pending
+                self._unsure = True
+                raise
+            self._unsure = False
+
+    async def balance(self, user_id: str) -> Schemas.LedgerSnapshot:
+        """The user's balances per the ledger: their snapshot plus every entry
+        since, buffered ones included."""
+        async with self._compact_lock, self._flush_lock:
+            snapshot = await self.database.ledger_snapshots.get(user_id)
+            if snapshot is None:
+                snapshot = Schemas.LedgerSnapshot(user_id=user_id)
+            tail = await self.database.ledger_entries.find(
+                {'user_id': user_id, 'at': {'$gte': snapshot.through or 0}}).to_list(None)
+            tail += [entry for entry in self._pending if entry['user_id'] == user_id]
+        for entry in tail:
+            _fold(snapshot, Schemas.LedgerEntry.from_dict(entry))
+        return snapshot
+
+    async def compact(self, chunk_size: int = 500) -> int:
+        """Fold entries older than `keep` seconds into the users' snapshots and
+        delete them. Returns how many entries were folded."""
+        async with self._compact_lock:
+            await self.flush()
+            cutoff = time.time() - self.keep
+            entries = self.database.ledger_entries
+            users = await entries.distinct('user_id', {'at': {'$lt': cutoff}})
+            folded = 0
+            for i in range(0, len(users), chunk_size):
+                chunk = users[i:i + chunk_size]
+                snapshots = await self.database.ledger_snapshots.get_many(chunk, readonly=True)
+                changes: dict[str, Schemas.LedgerSnapshot] = {user_id: Schemas.LedgerSnapshot(user_id=user_id)
+                                                              for user_id in chunk}
+                async for doc in entries.find({'user_id': {'$in': chunk}, 'at': {'$lt': cutoff}}):
+                    entry = Schemas.LedgerEntry.from_dict(doc)
+                    if entry.user_id is None:
+                        continue
+                    snapshot = snapshots.get(entry.user_id)
+                    if snapshot is not None and (entry.at or 0) < (snapshot.through or 0):
+                        continue  # folded by a compaction that died before deleting it
+                    _fold(changes[entry.user_id], entry)
+                    folded += 1
+                done = [user_id for user_id in chunk
+                        if await self._fold_into_snapshot(changes[user_id], snapshots.get(user_id), cutoff)]
+                await entries.delete_many({'user_id': {'$in': done}, 'at': {'$lt': cutoff}})
+        if folded:
+            logging.info(f'Ledger compaction folded {folded} entries for {len(users)} users')
+        return folded
+
+    async def _fold_into_snapshot(self, change: Schemas.LedgerSnapshot, snapshot: Schemas.LedgerSnapshot | None,
+                                  cutoff: float) -> bool:
+        """Add `change` to the stored snapshot and move its `through` up to `cutoff`,
+        unless another compaction got there first. Returns whether it was applied."""
+        snapshots = self.database.ledger_snapshots
+        inc = {field: n for field, n in (('wallet', change.wallet), ('bank', change.bank)) if n}
+        inc.update({f'inventory.{item}': n for item, n in (change.inventory or {}).items() if n})
+        if snapshot is not None:
+            return await snapshots.update_if(change.user_id, {'through': snapshot.through}, inc=inc or None,
+                                             set={'through': cutoff}) is not None
+        try:
+            await snapshots.update(change.user_id, inc=inc or None, set={'through': cutoff},
+                                   through={'$exists': False})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def start(self) -> None:
+        """Run `compact` every `compact_interval` seconds in the background."""
+        if self._compact_task is None:
+            self._compact_task = asyncio.create_task(self._compact_loop())
+
+    async def _compact_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logging.error(f'Ledger compaction failed: {e}')
+
+    async def close(self) -> None:
+        """Stop compacting and write out buffered entries."""
+        for task in filter(None, [self._compact_task, self._flush_task, self._batch_task]):
+            task.cancel()
+        self._compact_task = self._flush_task = self._batch_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f'Failed to flush the ledger on shutdown, {len(self._pending)} entries lost: {e}')
+
+
+def _fold(snapshot: Schemas.LedgerSnapshot, entry: Schemas.LedgerEntry) -> None:
+    """Add an entry's changes to a snapshot, in place."""
+    snapshot.wallet = (snapshot.wallet or 0) + (entry.wallet or 0)
+    snapshot.bank = (snapshot.bank or 0) + (entry.bank or 0)
+    inventory = snapshot.inventory if snapshot.inventory is not None else {}
+    for item, n in (entry.items or {}).items():
+        inventory[item] = inventory.get(item, 0) + n
+    snapshot.inventory = inventory
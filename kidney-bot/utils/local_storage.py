@@ -0,0 +1,827 @@
+# Embedded storage backends
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import sqlite3
+from collections.abc import Iterable, Iterator
+from typing import Any
+
+from bson import ObjectId, json_util
+from bson.json_util import RELAXED_JSON_OPTIONS
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+BACKENDS = ('mongodb', 'sqlite', 'memory')
+
+# Server error codes the local backends raise, matching MongoDB's
+BAD_VALUE = 2
+TYPE_MISMATCH = 14
+INDEX_NOT_FOUND = 27
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+_MISSING = object()
+
+
+# ── Query language ────────────────────────────────────────────────────────────
+# The subset of MongoDB's query and update language that Collection and the
+# cogs use. Anything else raises OperationFailure like an unknown operator would.
+
+def _copy(value: Any) -> Any:
+    if type(value) is list:
+        return [_copy(v) for v in value]
+    if type(value) is dict:
+        return {k: _copy(v) for k, v in value.items()}
+    return value
+
+
+def _values(value: Any, path: list[str]) -> list[Any]:
+    """Every value `path` reaches, descending into arrays of subdocuments like
+    MongoDB does ('warns.id' reaches the id of every warn)."""
+    if not path:
+        return [value]
+    if isinstance(value, dict):
+        return _values(value.get(path[0], _MISSING), path[1:]) if path[0] in value else [_MISSING]
+    if isinstance(value, list):
+        if path[0].isdigit():
+            index = int(path[0])
+            return _values(value[index], path[1:]) if index < len(value) else [_MISSING]
+        return [v for item in value if isinstance(item, dict) for v in _values(item, path)] or [_MISSING]
+    return [_MISSING]
+
+
+def _equals(value: Any, expected: Any) -> bool:
+    if value is _MISSING:
+        return expected is None
+    if type(value) is bool or type(expected) is bool:
+        # True == 1 in Python, but not in MongoDB
+        if type(value) is type(expected):
+            return value == expected
+    elif value == expected:
+        return True
+    return isinstance(value, list) and any(_equals(v, expected) for v in value if not isinstance(v, list))
+
+
+def _compare(value: Any, expected: Any, op: str) -> bool:
+    candidates = value if isinstance(value, list) else [value]
+    for v in candidates:
+        if v is _MISSING or v is None or expected is None:
+            continue
+        try:
+            if ((op == '$gt' and v > expected) or (op == '$gte' and v >= expected)
+                    or (op == '$lt' and v < expected) or (op == '$lte' and v <= expected)):
+                return True
+        except TypeError:
+            continue  # MongoDB only compares values of the same type
+    return False
+
+
+def _match_operator(values: list[Any], op: str, arg: Any) -> bool:
+    if op == '$eq':
+        return any(_equals(v, arg) for v in values)
+    if op == '$ne':
+        return not any(_equals(v, arg) for v in values)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        return any(_compare(v, arg, op) for v in values)
+    if op == '$in':
+        return any(_equals(v, a) for v in values for a in arg)
+    if op == '$nin':
+        return not any(_equals(v, a) for v in values for a in arg)
+    if op == '$exists':
+        return any(v is not _MISSING for v in values) == bool(arg)
+    if op == '$size':
+        return any(isinstance(v, list) and len(v) == arg for v in values)
+    if op == '$elemMatch':
+        return any(isinstance(v, list) and any(
+            matches(item, arg) if isinstance(item, dict) else _match_condition([item], arg) for item in v)
+            for v in values)
+    if op == '$not':
+        return not _match_condition(values, arg)
+    raise OperationFailure(f'unknown operator: {op}', code=BAD_VALUE)
+
+
+def _match_condition(values: list[Any], condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        return all(_match_operator(values, op, arg) for op, arg in condition.items())
+    return any(_equals(v, condition) for v in values)
+
+
+def matches(doc: dict, filter: dict | None) -> bool:
+    """Whether `doc` matches the MongoDB query `filter`."""
+    for key, condition in (filter or {}).items():
+        if key == '$or':
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, sub) for sub in condition):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure(f'unknown top level operator: {key}', code=BAD_VALUE)
+        elif not _match_condition(_values(doc, key.split('.')), condition):
+            return False
+    return True
+
+
+def _equalities(filter: dict) -> dict[str, Any]:
+    """The top-level `field: value` conditions of a filter: what an upsert seeds
+    the new document with, and what the backends can answer from an index."""
+    fields = {}
+    for key, condition in filter.items():
+        if key.startswith('$'):
+            continue
+        if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+            if '$eq' in condition:
+                fields[key] = condition['$eq']
+        else:
+            fields[key] = condition
+    return fields
+
+
+def _parent(doc: dict, path: list[str], create: bool) -> dict | None:
+    for part in path[:-1]:
+        child = doc.get(part)
+        if not isinstance(child, dict):
+            if not create or child is not None:
+                return None
+            child = doc[part] = {}
+        doc = child
+    return doc
+
+
+def _set_path(doc: dict, path: str, value: Any) -> None:
+    parts = path.split('.')
+    parent = _parent(doc, parts, create=True)
+    if parent is None:
+        raise OperationFailure(f'Cannot create field {parts[-1]!r} in {path!r}', code=BAD_VALUE)
+    parent[parts[-1]] = value
+
+
+def _get_path(doc: dict, path: str) -> Any:
+    parts = path.split('.')
+    parent = _parent(doc, parts, create=False)
+    return _MISSING if parent is None else parent.get(parts[-1], _MISSING)
+
+
+def _array_at(doc: dict, path: str, op: str) -> list:
+    current = _get_path(doc, path)
+    if current is _MISSING or current is None:
+        current = []
+        _set_path(doc, path, current)
+    elif not isinstance(current, list):
+        raise OperationFailure(f'{op} requires an array at {path!r}', code=BAD_VALUE)
+    return current
+
+
+def apply_update(doc: dict, update: dict, inserting: bool = False) -> None:
+    """Apply a MongoDB update document to `doc` in place."""
+    if not update or not all(op.startswith('$') for op in update):
+        raise ValueError('update only works with $ operators')
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            if op == '$set':
+                _set_path(doc, path, _copy(arg))
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set_path(doc, path, _copy(arg))
+            elif op == '$unset':
+                parts = path.split('.')
+                parent = _parent(doc, parts, create=False)
+                if parent is not None:
+                    parent.pop(parts[-1], None)
+            elif op in ('$inc', '$mul'):
+                current = _get_path(doc, path)
+                if current is _MISSING:
+                    current = 0
+                if not isinstance(current, (int, float)) or isinstance(current, bool):
+                    raise OperationFailure(f'Cannot apply {op} to a value of non-numeric type at {path!r}',
+                                           code=TYPE_MISMATCH)
+                _set_path(doc, path, current + arg if op == '$inc' else current * arg)
+            elif op in ('$min', '$max'):
+                current = _get_path(doc, path)
+                if current is _MISSING or (arg < current if op == '$min' else arg > current):
+                    _set_path(doc, path, arg)
+            elif op in ('$push', '$addToSet'):
+                items = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                array = _array_at(doc, path, op)
+                for item in items:
+                    if op == '$push' or item not in array:
+                        array.append(_copy(item))
+            elif op == '$pull':
+                array = _get_path(doc, path)
+                if isinstance(array, list):
+                    array[:] = [item for item in array if not (
+                        matches(item, arg) if isinstance(item, dict) and isinstance(arg, dict)
+                        else _match_condition([item], arg))]
+            else:
+                raise OperationFailure(f'Unknown modifier: {op}', code=BAD_VALUE)
+
+
+def project(doc: dict, projection: dict | list | None) -> dict:
+    if not projection:
+        return doc
+    if isinstance(projection, list):
+        projection = dict.fromkeys(projection, 1)
+    include = {field.split('.')[0] for field, on in projection.items() if on and field != '_id'}
+    if include:
+        keep_id = projection.get('_id', 1)
+        return {k: v for k, v in doc.items() if k in include or (k == '_id' and keep_id)}
+    return {k: v for k, v in doc.items() if projection.get(k, 1)}
+
+
+def _sort_key(value: Any) -> tuple[Any, ...]:
+    # MongoDB's cross-type order, for the types documents here hold
+    if value is _MISSING or value is None:
+        return (0,)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, str(value))
+
+
+def _index_keys(keys: str | Iterable[tuple[str, int]]) -> list[tuple[str, int]]:
+    return [(keys, 1)] if isinstance(keys, str) else [(field, direction) for field, direction in keys]
+
+
+def _duplicate(name: str, index: str, key: dict) -> DuplicateKeyError:
+    return DuplicateKeyError(f'E11000 duplicate key error collection: {name} index: {index} dup key: {key}',
+                             code=11000)
+
+
+# ── Collections ───────────────────────────────────────────────────────────────
+
+class LocalCursor:
+    """Async cursor over a query result. Like pymongo's, it is lazy: the query
+    runs on the first read, and `to_list` can be called repeatedly to page."""
+
+    def __init__(self, run: Any, sort: list | None = None, limit: int = 0, skip: int = 0) -> None:
+        self._run = run
+        self._sort = sort
+        self._limit = limit
+        self._skip = skip
+        self._docs: Iterator[dict] | None = None
+
+    def sort(self, key: str | list, direction: int = 1) -> 'LocalCursor':
+        self._sort = _index_keys(key) if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def limit(self, limit: int) -> 'LocalCursor':
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int) -> 'LocalCursor':
+        self._skip = skip
+        return self
+
+    def _iter(self) -> Iterator[dict]:
+        if self._docs is None:
+            docs: Iterable[dict[str, Any]] = self._run()
+            if self._sort:
+                docs = list(docs)
+                for field, direction in reversed(self._sort):
+                    docs.sort(key=lambda d: _sort_key(_values(d, field.split('.'))[0]), reverse=direction < 0)
+            docs = list(docs)[self._skip:]
+            if self._limit:
+                docs = docs[:self._limit]
+            self._docs = iter(docs)
+        return self._docs
+
+    async def to_list(self, length: int | None = None) -> list[dict]:
+        docs = self._iter()
+        if length is None:
+            return list(docs)
+        return [doc for _, doc in zip(range(length), docs, strict=False)]
+
+    def __aiter__(self) -> 'LocalCursor':
+        return self
+
+    async def __anext__(self) -> dict:
+        try:
+            return next(self._iter())
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self) -> None:
+        self._docs = iter(())
+
+
+class LocalCollection:
+    """The part of pymongo's AsyncCollection API that Collection, the migrations
+    and the index setup use, over an embedded store. Subclasses provide storage;
+    queries are matched here, with equality on indexed fields answered from the
+    store's indexes."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._indexes: dict[str, dict] = {'_id_': {'key': [('_id', 1)], 'unique': True, 'sparse': False}}
+
+    # ── storage (subclasses) ──────────────────────────────────────────────────
+
+    def _candidates(self, filter: dict) -> Iterable[dict]:
+        """Stored documents that may match `filter` (a superset); not copies."""
+        raise NotImplementedError
+
+    def _store(self, doc: dict, old: dict | None) -> None:
+        """Insert `doc`, or replace `old` (same `_id`) with it."""
+        raise NotImplementedError
+
+    def _remove(self, doc: dict) -> None:
+        raise NotImplementedError
+
+    def _size(self) -> int:
+        raise NotImplementedError
+
+    def _index_added(self, name: str, key: list[tuple[str, int]]) -> None:
+        pass
+
+    def _index_dropped(self, name: str, key: list[tuple[str, int]]) -> None:
+        pass
+
+    def _commit(self) -> None:
+        pass
+
+    # ── queries ───────────────────────────────────────────────────────────────
+
+    def _matching(self, filter: dict | None) -> Iterator[dict[str, Any]]:
+        filter = filter or {}
+        return (doc for doc in list(self._candidates(filter)) if matches(doc, filter))
+
+    def _first(self, filter: dict | None, sort: list | None = None) -> dict | None:
+        if sort:
+            return next(LocalCursor(lambda: self._matching(filter), _index_keys(sort), limit=1)._iter(), None)
+        return next(self._matching(filter), None)
+
+    async def find_one(self, filter: dict | None = None, projection: dict | list | None = None,
+                       *, sort: list | None = None, **kwargs: Any) -> dict | None:
+        doc = self._first(filter, sort)
+        return None if doc is None else project(_copy(doc), projection)
+
+    def find(self, filter: dict | None = None, projection: dict | list | None = None, *,
+             sort: list | None = None, limit: int = 0, skip: int = 0, **kwargs: Any) -> LocalCursor:
+        def run() -> Iterator[dict]:
+            return (project(_copy(doc), projection) for doc in self._matching(filter))
+        return LocalCursor(run, _index_keys(sort) if sort else None, limit, skip)
+
+    async def count_documents(self, filter: dict, **kwargs: Any) -> int:
+        if not filter:
+            return self._size()
+        return sum(1 for _ in self._matching(filter))
+
+    async def estimated_document_count(self, **kwargs: Any) -> int:
+        return self._size()
+
+    async def distinct(self, key: str, filter: dict | None = None, **kwargs: Any) -> list:
+        seen: list = []
+        for doc in self._matching(filter):
+            for value in _values(doc, key.split('.')):
+                for v in (value if isinstance(value, list) else [value]):
+                    if v is not _MISSING and v not in seen:
+                        seen.append(v)
+        return seen
+
+    # ── writes ────────────────────────────────────────────────────────────────
+
+    def _check_unique(self, doc: dict, old: dict | None) -> None:
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            key = {field: _get_path(doc, field) for field, _ in index['key']}
+            if index['sparse'] and all(v is _MISSING for v in key.values()):
+                continue
+            query = {field: None if v is _MISSING else v for field, v in key.items()}
+            for other in self._matching(query):
+                if old is None or other['_id'] != old['_id']:
+                    raise _duplicate(self.name, name, query)
+
+    def _write(self, doc: dict, old: dict | None) -> None:
+        if old is not None:
+            doc['_id'] = old['_id']
+        elif '_id' not in doc:
+            doc['_id'] = ObjectId()
+        self._check_unique(doc, old)
+        self._store(doc, old)
+
+    def _insert(self, doc: dict) -> Any:
+        doc = _copy(doc)
+        self._write(doc, None)
+        return doc['_id']
+
+    def _replace(self, filter: dict, replacement: dict, upsert: bool) -> dict:
+        if any(k.startswith('$') for k in replacement):
+            raise ValueError('replacement can not include $ operators')
+        old = self._first(filter)
+        doc = _copy(replacement)
+        if old is None:
+            if not upsert:
+                return {'n': 0, 'nModified': 0}
+            if '_id' not in doc and '_id' in _equalities(filter):
+                doc['_id'] = _equalities(filter)['_id']
+            self._write(doc, None)
+            return {'n': 1, 'nModified': 0, 'upserted': doc['_id']}
+        self._write(doc, old)
+        return {'n': 1, 'nModified': int(doc != old)}
+
+    def _update(self, filter: dict, update: dict, upsert: bool, multi: bool = False,
+                sort: list | None = None) -> tuple[dict, dict | None, dict | None]:
+        """Returns the raw result and the first document before and after."""
+        targets = list(self._matching(filter)) if multi else [d for d in [self._first(filter, sort)] if d]
+        if not targets:
+            if not upsert:
+                return {'n': 0, 'nModified': 0}, None, None
+            doc = _copy(_equalities(filter))
+            apply_update(doc, update, inserting=True)
+            self._write(doc, None)
+            return {'n': 1, 'nModified': 0, 'upserted': doc['_id']}, None, doc
+        modified = 0
+        first_after = None
+        for old in targets:
+            doc = _copy(old)
+            apply_update(doc, update)
+            if doc != old:
+                self._write(doc, old)
+                modified += 1
+            first_after = first_after or doc
+        return {'n': len(targets), 'nModified': modified}, targets[0], first_after
+
+    def _delete(self, filter: dict, multi: bool) -> int:
+        targets = list(self._matching(filter)) if multi else [d for d in [self._first(filter)] if d]
+        for doc in targets:
+            self._remove(doc)
+        return len(targets)
+
+    async def insert_one(self, document: dict, **kwargs: Any) -> InsertOneResult:
+        inserted_id = self._insert(document)
+        self._commit()
+        document.setdefault('_id', inserted_id)
+        return InsertOneResult(inserted_id, True)
+
+    async def insert_many(self, documents: Iterable[dict], ordered: bool = True, **kwargs: Any) -> InsertManyResult:
+        ids = []
+        try:
+            for document in documents:
+                ids.append(self._insert(document))
+                document.setdefault('_id', ids[-1])
+        finally:
+            self._commit()
+        return InsertManyResult(ids, True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        result = self._replace(filter, replacement, upsert)
+        self._commit()
+        return UpdateResult(result, True)
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        result, _, _ = self._update(filter, update, upsert, sort=kwargs.get('sort'))
+        self._commit()
+        return UpdateResult(result, True)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        result, _, _ = self._update(filter, update, upsert, multi=True)
+        self._commit()
+        return UpdateResult(result, True)
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection: dict | list | None = None,
+                                  sort: list | None = None, upsert: bool = False,
+                                  return_document: bool = ReturnDocument.BEFORE, **kwargs: Any) -> dict | None:
+        _, before, after = self._update(filter, update, upsert, sort=sort)
+        self._commit()
+        doc = after if return_document == ReturnDocument.AFTER else before
+        return None if doc is None else project(_copy(doc), projection)
+
+    async def find_one_and_delete(self, filter: dict, projection: dict | list | None = None,
+                                  sort: list | None = None, **kwargs: Any) -> dict | None:
+        doc = self._first(filter, sort)
+        if doc is not None:
+            self._remove(doc)
+            self._commit()
+        return None if doc is None else project(_copy(doc), projection)
+
+    async def delete_one(self, filter: dict, **kwargs: Any) -> DeleteResult:
+        deleted = self._delete(filter, multi=False)
+        self._commit()
+        return DeleteResult({'n': deleted}, True)
+
+    async def delete_many(self, filter: dict, **kwargs: Any) -> DeleteResult:
+        deleted = self._delete(filter, multi=True)
+        self._commit()
+        return DeleteResult({'n': deleted}, True)
+
+    async def bulk_write(self, requests: list, ordered: bool = True, **kwargs: Any) -> BulkWriteResult:
+        totals: dict[str, Any] = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0,
+                                  'upserted': [], 'writeErrors': [], 'writeConcernErrors': []}
+        try:
+            for i, op in enumerate(requests):
+                try:
+                    self._bulk_one(i, op, totals)
+                except DuplicateKeyError as e:
+                    totals['writeErrors'].append({'index': i, 'code': e.code, 'errmsg': str(e), 'op': op._doc})
+                    if ordered:
+                        break
+        finally:
+            self._commit()
+        if totals['writeErrors']:
+            raise BulkWriteError(totals)
+        return BulkWriteResult(totals, True)
+
+    def _bulk_one(self, i: int, op: Any, totals: dict[str, Any]) -> None:
+        kind = type(op).__name__
+        if kind == 'InsertOne':
+            self._insert(op._doc)
+            totals['nInserted'] += 1
+            return
+        if kind in ('DeleteOne', 'DeleteMany'):
+            totals['nRemoved'] += self._delete(op._filter, multi=kind == 'DeleteMany')
+            return
+        if kind == 'ReplaceOne':
+            result = self._replace(op._filter, op._doc, bool(op._upsert))
+        elif kind in ('UpdateOne', 'UpdateMany'):
+            result, _, _ = self._update(op._filter, op._doc, bool(op._upsert), multi=kind == 'UpdateMany')
+        else:
+            raise TypeError(f'{op!r} is not a valid request')
+        if 'upserted' in result:
+            totals['nUpserted'] += 1
+            totals['upserted'].append({'index': i, '_id': result['upserted']})
+        else:
+            totals['nMatched'] += result['n']
+            totals['nModified'] += result['nModified']
+
+    # ── indexes ───────────────────────────────────────────────────────────────
+
+    async def create_index(self, keys: str | list, unique: bool = False, sparse: bool = False,
+                           name: str | None = None, **kwargs: Any) -> str:
+        key = _index_keys(keys)
+        name = name or '_'.join(f'{field}_{direction}' for field, direction in key)
+        for existing_name, existing in self._indexes.items():
+            if existing['key'] == key:
+                if (existing['unique'], existing['sparse']) != (unique, sparse):
+                    raise OperationFailure(f'Index with name: {existing_name} already exists with '
+                                           'different options', code=85)
+                return existing_name
+
+        index = {'key': key, 'unique': unique, 'sparse': sparse}
+        if unique:
+            seen: set = set()
+            for doc in self._matching({}):
+                values = [_get_path(doc, field) for field, _ in key]
+                if sparse and all(v is _MISSING for v in values):
+                    continue
+                value = repr([None if v is _MISSING else v for v in values])
+                if value in seen:
+                    raise _duplicate(self.name, name, dict(zip((f for f, _ in key), values, strict=True)))
+                seen.add(value)
+        self._indexes[name] = index
+        self._index_added(name, key)
+        self._commit()
+        return name
+
+    async def list_indexes(self, **kwargs: Any) -> LocalCursor:
+        def run() -> Iterator[dict]:
+            for name, index in self._indexes.items():
+                yield {'v': 2, 'key': dict(index['key']), 'name': name,
+                       **({'unique': True} if index['unique'] and name != '_id_' else {}),
+                       **({'sparse': True} if index['sparse'] else {})}
+        return LocalCursor(run)
+
+    async def drop_index(self, index_or_name: str | list, **kwargs: Any) -> None:
+        name = index_or_name
+        if not isinstance(name, str):
+            key = _index_keys(name)
+            name = next((n for n, i in self._indexes.items() if i['key'] == key), '')
+        if name == '_id_' or name not in self._indexes:
+            raise OperationFailure(f'index not found with name [{name}]', code=INDEX_NOT_FOUND)
+        index = self._indexes.pop(name)
+        self._index_dropped(name, index['key'])
+        self._commit()
+
+
+class MemoryCollection(LocalCollection):
+    """Documents in a dict keyed by `_id`, with a hash index per indexed field.
+    Nothing is persisted; meant for tests, benchmarks and throwaway instances."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self._docs: dict[Any, dict] = {}
+        # field → value → _ids, for the first field of every index
+        self._hash: dict[str, dict[Any, set]] = {'_id': {}}
+
+    def _candidates(self, filter: dict) -> Iterable[dict]:
+        for field, value in _equalities(filter).items():
+            hashed = self._hash.get(field)
+            if hashed is None or value is None or isinstance(value, (dict, list)):
+                continue
+            return [self._docs[i] for i in hashed.get(value, ())]
+        for field, condition in filter.items():
+            if field in self._hash and isinstance(condition, dict) and set(condition) == {'$in'}:
+                values = condition['$in']
+                if all(v is not None and not isinstance(v, (dict, list)) for v in values):
+                    ids = {i for v in values for i in self._hash[field].get(v, ())}
+                    return [self._docs[i] for i in ids]
+        return self._docs.values()
+
+    def _hash_fields(self, doc: dict) -> Iterator[tuple[dict, Any]]:
+        for field, hashed in self._hash.items():
+            for value in _values(doc, field.split('.')):
+                for v in (value if isinstance(value, list) else [value]):
+                    if v is not _MISSING and v is not None and not isinstance(v, (dict, list)):
+                        yield hashed, v
+
+    def _store(self, doc: dict, old: dict | None) -> None:
+        if old is not None:
+            self._remove(old)
+        self._docs[doc['_id']] = doc
+        for hashed, value in self._hash_fields(doc):
+            hashed.setdefault(value, set()).add(doc['_id'])
+
+    def _remove(self, doc: dict) -> None:
+        self._docs.pop(doc['_id'], None)
+        for hashed, value in self._hash_fields(doc):
+            ids = hashed.get(value)
+            if ids is not None:
+                ids.discard(doc['_id'])
+                if not ids:
+                    del hashed[value]
+
+    def _size(self) -> int:
+        return len(self._docs)
+
+    def _index_added(self, name: str, key: list[tuple[str, int]]) -> None:
+        field = key[0][0]
+        if field not in self._hash:
+            self._hash[field] = {}
+            for doc in self._docs.values():
+                for value in _values(doc, field.split('.')):
+                    for v in (value if isinstance(value, list) else [value]):
+                        if v is not _MISSING and v is not None and not isinstance(v, (dict, list)):
+                            self._hash[field].setdefault(v, set()).add(doc['_id'])
+
+    def _index_dropped(self, name: str, key: list[tuple[str, int]]) -> None:
+        field = key[0][0]
+        if field != '_id' and not any(i['key'][0][0] == field for i in self._indexes.values()):
+            self._hash.pop(field, None)
+
+
+class SQLiteCollection(LocalCollection):
+    """One table per collection: the `_id` and the document as a JSON column.
+    Every index gets a SQLite expression index on json_extract() of its fields,
+    which serves equality and $in lookups on scalar values; other conditions are
+    matched on the decoded rows. Index definitions live in the `_indexes` table.
+    `table` is the collection name qualified by its database's."""
+
+    def __init__(self, name: str, table: str, conn: sqlite3.Connection) -> None:
+        super().__init__(name)
+        self._conn = conn
+        self._qualified = table
+        self._table = f'"{table}"'
+        conn.execute(f'CREATE TABLE IF NOT EXISTS {self._table} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+        for index_name, key, unique, sparse in conn.execute(
+                'SELECT name, key, "unique", sparse FROM _indexes WHERE collection = ?', (table,)):
+            self._indexes[index_name] = {'key': [tuple(k) for k in json_util.loads(key)],
+                                         'unique': bool(unique), 'sparse': bool(sparse)}
+        self._indexed = {index['key'][0][0] for index in self._indexes.values()}
+
+    @staticmethod
+    def _dumps(value: Any) -> str:
+        return json_util.dumps(value, json_options=RELAXED_JSON_OPTIONS)
+
+    def _rows(self, where: str = '', params: Iterable[Any] = ()) -> Iterator[dict]:
+        for (doc,) in self._conn.execute(f'SELECT doc FROM {self._table} {where}', tuple(params)):
+            yield json_util.loads(doc)
+
+    def _candidates(self, filter: dict) -> Iterable[dict]:
+        clauses, params = [], []
+        for field, value in _equalities(filter).items():
+            if field == '_id':
+                clauses.append('id = ?')
+                params.append(self._dumps(value))
+            elif field in self._indexed and isinstance(value, (int, float, str)) and not isinstance(value, bool):
+                clauses.append(f"json_extract(doc, '$.{field}') = ?")
+                params.append(value)
+        for field, condition in filter.items():
+            if (field in self._indexed and field != '_id' and isinstance(condition, dict)
+                    and set(condition) == {'$in'} and condition['$in']
+                    and all(isinstance(v, (int, float, str)) and not isinstance(v, bool) for v in condition['$in'])):
+                clauses.append(f"json_extract(doc, '$.{field}') IN ({', '.join('?' * len(condition['$in']))})")
+                params.extend(condition['$in'])
+        return self._rows('WHERE ' + ' AND '.join(clauses) if clauses else '', params)
+
+    def _store(self, doc: dict, old: dict | None) -> None:
+        self._conn.execute(f'INSERT OR REPLACE INTO {self._table} (id, doc) VALUES (?, ?)',
+                           (self._dumps(doc['_id']), self._dumps(doc)))
+
+    def _remove(self, doc: dict) -> None:
+        self._conn.execute(f'DELETE FROM {self._table} WHERE id = ?', (self._dumps(doc['_id']),))
+
+    def _size(self) -> int:
+        return self._conn.execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()[0]
+
+    def _commit(self) -> None:
+        self._conn.commit()
+
+    def _sql_index(self, name: str) -> str:
+        return f'"{self._qualified}.{name}"'
+
+    def _index_added(self, name: str, key: list[tuple[str, int]]) -> None:
+        columns = ', '.join(f"json_extract(doc, '$.{field}')" for field, _ in key)
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS {self._sql_index(name)} ON {self._table} ({columns})')
+        index = self._indexes[name]
+        self._conn.execute('INSERT OR REPLACE INTO _indexes VALUES (?, ?, ?, ?, ?)',
+                           (self._qualified, name, json_util.dumps(key), index['unique'], index['sparse']))
+        self._indexed.add(key[0][0])
+
+    def _index_dropped(self, name: str, key: list[tuple[str, int]]) -> None:
+        self._conn.execute(f'DROP INDEX IF EXISTS {self._sql_index(name)}')
+        self._conn.execute('DELETE FROM _indexes WHERE collection = ? AND name = ?', (self._qualified, name))
+        self._indexed = {index['key'][0][0] for index in self._indexes.values()}
+
+
+# ── Client ────────────────────────────────────────────────────────────────────
+
+class LocalDatabase:
+    """Stands in for an AsyncDatabase: collections by attribute or item."""
+
+    def __init__(self, client: 'LocalClient', name: str) -> None:
+        self.client = client
+        self.name = name
+        self._collections: dict[str, LocalCollection] = {}
+
+    def __getattr__(self, name: str) -> LocalCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> LocalCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = self.client._open_collection(self.name, name)
+        return collection
+
+    async def list_collection_names(self, **kwargs: Any) -> list[str]:
+        return self.client._collection_names(self.name)
+
+    async def watch(self, *args: Any, **kwargs: Any) -> Any:
+        # Nothing else can write to an embedded store
+        raise OperationFailure('The $changeStream stage is only supported on replica sets',
+                               code=CHANGE_STREAMS_UNSUPPORTED)
+
+
+class LocalClient:
+    """Stands in for AsyncMongoClient with the 'sqlite' or 'memory' backend.
+
+    SQLite runs in WAL mode with synchronous=NORMAL: readers never block the
+    writer, and a crash can lose at most the last few commits, never corrupt
+    the file. Statements run on the event loop thread; single-document reads
+    and writes on indexed keys take microseconds, which is cheaper than handing
+    them to a thread.
+    """
+
+    def __init__(self, backend: str, path: str | None = None) -> None:
+        if backend not in ('sqlite', 'memory'):
+            raise ValueError(f'Unknown local storage backend {backend!r}')
+        self.backend = backend
+        self.path = path or ':memory:'
+        self._conn: sqlite3.Connection | None = None
+        if backend == 'sqlite':
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS _indexes (collection TEXT, name TEXT, key TEXT, '
+                               '"unique" INTEGER, sparse INTEGER, PRIMARY KEY (collection, name))')
+            self._conn.commit()
+        self._databases: dict[str, LocalDatabase] = {}
+
+    def __getattr__(self, name: str) -> LocalDatabase:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> LocalDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = LocalDatabase(self, name)
+        return database
+
+    def get_database(self, name: str, **kwargs: Any) -> LocalDatabase:
+        return self[name]
+
+    def _open_collection(self, database: str, name: str) -> LocalCollection:
+        if self._conn is None:
+            return MemoryCollection(name)
+        return SQLiteCollection(name, f'{database}.{name}', self._conn)
+
+    def _collection_names(self, database: str) -> list[str]:
+        if self._conn is None:
+            return list(self[database]._collections)
+        prefix = f'{database}.'
+        return [row[0][len(prefix):] for row in self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?", (prefix + '%',))]
+
+    async def server_info(self) -> dict:
+        return {'version': f'sqlite {sqlite3.sqlite_version}' if self._conn else 'memory', 'ok': 1.0}
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,161 @@
+# Legacy field migrations
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import asyncio
+import logging
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+@dataclass(frozen=True)
+class FieldMigration:
+    """Rename `legacy_field` to `field` on every document of `collection`.
+
+    Values are copied as-is (no type conversion), so queries that used to match the
+    legacy field match the new one the same way.
+    """
+    collection: str
+    legacy_field: str
+    field: str
+
+    @property
+    def name(self) -> str:
+        return f'{self.collection}.{self.legacy_field}->{self.field}'
+
+    @property
+    def query(self) -> dict:
+        return {self.legacy_field: {'$exists': True}}
+
+    @property
+    def projection(self) -> dict:
+        return {self.legacy_field: 1, self.field: 1}
+
+    def update_for(self, doc: dict) -> tuple[dict, dict]:
+        """The (filter, update) rewriting `doc`."""
+        if doc.get(self.field) is not None or doc.get(self.legacy_field) is None:
+            # Nothing worth copying; the legacy field is dead weight
+            return {'_id': doc['_id']}, {'$unset': {self.legacy_field: ''}}
+        return {'_id': doc['_id']}, {'$set': {self.field: doc[self.legacy_field]},
+                                     '$unset': {self.legacy_field: ''}}
+
+
+@dataclass(frozen=True)
+class ComputedFieldMigration:
+    """Set `field` to `compute(doc)` on every document of `collection` that lacks
+    it, where `doc` holds the `sources` fields.
+
+    Each update only applies if the sources still hold the values that were read,
+    so a write racing the migration can't leave a stale result behind.
+    """
+    collection: str
+    field: str
+    sources: tuple[str, ...]
+    compute: Callable[[dict], Any]
+
+    @property
+    def name(self) -> str:
+        return f'{self.collection}.{self.field}'
+
+    @property
+    def query(self) -> dict:
+        return {self.field: {'$exists': False}}
+
+    @property
+    def projection(self) -> dict:
+        return dict.fromkeys(self.sources, 1)
+
+    def update_for(self, doc: dict) -> tuple[dict, dict]:
+        # A missing field matches None, so this also checks sources are still unset
+        condition = {'_id': doc['_id'], self.field: {'$exists': False},
+                     **{source: doc.get(source) for source in self.sources}}
+        return condition, {'$set': {self.field: self.compute(doc)}}
+
+
+Migration = FieldMigration | ComputedFieldMigration
+
+
+def _net_worth(doc: dict) -> int:
+    # Old documents may hold balances as strings; those can't be $inc'd either
+    return sum(value for value in (doc.get('wallet'), doc.get('bank'))
+               if isinstance(value, int) and not isinstance(value, bool))
+
+
+FIELD_MIGRATIONS: tuple[Migration, ...] = (
+    FieldMigration('automodsettings', 'guild', 'guild_id'),
+    FieldMigration('autorolesettings', 'guild', 'guild_id'),
+    FieldMigration('autorolesettings', 'BotsGetRoles', 'bots_get_roles'),
+    FieldMigration('currency', 'userID', 'user_id'),
+    FieldMigration('scammer_list', 'user', 'user_id'),
+    ComputedFieldMigration('currency', 'net_worth', ('wallet', 'bank'), _net_worth),
+)
+
+
+class MigrationRunner:
+    """Rewrites documents in `bulk_write` batches, walking each collection in
+    `_id` order. Progress is stored per migration in the `migrations` collection, so
+    a restart resumes after the last finished batch instead of starting over.
+    """
+
+    def __init__(self, db: Any, migrations: tuple[Migration, ...] = FIELD_MIGRATIONS,
+                 batch_size: int = 500, pause: float = 0.1) -> None:
+        self._db = db
+        self._progress = db.migrations
+        self._migrations = migrations
+        self._batch_size = batch_size
+        self._pause = pause
+
+    async def run(self, on_complete: Callable[[Migration], None]) -> None:
+        """Run every pending migration, calling `on_complete` for each finished one
+        (including ones already finished by an earlier run)."""
+        for migration in self._migrations:
+            try:
+                await self._run_one(migration)
+            except Exception as e:
+                logging.error(f'Migration {migration.name} failed, will resume on next start: {e}')
+                continue
+            on_complete(migration)
+
+    async def _run_one(self, migration: Migration) -> None:
+        state = await self._progress.find_one({'_id': migration.name}) or {}
+        if state.get('done'):
+            return
+
+        last_id = state.get('last_id')
+        migrated: int = state.get('migrated', 0)
+        source = self._db[migration.collection]
+        logging.info(f'Running migration {migration.name}' + (f' (resuming after {last_id})' if last_id else ''))
+
+        while True:
+            query: dict[str, Any] = dict(migration.query)
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+            cursor = source.find(query, migration.projection,
+                                 sort=[('_id', ASCENDING)], limit=self._batch_size)
+            docs = await cursor.to_list(length=None)
+            if not docs:
+                break
+
+            ops = [UpdateOne(*migration.update_for(doc)) for doc in docs]
+            try:
+                result = await source.bulk_write(ops, ordered=False)
+                migrated += result.modified_count
+            except BulkWriteError as e:
+                # Usually a duplicate key: a document under the new field already
+                # exists, so the legacy copy is shadowed and left where it is.
+                migrated += e.details.get('nModified', 0)
+                logging.warning(f'Migration {migration.name}: skipped {len(e.details.get("writeErrors", []))} '
+                                f'conflicting legacy documents')
+
+            last_id = docs[-1]['_id']
+            await self._progress.update_one(
+                {'_id': migration.name}, {'$set': {'last_id': last_id, 'migrated': migrated}}, upsert=True)
+            await asyncio.sleep(self._pause)
+
+        await self._progress.update_one(
+            {'_id': migration.name}, {'$set': {'done': True, 'migrated': migrated}}, upsert=True)
+        logging.info(f'Migration {migration.name} complete ({migrated} documents rewritten)')
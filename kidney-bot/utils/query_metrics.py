@@ -0,0 +1,170 @@
+# MongoDB command latency metrics
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import logging
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Any
+
+from pymongo import monitoring
+
+# Upper bounds (ms) of the latency histogram buckets; anything slower lands in the last one
+BUCKETS_MS: tuple[float, ...] = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float('inf'))
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram. Percentiles are bucket upper bounds, so
+    they are approximate but cost nothing to keep up to date."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS_MS)
+        self.count = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms: float) -> None:
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS_MS, self.counts, strict=True):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "avg_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": self.max_ms,
+            "total_ms": self.total_ms,
+            "buckets": {f"le_{bound:g}": n for bound, n in zip(BUCKETS_MS, self.counts, strict=True)},
+        }
+
+
+class QueryMetrics(monitoring.CommandListener):
+    """pymongo command listener recording latency per (collection, command).
+
+    Commands are named as the server sees them, so driver methods are grouped
+    by the command they send: find_one → find, replace_one/update_one → update,
+    insert_one → insert, count_documents → aggregate. Commands slower than
+    `slow_query_ms` are logged with their filter.
+    """
+
+    def __init__(self, slow_query_ms: float = 100, window: int = 60) -> None:
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = 0
+        self._histograms: dict[tuple[str, str], LatencyHistogram] = {}
+        # request_id → (collection, command, filter) for commands in flight
+        self._started: dict[int, tuple[str, str, Any]] = {}
+        # (second, commands finished in it) for the last `window` seconds
+        self._window = window
+        self._per_second: deque[list[int]] = deque(maxlen=window)
+        self._started_at = time.monotonic()
+        self._total = 0
+
+    # ── listener ──────────────────────────────────────────────────────────────
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = self._collection(event.command_name, event.command)
+        if collection is not None:
+            self._started[event.request_id] = (collection, event.command_name, self._filter(event.command))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, failed=True)
+
+    def _finish(self, event: Any, failed: bool) -> None:
+        started = self._started.pop(event.request_id, None)
+        if started is None:
+            return
+        collection, command, query = started
+        ms = event.duration_micros / 1000
+
+        histogram = self._histograms.get((collection, command))
+        if histogram is None:
+            histogram = self._histograms[(collection, command)] = LatencyHistogram()
+        histogram.record(ms)
+        if failed:
+            histogram.failures += 1
+        self._tick()
+
+        if ms >= self.slow_query_ms:
+            self.slow_queries += 1
+            logging.warning(f'Slow MongoDB {command} on {collection}: {ms:.1f} ms, filter {str(query)[:200]}')
+
+    # ── reporting ─────────────────────────────────────────────────────────────
+
+    def commands_per_second(self) -> float:
+        """Average rate over the last `window` seconds (or since startup, if shorter)."""
+        now = int(time.monotonic())
+        recent = sum(n for second, n in self._per_second if now - second < self._window)
+        elapsed = min(self._window, max(1.0, time.monotonic() - self._started_at))
+        return recent / elapsed
+
+    def stats(self) -> dict:
+        uptime = max(1e-9, time.monotonic() - self._started_at)
+        return {
+            "commands": self._total,
+            "commands_per_second": self.commands_per_second(),
+            "avg_commands_per_second": self._total / uptime,
+            "slow_queries": self.slow_queries,
+            "slow_query_ms": self.slow_query_ms,
+            "operations": {
+                f"{collection}.{command}": histogram.stats()
+                for (collection, command), histogram in sorted(self._histograms.items())
+            },
+        }
+
+    def reset(self) -> None:
+        self._histograms.clear()
+        self._per_second.clear()
+        self._started_at = time.monotonic()
+        self._total = 0
+        self.slow_queries = 0
+
+    # ── internal ──────────────────────────────────────────────────────────────
+
+    def _tick(self) -> None:
+        self._total += 1
+        second = int(time.monotonic())
+        if self._per_second and self._per_second[-1][0] == second:
+            self._per_second[-1][1] += 1
+        else:
+            self._per_second.append([second, 1])
+
+    @staticmethod
+    def _collection(command_name: str, command: Any) -> str | None:
+        # The collection is the value of the command's first key (e.g. {"find": "currency"});
+        # getMore names it separately. Admin commands like hello/ping aren't tracked.
+        name = command.get('collection') if command_name == 'getMore' else command.get(command_name)
+        return name if isinstance(name, str) else None
+
+    @staticmethod
+    def _filter(command: Any) -> Any:
+        if 'filter' in command:
+            return command['filter']
+        if 'query' in command:
+            return command['query']
+        for key in ('updates', 'deletes'):
+            if command.get(key):
+                return command[key][0].get('q')
+        if 'pipeline' in command:
+            return command['pipeline']
+        return None
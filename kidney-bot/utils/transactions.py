@@ -0,0 +1,276 @@
+# Atomic currency transactions
+# Copyright (C) 2023  Alec Jensen
+# Full license at LICENSE.md
+
+import logging
+from typing import Any, overload
+
+from pymongo.errors import OperationFailure
+
+from utils.database import Database, Schemas
+from utils.leaderboard import Leaderboard
+from utils.ledger import Ledger
+
+# Server error code for transactions on a standalone server
+ILLEGAL_OPERATION = 20
+
+
+class TransactionDeclined(Exception):
+    """The user's balances or inventory don't allow the change; nothing was written."""
+
+    def __init__(self, user_id: str, changes: dict[str, int]) -> None:
+        super().__init__(f'{user_id} cannot cover {changes}')
+        self.user_id = user_id
+        self.changes = changes
+
+
+def _changes(wallet: int, bank: int, items: dict[str, int] | None) -> dict[str, int]:
+    """The `$inc` spec for a change to a currency document."""
+    inc = {field: delta for field, delta in (('wallet', wallet), ('bank', bank)) if delta}
+    if wallet + bank:
+        inc['net_worth'] = wallet + bank
+    inc.update({f'inventory.{item}': n for item, n in (items or {}).items() if n})
+    return inc
+
+
+def _covered(inc: dict[str, int], limits: dict[str, int | float] | None = None) -> dict:
+    """Filter that only matches if every field `inc` takes from holds at least that
+    much (a missing field holds nothing) and every item in `limits` is below its limit."""
+    condition: dict[str, dict] = {field: {'$gte': -delta} for field, delta in inc.items()
+                                  if delta < 0 and field != 'net_worth'}
+    for item, limit in (limits or {}).items():
+        if limit != float('inf'):
+            # $not also matches a missing field, i.e. none owned yet
+            condition.setdefault(f'inventory.{item}', {})['$not'] = {'$gte': limit}
+    return condition
+
+
+def _split(location: str, amount: int) -> tuple[int, int]:
+    """The (wallet, bank) deltas for `amount` going to `location`."""
+    if location == 'wallet':
+        return amount, 0
+    if location == 'bank':
+        return 0, amount
+    raise ValueError(f"location must be 'wallet' or 'bank', got: {location}")
+
+
+def _net_worth(doc: Schemas.Currency) -> int:
+    return int(doc.wallet or 0) + int(doc.bank or 0)
+
+
+class Transactions:
+    """Currency changes that can't lose updates or create money.
+
+    Every change is a single `$inc` on the user's currency document, and any
+    balance it takes from is checked by the same server operation (`update_if`),
+    so two commands racing on one user can't both spend the same beans.
+
+    Transfers between users run both updates in a MongoDB transaction where the
+    deployment supports them (replica sets, sharded clusters). Elsewhere the source
+    is debited first and the target credited second; if the credit fails, the
+    debit is refunded. A process dying between the two writes loses the amount in
+    flight, which is why transactions are used whenever they are available.
+
+    Every write also keeps `net_worth` (wallet + bank) current, and reports it
+    to `leaderboard`. Every change that lands is recorded in `ledger`, with the
+    `reason` given for it, once it has been written (best-effort; see Ledger).
+    """
+
+    def __init__(self, database: Database, leaderboard: Leaderboard | None = None,
+                 ledger: Ledger | None = None) -> None:
+        self.database = database
+        self.leaderboard = leaderboard
+        self.ledger = ledger
+
+    async def credit(self, user_id: str, *, wallet: int = 0, bank: int = 0,
+                     items: dict[str, int] | None = None, reason: str | None = None) -> Schemas.Currency | None:
+        """Apply the change unconditionally (balances may go negative), creating the
+        document if needed. Returns the updated document."""
+        return await self._written(await self._credit(user_id, wallet=wallet, bank=bank, items=items,
+                                                      reason=reason))
+
+    async def charge(self, user_id: str, *, wallet: int = 0, bank: int = 0,
+                     items: dict[str, int] | None = None,
+                     limits: dict[str, int | float] | None = None,
+                     reason: str | None = None) -> Schemas.Currency | None:
+        """Apply the change only if every balance or item it takes from covers it,
+        and every item in `limits` is held fewer than that many times. Raises
+        TransactionDeclined otherwise. Returns the updated document."""
+        return await self._written(await self._charge(user_id, wallet=wallet, bank=bank, items=items,
+                                                      limits=limits, reason=reason))
+
+    @overload
+    async def _written(self, doc: Schemas.Currency) -> Schemas.Currency: ...
+
+    @overload
+    async def _written(self, doc: None) -> None: ...
+
+    async def _written(self, doc: Schemas.Currency | None) -> Schemas.Currency | None:
+        if doc is None or doc.user_id is None:
+            return doc
+        user_id = doc.user_id
+        net_worth = _net_worth(doc)
+        if doc.net_worth != net_worth:
+            # Written before net_worth was stored, so the $inc started it from zero
+            repaired = await self.database.currency.update_if(
+                user_id, {'wallet': doc.wallet, 'bank': doc.bank}, set={'net_worth': net_worth})
+            doc = repaired or doc
+        if self.leaderboard is not None:
+            self.leaderboard.record(user_id, net_worth)
+        return doc
+
+    def _record(self, user_id: str, *, wallet: int = 0, bank: int = 0, items: dict[str, int] | None = None,
+                reason: str | None = None, counterparty: str | None = None) -> None:
+        if self.ledger is not None:
+            self.ledger.record(user_id, wallet=wallet, bank=bank, items=items, reason=reason,
+                               counterparty=counterparty)
+
+    async def _credit(self, user_id: str, *, wallet: int = 0, bank: int = 0,
+                      items: dict[str, int] | None = None, reason: str | None = None,
+                      counterparty: str | None = None) -> Schemas.Currency | None:
+        inc = _changes(wallet, bank, items)
+        if not inc:
+            return await self.database.currency.get(user_id)
+        doc = await self.database.currency.update(user_id, inc=inc, return_document=True)
+        self._record(user_id, wallet=wallet, bank=bank, items=items, reason=reason, counterparty=counterparty)
+        return doc
+
+    async def _charge(self, user_id: str, *, wallet: int = 0, bank: int = 0,
+                      items: dict[str, int] | None = None,
+                      limits: dict[str, int | float] | None = None, reason: str | None = None,
+                      counterparty: str | None = None) -> Schemas.Currency | None:
+        inc = _changes(wallet, bank, items)
+        condition = _covered(inc, limits)
+        if not inc:
+            return await self.database.currency.get(user_id)
+        if not condition:
+            doc = await self.database.currency.update(user_id, inc=inc, return_document=True)
+        else:
+            doc = await self.database.currency.update_if(user_id, condition, inc=inc)
+            if doc is None:
+                raise TransactionDeclined(user_id, inc)
+        self._record(user_id, wallet=wallet, bank=bank, items=items, reason=reason, counterparty=counterparty)
+        return doc
+
+    async def deposit(self, user_id: str, amount: int) -> Schemas.Currency | None:
+        if amount < 0:
+            raise ValueError('amount must not be negative')
+        return await self.charge(user_id, wallet=-amount, bank=amount, reason='deposit')
+
+    async def withdraw(self, user_id: str, amount: int) -> Schemas.Currency | None:
+        if amount < 0:
+            raise ValueError('amount must not be negative')
+        return await self.charge(user_id, wallet=amount, bank=-amount, reason='withdraw')
+
+    async def buy(self, user_id: str, item: str, price: int,
+                  max_quantity: int | float = float('inf')) -> Schemas.Currency | None:
+        """Take `price` from the wallet and add one `item`, unless the user already
+        holds `max_quantity` of them."""
+        return await self.charge(user_id, wallet=-price, items={item: 1}, limits={item: max_quantity},
+                                 reason='buy')
+
+    async def use_item(self, user_id: str, item: str, amount: int = 1) -> bool:
+        """Remove `amount` of `item`. Returns False if the user has fewer."""
+        try:
+            await self.charge(user_id, items={item: -amount}, reason='use')
+        except TransactionDeclined:
+            return False
+        return True
+
+    async def reward(self, amounts: dict[str, int], location: str = 'wallet',
+                     reason: str | None = None) -> dict[str, Schemas.Currency]:
+        """Credit each user their amount, like `credit`, with one bulk write for
+        all of them. Returns the updated documents."""
+        split = {user_id: _split(location, amount) for user_id, amount in amounts.items()}
+        changes = {user_id: _changes(wallet, bank, None) for user_id, (wallet, bank) in split.items()}
+        changes = {user_id: inc for user_id, inc in changes.items() if inc}
+        if not changes:
+            return {}
+        await self.database.currency.inc_many(changes)
+        for user_id in changes:
+            wallet, bank = split[user_id]
+            self._record(user_id, wallet=wallet, bank=bank, reason=reason)
+        # Mostly answered by the cache, which took the increments in
+        docs = await self.database.currency.get_many(changes)
+        return {user_id: await self._written(doc) for user_id, doc in docs.items()}
+
+    async def transfer(self, source: str, target: str, amount: int, source_location: str = 'wallet',
+                       target_location: str = 'wallet') -> tuple[Schemas.Currency, Schemas.Currency]:
+        """Move `amount` from the source's balance to the target's. Raises
+        TransactionDeclined if the source doesn't have it. Returns both updated
+        documents."""
+        if amount <= 0:
+            raise ValueError('amount must be positive')
+        if source == target:
+            raise ValueError('source and target must be different users')
+
+        # Raise ValueError for anything but 'wallet' or 'bank' before writing
+        _split(source_location, amount)
+        _split(target_location, amount)
+        result = None
+        if self.database.supports_transactions:
+            try:
+                result = await self._transfer_in_transaction(source, target, amount, source_location,
+                                                             target_location)
+            except OperationFailure as e:
+                if e.code != ILLEGAL_OPERATION:
+                    raise
+                logging.warning(f'Transactions are not supported by this deployment, '
+                                f'transferring with a compensating refund instead: {e}')
+                self.database.supports_transactions = False
+        if result is None:
+            result = await self._transfer_with_refund(source, target, amount, source_location, target_location)
+        debited, credited = result
+        return await self._written(debited), await self._written(credited)
+
+    async def _transfer_in_transaction(self, source: str, target: str, amount: int, source_location: str,
+                                       target_location: str) -> tuple[Schemas.Currency, Schemas.Currency]:
+        currency = self.database.currency
+
+        async def run(session: Any) -> tuple[Schemas.Currency, Schemas.Currency]:
+            debited = await currency.update_if(source, {source_location: {'$gte': amount}},
+                                               inc={source_location: -amount, 'net_worth': -amount},
+                                               session=session)
+            if debited is None:
+                raise TransactionDeclined(source, {source_location: -amount})
+            credited = await currency.update(target, inc={target_location: amount, 'net_worth': amount},
+                                             return_document=True, session=session)
+            if credited is None:
+                raise RuntimeError(f'Crediting {target} returned no document')
+            return debited, credited
+
+        async with self.database.client.start_session() as session:  # type: ignore[union-attr]
+            try:
+                result = await session.with_transaction(run)
+            except BaseException:
+                # The cache took in the writes as they were made; the transaction
+                # may have been rolled back since.
+                currency.forget(source)
+                currency.forget(target)
+                raise
+        # Only once committed: with_transaction may have run `run` more than once
+        wallet, bank = _split(source_location, -amount)
+        self._record(source, wallet=wallet, bank=bank, reason='transfer', counterparty=target)
+        wallet, bank = _split(target_location, amount)
+        self._record(target, wallet=wallet, bank=bank, reason='transfer', counterparty=source)
+        return result
+
+    async def _transfer_with_refund(self, source: str, target: str, amount: int, source_location: str,
+                                    target_location: str) -> tuple[Schemas.Currency, Schemas.Currency]:
+        wallet, bank = _split(source_location, -amount)
+        debited = await self._charge(source, wallet=wallet, bank=bank, reason='transfer', counterparty=target)
+        try:
+            wallet, bank = _split(target_location, amount)
+            credited = await self._credit(target, wallet=wallet, bank=bank, reason='transfer', counterparty=source)
+            if debited is None or credited is None:
+                raise RuntimeError(f'Transferring from {source} to {target} returned no document')
+        except BaseException as e:
+            logging.error(f'Transfer of {amount} from {source} to {target} failed after the debit, refunding: {e}')
+            try:
+                wallet, bank = _split(source_location, amount)
+                await self.credit(source, wallet=wallet, bank=bank, reason='refund')
+            except Exception as refund_error:
+                logging.critical(f'Refund of {amount} to {source}\'s {source_location} failed, '
+                                 f'the beans are lost: {refund_error}')
+            raise
+        return debited, credited
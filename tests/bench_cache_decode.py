@@ -0,0 +1,79 @@
+"""Micro-benchmark: decoding cached raw dicts on every hit (old path) vs handing out
+a copy of the cached decoded schema vs the shared frozen instance (readonly=True).
+
+Not collected by pytest. Run with: python tests/bench_cache_decode.py
+"""
+import asyncio
+import functools
+import sys, pathlib
+import timeit
+from unittest.mock import MagicMock
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from utils.cache import Cache
+from utils.database import Collection, Schemas
+
+N = 200_000
+REPEAT = 5
+
+SAMPLES = {
+    "AutoModSettings": (Schemas.AutoModSettings, "guild_id",
+                        {"guild_id": 1, "log_channel": 2, "whitelist": [3, 4, 5]}),
+    "AutoRoleSettings": (Schemas.AutoRoleSettings, "guild_id",
+                         {"guild_id": 1, "roles": [{"id": 2, "delay": 0}, {"id": 3, "delay": 60}],
+                          "bots_get_roles": True}),
+    "GuildConfig": (Schemas.GuildConfig, "guild_id",
+                    {"guild_id": 1, "ephemeral_moderation_messages": True,
+                     "ephemeral_setting_overpowers_user_setting": False}),
+    "Currency": (Schemas.Currency, "user_id",
+                 {"user_id": "1", "wallet": 100, "bank": 2000, "inventory": {"cookie": 3, "phone": 1}}),
+}
+
+
+def bench_cache_paths() -> None:
+    print(f"Cache hit → schema, {N:,} iterations (µs per hit)")
+    print(f"{'schema':<18}{'from_dict':>12}{'copy':>12}{'readonly':>12}")
+    for name, (schema, pk, doc) in SAMPLES.items():
+        cache = Cache(pk, decode=lambda d, schema=schema: schema.from_dict(d).freeze())
+        cache.add(doc)
+        query = {pk: doc[pk]}
+
+        def old_path(schema=schema, cache=cache, query=query):
+            return schema.from_dict(cache.lookup(query)[1])
+
+        def copy_path(cache=cache, query=query):
+            return cache.lookup_decoded(query)[1].copy()
+
+        def readonly_path(cache=cache, query=query):
+            return cache.lookup_decoded(query)[1]
+
+        paths = (old_path, copy_path, readonly_path)
+        # Interleaved, so a noisy stretch slows every path alike; best of REPEAT rounds
+        rounds = [[timeit.timeit(f, number=N) for f in paths] for _ in range(REPEAT)]
+        old, copied, shared = (min(times) / N * 1e6 for times in zip(*rounds, strict=True))
+        print(f"{name:<18}{old:>12.3f}{copied:>12.3f}{shared:>12.3f}")
+        # Copies borrow the cached containers until touched, so a modifiable hit
+        # must never cost more than decoding the raw dict did
+        assert copied <= old, f"{name}: copy on hit ({copied:.3f} µs) slower than decode ({old:.3f} µs)"
+
+
+def bench_collection_get() -> None:
+    schema, pk, doc = SAMPLES["AutoRoleSettings"]
+    col = Collection(MagicMock(), pk, schema)
+    col.cache.add(doc)
+    loop = asyncio.new_event_loop()
+
+    async def many_gets(readonly):
+        for _ in range(N):
+            await col.get(1, readonly=readonly)
+
+    print()
+    for readonly in (False, True):
+        t = timeit.timeit(functools.partial(loop.run_until_complete, many_gets(readonly)), number=1) / N * 1e6
+        print(f"Collection.get cache hit (AutoRoleSettings, readonly={readonly}): {t:.3f} µs")
+
+
+if __name__ == "__main__":
+    bench_cache_paths()
+    bench_collection_get()
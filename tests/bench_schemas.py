@@ -0,0 +1,138 @@
+"""Micro-benchmark: the hand-written, __dict__-based schema classes (before) vs the
+declarative slotted schemas with generated codecs (after) — decode throughput,
+encode throughput and memory per instance.
+
+Not collected by pytest. Run with: python tests/bench_schemas.py
+"""
+import functools
+import sys, pathlib
+import timeit
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from utils.database import Schemas, convert_except_none, remove_none_values
+
+N = 100_000
+REPEAT = 5
+INSTANCES = 50_000
+
+
+def best(f) -> float:
+    """µs per call, best of REPEAT runs."""
+    return min(timeit.repeat(f, number=N, repeat=REPEAT)) / N * 1e6
+
+
+# The schema classes as they were written before, kept here as the baseline
+class LegacyCurrency:
+    def __init__(self, user_id=None, wallet=None, bank=None, inventory=None):
+        self.user_id = convert_except_none(user_id, str)
+        self.wallet = convert_except_none(wallet, int)
+        self.bank = convert_except_none(bank, int)
+        self.inventory = inventory
+
+    @classmethod
+    def from_dict(cls, data):
+        if data is None:
+            return cls()
+        user_id = data.get('user_id') or data.get('userID')
+        return cls(user_id, data.get('wallet'), data.get('bank'), data.get('inventory'))
+
+    def to_dict(self):
+        return remove_none_values({
+            'user_id': self.user_id, 'wallet': self.wallet,
+            'bank': self.bank, 'inventory': self.inventory,
+        })
+
+
+class LegacyAutoRoleSettings:
+    def __init__(self, guild_id=None, roles=None, bots_get_roles=None):
+        self.guild_id = convert_except_none(guild_id, int)
+        self.roles = roles
+        self.bots_get_roles = convert_except_none(bots_get_roles, bool)
+
+    @classmethod
+    def from_dict(cls, data):
+        if data is None:
+            return cls()
+        guild_id = data.get('guild_id') or data.get('guild')
+        bots_get_roles = data.get('bots_get_roles') if data.get('bots_get_roles') is not None else data.get('BotsGetRoles')
+        return cls(guild_id, data.get('roles'), bots_get_roles)
+
+    def to_dict(self):
+        return remove_none_values({
+            'guild_id': self.guild_id,
+            'roles': self.roles,
+            'bots_get_roles': self.bots_get_roles,
+        })
+
+
+class LegacyMusicQueue:
+    def __init__(self, guild_id=None, voice_channel_id=None, text_channel_id=None, current=None,
+                 queue=None, loop_mode=None, volume=None):
+        self.guild_id = convert_except_none(guild_id, int)
+        self.voice_channel_id = convert_except_none(voice_channel_id, int)
+        self.text_channel_id = convert_except_none(text_channel_id, int)
+        self.current = current
+        self.queue = queue if queue is not None else []
+        self.loop_mode = convert_except_none(loop_mode, str)
+        self.volume = convert_except_none(volume, float)
+
+    @classmethod
+    def from_dict(cls, data):
+        if data is None:
+            return cls()
+        return cls(data.get('guild_id'), data.get('voice_channel_id'), data.get('text_channel_id'),
+                   data.get('current'), data.get('queue', []), data.get('loop_mode'), data.get('volume'))
+
+    def to_dict(self):
+        d = remove_none_values({
+            'guild_id': self.guild_id, 'voice_channel_id': self.voice_channel_id,
+            'text_channel_id': self.text_channel_id, 'current': self.current,
+            'loop_mode': self.loop_mode, 'volume': self.volume,
+        })
+        d['queue'] = self.queue
+        return d
+
+
+SAMPLES = {
+    "Currency": (LegacyCurrency, Schemas.Currency,
+                 {"user_id": "1", "wallet": 100, "bank": 2000, "inventory": {"cookie": 3}}),
+    "Currency (legacy)": (LegacyCurrency, Schemas.Currency,
+                          {"userID": "1", "wallet": "100", "bank": "2000"}),
+    "AutoRoleSettings": (LegacyAutoRoleSettings, Schemas.AutoRoleSettings,
+                         {"guild_id": 1, "roles": [{"id": 2, "delay": 0}], "bots_get_roles": True}),
+    "MusicQueue": (LegacyMusicQueue, Schemas.MusicQueue,
+                   {"guild_id": 1, "voice_channel_id": 2, "text_channel_id": 3, "current": {"title": "a"},
+                    "queue": [{"title": "b"}], "loop_mode": "off", "volume": 0.5}),
+}
+
+
+def per_instance_bytes(schema, doc) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = [schema.from_dict(doc) for _ in range(INSTANCES)]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objs
+    # The instance plus whatever decoding allocates for it (converted values, copied lists)
+    return used / INSTANCES
+
+
+def bench() -> None:
+    print(f"{'schema':<20}{'decode µs':>22}{'encode µs':>22}{'bytes/instance':>22}")
+    print(f"{'':<20}{'before → after':>22}{'before → after':>22}{'before → after':>22}")
+    for name, (legacy, schema, doc) in SAMPLES.items():
+        decode = [best(functools.partial(cls.from_dict, doc)) for cls in (legacy, schema)]
+        objs = [cls.from_dict(doc) for cls in (legacy, schema)]
+        encode = [best(obj.to_dict) for obj in objs]
+        memory = [per_instance_bytes(cls, doc) for cls in (legacy, schema)]
+        print(f"{name:<20}{decode[0]:>12.3f} → {decode[1]:<7.3f}{encode[0]:>12.3f} → {encode[1]:<7.3f}"
+              f"{memory[0]:>12.0f} → {memory[1]:<7.0f}")
+    doc = SAMPLES["Currency"][2]
+    print(f"\nDecode throughput (Currency): {1e6 / best(lambda: LegacyCurrency.from_dict(doc)):,.0f}/s → "
+          f"{1e6 / best(lambda: Schemas.Currency.from_dict(doc)):,.0f}/s")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,25 @@
+"""Shared fixtures for the tests that run against the in-memory storage backend."""
+import asyncio
+import pytest
+import sys, pathlib
+
+# One loop for the shared fixtures and the tests using them: a Database's tasks
+# and locks belong to the loop it was connected on.
+_loop = asyncio.new_event_loop()
+def run(coro):
+    return _loop.run_until_complete(coro)
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from utils.database import Database
+
+
+@pytest.fixture
+def db():
+    """A connected in-memory Database whose startup migrations have finished.
+    Test modules that need to watch its calls override this fixture and wrap them."""
+    db = Database("", storage="memory")
+    run(db.connect())
+    run(db._migration_task)
+    yield db
+    run(db.close())
@@ -0,0 +1,81 @@
+"""Tests for utils/activity.py."""
+import asyncio
+import sys, pathlib
+import time
+from datetime import UTC, datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from utils.activity import RecentActivity
+
+_loop = asyncio.new_event_loop()
+def run(coro):
+    return _loop.run_until_complete(coro)
+
+
+def message(author, channel=1, ago=0, bot=False):
+    sent = datetime.fromtimestamp(time.time() - ago, UTC)
+    return SimpleNamespace(author=SimpleNamespace(id=author, bot=bot), channel=SimpleNamespace(id=channel),
+                           created_at=sent)
+
+
+def listening(window=120):
+    """A buffer that has been listening for a while."""
+    activity = RecentActivity(window)
+    activity._since = time.time() - 1000
+    return activity
+
+
+class TestRecentActivity:
+    def test_unknown_until_started(self):
+        activity = RecentActivity()
+        activity.record(message(1))
+        assert activity.authors(1, time.time() - 60) is None
+
+    def test_authors_since(self):
+        activity = listening()
+        for author, ago in ((1, 0), (2, 0), (3, 0), (2, 0)):
+            activity.record(message(author, ago=ago))
+        activity.record(message(4, bot=True))
+        activity.record(message(5, channel=2))
+        assert activity.authors(1, time.time() - 60) == [1, 3, 2]
+        assert activity.authors(3, time.time() - 60) == []
+
+    def test_older_than_start_or_window_is_unknown(self):
+        activity = listening()
+        assert activity.authors(1, time.time() - 60) == []
+        assert activity.authors(1, time.time() - 200) is None
+
+        async def start():
+            activity.start()
+        run(start())
+        assert activity.authors(1, time.time() - 60) is None
+        activity.stop()
+
+    def test_old_messages_are_dropped(self):
+        activity = listening()
+        activity.record(message(1, ago=100))
+        activity.record(message(2, ago=30))
+        assert activity.authors(1, time.time() - 60) == [2]
+        activity.record(message(3, ago=-30))
+        assert list(activity._channels[1]) == [2, 3]
+
+    def test_reads_sweep_quiet_channels(self):
+        activity = listening()
+        activity.record(message(1, channel=1, ago=100))
+        activity.record(message(2, channel=2, ago=30))
+        activity._channels[1][1] -= 60  # went quiet since
+        assert activity.authors(2, time.time() - 60) == [2]
+        assert list(activity._channels) == [2]
+
+    def test_sweep_loop_drops_empty_channels(self):
+        activity = listening(window=0.01)
+
+        async def go():
+            activity.start()
+            activity.record(message(1))
+            await asyncio.sleep(0.05)
+        run(go())
+        activity.stop()
+        assert activity._channels == {}
@@ -81,6 +81,38 @@ class TestCacheUpdate:
     def test_update_miss_is_noop(self, cache):
         cache.update({"guild_id": 99}, {"$set": {"x": 1}})  # should not raise
 
+    def test_inc_adds_to_field(self, cache):
+        cache.add({"guild_id": 1, "count": 2})
+        cache.update({"guild_id": 1}, {"$inc": {"count": 3, "other": 1}})
+        assert cache.get_one({"guild_id": 1}) == {"guild_id": 1, "count": 5, "other": 1}
+
+    def test_dotted_inc_creates_nested_dict(self, cache):
+        cache.add({"guild_id": 1})
+        cache.update({"guild_id": 1}, {"$inc": {"inventory.cookie": 1}})
+        assert cache.get_one({"guild_id": 1})["inventory"] == {"cookie": 1}
+
+    def test_push_and_pull(self, cache):
+        cache.add({"guild_id": 1, "roles": [1, 2]})
+        cache.update({"guild_id": 1}, {"$push": {"roles": 3}})
+        cache.update({"guild_id": 1}, {"$pull": {"roles": 1}})
+        assert cache.get_one({"guild_id": 1})["roles"] == [2, 3]
+
+    def test_push_each(self, cache):
+        cache.add({"guild_id": 1})
+        cache.update({"guild_id": 1}, {"$push": {"roles": {"$each": [1, 2]}}})
+        assert cache.get_one({"guild_id": 1})["roles"] == [1, 2]
+
+    def test_unsupported_update_drops_entry(self, cache):
+        cache.add({"guild_id": 1, "warns": [{"id": "a"}]})
+        cache.update({"guild_id": 1}, {"$pull": {"warns": {"id": "a"}}})
+        assert cache.get_one({"guild_id": 1}) is None
+
+    def test_nested_original_not_mutated(self, cache):
+        doc = {"guild_id": 1, "inventory": {"cookie": 1}, "roles": [1]}
+        cache.add(doc)
+        cache.update({"guild_id": 1}, {"$inc": {"inventory.cookie": 1}, "$push": {"roles": 2}})
+        assert doc == {"guild_id": 1, "inventory": {"cookie": 1}, "roles": [1]}
+
     def test_original_doc_not_mutated(self, cache):
         doc = {"guild_id": 1, "val": "original"}
         cache.add(doc)
@@ -102,6 +134,32 @@ class TestCacheRemove:
         cache.remove({"other": "field"})
         assert cache.get_one({"guild_id": 1}) is not None
 
+    def test_remove_id_drops_only_the_matching_entry(self, cache):
+        cache.add({"_id": "a", "guild_id": 1})
+        cache.add({"guild_id": 2})
+        assert cache.remove_id("a") == 1
+        assert cache.get_one({"guild_id": 1}) is None
+        assert cache.get_one({"guild_id": 2}) is not None
+
+    def test_remove_id_of_unknown_document_keeps_everything(self, cache):
+        cache.add({"guild_id": 1})
+        assert cache.remove_id("a") is None
+        assert cache.get_one({"guild_id": 1}) is not None
+
+    def test_save_over_read_document_keeps_its_id(self, cache):
+        cache.add({"_id": "a", "guild_id": 1, "value": "old"})
+        cache.add({"guild_id": 1, "value": "new"})
+        assert cache.remove_id("a") == 1
+        assert cache.get_one({"guild_id": 1}) is None
+
+    def test_id_index_follows_evictions(self):
+        cache = Cache(primary_key="guild_id", max_entries=1)
+        cache.add({"_id": "a", "guild_id": 1})
+        cache.add({"_id": "b", "guild_id": 2})
+        assert cache._ids == {"b": 2}
+        cache.clear()
+        assert cache._ids == {}
+
 
 class TestCacheCleanup:
     def test_cleanup_removes_expired(self, cache):
@@ -113,6 +171,32 @@ class TestCacheCleanup:
         assert cache.get_one({"guild_id": 1}) is None
         assert cache.get_one({"guild_id": 2}) is not None
 
+    def test_cleanup_follows_insertion_order(self, cache):
+        with patch("utils.cache.time.monotonic", return_value=1000.0):
+            cache.add({"guild_id": 1})
+            cache.add({"guild_id": 2})
+        with patch("utils.cache.time.monotonic", return_value=1200.0):
+            cache.add({"guild_id": 1})  # re-adding restarts its TTL
+            cache.update({"guild_id": 2}, {"$set": {"x": 1}})  # updating does not
+        with patch("utils.cache.time.monotonic", return_value=1400.0):
+            assert cache.cleanup() == 1
+        assert list(cache._store) == [1]
+
+    def test_cleanup_stops_at_first_live_entry(self, cache):
+        cache.add_many([{"guild_id": i} for i in range(1000)])
+        cache._store[0]["ts"] -= 400
+        with patch.object(cache, "_pop", wraps=cache._pop) as pop:
+            assert cache.cleanup() == 1
+        assert pop.call_count == 1
+
+    def test_cleanup_after_lru_eviction(self):
+        cache = Cache(primary_key="guild_id", max_entries=1)
+        cache.add({"guild_id": 1})
+        cache.add({"guild_id": 2})
+        cache._store[2]["ts"] -= 400
+        assert cache.cleanup() == 1
+        assert len(cache._expiry) == 0
+
     def test_cleanup_returns_zero_when_nothing_expired(self, cache):
         cache.add({"guild_id": 1})
         assert cache.cleanup() == 0
@@ -121,3 +205,129 @@ class TestCacheCleanup:
         cache.add_many([{"guild_id": i} for i in range(10)])
         cache.clear()
         assert len(cache._store) == 0
+
+
+class TestCacheNegative:
+    def test_absent_entry_is_a_hit(self, cache):
+        cache.add_absent({"guild_id": 1})
+        assert cache.lookup({"guild_id": 1}) == (True, None)
+        assert cache.negative_hits == 1
+
+    def test_unknown_key_is_a_miss(self, cache):
+        assert cache.lookup({"guild_id": 1}) == (False, None)
+        assert cache.misses == 1
+
+    def test_absent_entry_expires_on_its_own_ttl(self):
+        cache = Cache(primary_key="guild_id", ttl=300, negative_ttl=10)
+        cache.add_absent({"guild_id": 1})
+        cache._absent[1] -= 20
+        assert cache.lookup({"guild_id": 1}) == (False, None)
+        assert 1 not in cache._absent
+
+    def test_add_clears_absent_marker(self, cache):
+        cache.add_absent({"guild_id": 1})
+        cache.add({"guild_id": 1, "data": "x"})
+        assert cache.lookup({"guild_id": 1}) == (True, {"guild_id": 1, "data": "x"})
+
+    def test_remove_clears_absent_marker(self, cache):
+        cache.add_absent({"guild_id": 1})
+        cache.remove({"guild_id": 1})
+        assert cache.lookup({"guild_id": 1}) == (False, None)
+
+    def test_complex_query_not_marked_absent(self, cache):
+        cache.add_absent({"guild_id": 1, "other": 2})
+        assert len(cache._absent) == 0
+
+    def test_cleanup_removes_expired_absent(self, cache):
+        cache.add_absent({"guild_id": 1})
+        cache._absent[1] -= 400
+        assert cache.cleanup() == 1
+
+    def test_stats(self, cache):
+        cache.add({"guild_id": 1})
+        cache.lookup({"guild_id": 1})
+        cache.lookup({"guild_id": 2})
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_ratio"] == 0.5
+
+
+class TestCacheLimits:
+    def test_max_entries_evicts_least_recently_used(self):
+        cache = Cache(primary_key="guild_id", max_entries=2)
+        cache.add({"guild_id": 1})
+        cache.add({"guild_id": 2})
+        cache.get_one({"guild_id": 1})  # 2 is now least recently used
+        cache.add({"guild_id": 3})
+        assert cache.get_one({"guild_id": 2}) is None
+        assert cache.get_one({"guild_id": 1}) is not None
+        assert cache.get_one({"guild_id": 3}) is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_max_bytes(self):
+        doc = {"guild_id": 1, "whitelist": list(range(100))}
+        cache = Cache(primary_key="guild_id")
+        cache.add(doc)
+        one = cache.stats()["bytes"]
+        cache.set_limits(max_bytes=one * 2)
+        for i in range(2, 6):
+            cache.add({**doc, "guild_id": i})
+        stats = cache.stats()
+        assert stats["entries"] == 2
+        assert stats["bytes"] <= one * 2
+        assert stats["evictions"] == 3
+
+    def test_byte_accounting_follows_removals(self, cache):
+        cache.add({"guild_id": 1, "name": "x" * 100})
+        cache.add({"guild_id": 2})
+        cache.update({"guild_id": 1}, {"$set": {"name": "y"}})
+        cache.remove({"guild_id": 2})
+        cache.add_absent({"guild_id": 1})
+        assert cache.stats()["bytes"] == 0
+        cache.add({"guild_id": 3})
+        cache.clear()
+        assert cache.stats()["bytes"] == 0
+
+    def test_set_limits_evicts_immediately(self, cache):
+        for i in range(5):
+            cache.add({"guild_id": i})
+        cache.set_limits(max_entries=3)
+        assert cache.stats()["entries"] == 3
+        assert cache.get_one({"guild_id": 0}) is None
+
+    def test_absent_entries_capped(self):
+        cache = Cache(primary_key="guild_id", max_entries=2)
+        for i in range(4):
+            cache.add_absent({"guild_id": i})
+        assert cache.stats()["absent_entries"] == 2
+        assert cache.lookup({"guild_id": 3}) == (True, None)
+        assert cache.lookup({"guild_id": 0}) == (False, None)
+
+
+class TestCacheCompoundKey:
+    @pytest.fixture
+    def cache(self):
+        return Cache(primary_key=("user_id", "guild_id"))
+
+    def test_keyed_on_all_fields(self, cache):
+        cache.add({"user_id": 1, "guild_id": 10, "n": 1})
+        cache.add({"user_id": 1, "guild_id": 20, "n": 2})
+        assert cache.get_one({"user_id": 1, "guild_id": 10})["n"] == 1
+        assert cache.get_one({"user_id": 1, "guild_id": 20})["n"] == 2
+
+    def test_partial_query_bypasses_cache(self, cache):
+        cache.add({"user_id": 1, "guild_id": 10})
+        assert cache.get_one({"user_id": 1}) is None
+        assert cache.get_one({"user_id": 1, "guild_id": 10, "x": 1}) is None
+
+    def test_doc_missing_a_key_field_not_cached(self, cache):
+        cache.add({"user_id": 1})
+        assert cache.stats()["entries"] == 0
+
+    def test_absent_and_update(self, cache):
+        cache.add_absent({"user_id": 1, "guild_id": 10})
+        assert cache.lookup({"user_id": 1, "guild_id": 10}) == (True, None)
+        cache.add({"user_id": 2, "guild_id": 10, "warns": []})
+        cache.update({"user_id": 2, "guild_id": 10}, {"$push": {"warns": "a"}})
+        assert cache.get_one({"user_id": 2, "guild_id": 10})["warns"] == ["a"]
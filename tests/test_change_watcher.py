@@ -0,0 +1,227 @@
+"""Tests for utils/change_watcher.py, against an in-memory replica set stand-in."""
+import asyncio
+import pytest
+import sys, pathlib
+from unittest.mock import AsyncMock, MagicMock
+
+_loop = asyncio.new_event_loop()
+def run(coro):
+    return _loop.run_until_complete(coro)
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from utils.change_watcher import ChangeWatcher
+from utils.database import Collection, Schemas
+
+
+class FakeStream:
+    def __init__(self, events):
+        self._events = events
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._events:
+            await asyncio.sleep(0)  # a real stream would wait on the server here
+            raise StopAsyncIteration
+        event = self._events.pop(0)
+        if isinstance(event, Exception):
+            raise event
+        self.resume_token = event["_id"]
+        return event
+
+
+class FakeReplicaSet:
+    """Records writes as change events; each watch() replays the oplog after the
+    given resume token, then runs out (or raises whatever was queued with fail)."""
+
+    def __init__(self):
+        self.oplog = []
+        self.watch_calls = []
+        self._failures = []
+
+    def _emit(self, event):
+        event["_id"] = {"_data": len(self.oplog)}
+        self.oplog.append(event)
+
+    def update(self, coll, doc):
+        self._emit({"operationType": "update", "ns": {"db": "kidney", "coll": coll},
+                    "documentKey": {"_id": doc["_id"]}, "fullDocument": doc})
+
+    def delete(self, coll, doc_id, **shard_key):
+        self._emit({"operationType": "delete", "ns": {"db": "kidney", "coll": coll},
+                    "documentKey": {"_id": doc_id, **shard_key}})
+
+    def fail(self, error):
+        self._failures.append(error)
+
+    async def watch(self, pipeline, full_document=None, resume_after=None):
+        self.watch_calls.append(resume_after)
+        start = 0 if resume_after is None else resume_after["_data"] + 1
+        events = list(self.oplog[start:])
+        if self._failures:
+            error = self._failures.pop(0)
+            if isinstance(error, OperationFailure):
+                raise error
+            events.append(error)
+        return FakeStream(events)
+
+
+def make_collection(name="automodsettings"):
+    mongo_col = MagicMock()
+    mongo_col.name = name
+    return Collection(mongo_col, primary_key="guild_id", schema_class=Schemas.AutoModSettings)
+
+
+@pytest.fixture
+def col():
+    return make_collection()
+
+
+def drain(watcher):
+    """Run the watcher until it has consumed the oplog and the stream ends."""
+    run(watcher._watch())
+
+
+class TestChangeEvents:
+    def test_update_refreshes_cached_document(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1, "log_channel": 100})
+        rs = FakeReplicaSet()
+        rs.update("automodsettings", {"_id": "a", "guild_id": 1, "log_channel": 200})
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.get_one({"guild_id": 1})["log_channel"] == 200
+
+    def test_uncached_keys_are_not_added(self, col):
+        rs = FakeReplicaSet()
+        rs.update("automodsettings", {"_id": "a", "guild_id": 1})
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.stats()["entries"] == 0
+
+    def test_insert_over_absent_marker(self, col):
+        col.cache.add_absent({"guild_id": 1})
+        rs = FakeReplicaSet()
+        rs.update("automodsettings", {"_id": "a", "guild_id": 1, "log_channel": 5})
+        drain(ChangeWatcher(rs, [col]))
+        assert run(col.get(1)).log_channel == 5
+
+    def test_delete_drops_document(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1})
+        col.cache.add({"_id": "b", "guild_id": 2})
+        rs = FakeReplicaSet()
+        rs.delete("automodsettings", "a")
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.get_one({"guild_id": 1}) is None
+        assert col.cache.get_one({"guild_id": 2}) is not None
+
+    def test_delete_of_unknown_id_keeps_saved_documents(self, col):
+        col.cache.add({"guild_id": 1})
+        rs = FakeReplicaSet()
+        rs.delete("automodsettings", "a")
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.get_one({"guild_id": 1}) is not None
+
+    def test_delete_falls_back_to_shard_key(self, col):
+        col.cache.add({"guild_id": 1})
+        rs = FakeReplicaSet()
+        rs.delete("automodsettings", "a", guild_id=1)
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.get_one({"guild_id": 1}) is None
+
+    def test_pending_write_wins(self, col):
+        col._pending[1] = {"guild_id": 1, "log_channel": 1}
+        col.cache.add({"_id": "a", "guild_id": 1, "log_channel": 1})
+        rs = FakeReplicaSet()
+        rs.update("automodsettings", {"_id": "a", "guild_id": 1, "log_channel": 2})
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.get_one({"guild_id": 1})["log_channel"] == 1
+
+    def test_other_collections_ignored(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1, "log_channel": 1})
+        rs = FakeReplicaSet()
+        rs.update("currency", {"_id": "a", "guild_id": 1, "log_channel": 2})
+        drain(ChangeWatcher(rs, [col]))
+        assert col.cache.get_one({"guild_id": 1})["log_channel"] == 1
+
+    def test_invalidate_clears_everything(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1})
+        watcher = ChangeWatcher(FakeReplicaSet(), [col])
+        watcher.apply({"operationType": "invalidate"})
+        assert col.cache.stats()["entries"] == 0
+
+
+class TestResume:
+    def test_resumes_after_last_event_on_disconnect(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1, "log_channel": 0})
+        rs = FakeReplicaSet()
+        rs.update("automodsettings", {"_id": "a", "guild_id": 1, "log_channel": 1})
+        rs.fail(AutoReconnect("connection reset"))
+        watcher = ChangeWatcher(rs, [col], retry_delay=0)
+
+        async def scenario():
+            task = asyncio.ensure_future(watcher.run())
+            while len(rs.watch_calls) < 2:
+                await asyncio.sleep(0)
+            # Written while disconnected: must still arrive after the resume
+            rs.update("automodsettings", {"_id": "a", "guild_id": 1, "log_channel": 2})
+            while len(rs.watch_calls) < 3:
+                await asyncio.sleep(0)
+            task.cancel()
+
+        run(scenario())
+        assert rs.watch_calls[:2] == [None, {"_data": 0}]
+        assert col.cache.get_one({"guild_id": 1})["log_channel"] == 2
+
+    def test_lost_history_clears_caches(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1})
+        rs = FakeReplicaSet()
+        rs.fail(OperationFailure("resume point no longer in oplog", code=286))
+        watcher = ChangeWatcher(rs, [col], retry_delay=0)
+        watcher.resume_token = {"_data": 99}
+
+        async def scenario():
+            task = asyncio.ensure_future(watcher.run())
+            while len(rs.watch_calls) < 2:
+                await asyncio.sleep(0)
+            task.cancel()
+
+        run(scenario())
+        assert rs.watch_calls == [{"_data": 99}, None]
+        assert col.cache.stats()["entries"] == 0
+
+
+class TestPollingFallback:
+    def test_standalone_server_polls(self, col):
+        col.cache.add({"_id": "a", "guild_id": 1, "log_channel": 1})
+        col.cache.add({"_id": "b", "guild_id": 2})
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[{"_id": "a", "guild_id": 1, "log_channel": 9}])
+        col.collection.find = MagicMock(return_value=cursor)
+
+        db = MagicMock()
+        db.watch = AsyncMock(side_effect=OperationFailure("The $changeStream stage is only supported on "
+                                                          "replica sets", code=40573))
+        watcher = ChangeWatcher(db, [col], poll_interval=0)
+
+        async def scenario():
+            task = asyncio.ensure_future(watcher.run())
+            while not col.collection.find.called:
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            task.cancel()
+
+        run(scenario())
+        assert watcher.polling
+        assert col.collection.find.call_args.args[0] == {"guild_id": {"$in": [1, 2]}}
+        assert col.cache.get_one({"guild_id": 1})["log_channel"] == 9
+        assert run(col.get(2)) is None
+        col.collection.find_one.assert_not_called()
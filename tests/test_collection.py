@@ -2,7 +2,7 @@
 import asyncio
 import pytest
 import sys, pathlib
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock, MagicMock, patch
 
 _loop = asyncio.new_event_loop()
 def run(coro):
@@ -10,38 +10,88 @@ def run(coro):
 
 sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
 
-from utils.database import Collection, Schemas
+from pymongo.errors import DuplicateKeyError, ServerSelectionTimeoutError
 
+from utils.database import Collection, Database, Schemas
+from utils.local_storage import LocalClient
 
-def make_collection(primary_key="guild_id", schema_class=None, docs=None, legacy_pk=None):
-    """Return a Collection wired to a mock pymongo collection."""
+# Behaviour is tested against the embedded stores, which store for real; tests
+# that inject failures or slow replies use a mock answering with canned values.
+STORES = ["memory", "sqlite"]
+
+
+def _cursor(docs):
+    cursor = MagicMock()
+    cursor.to_list = AsyncMock(return_value=docs)
+    return cursor
+
+
+def mock_collection(primary_key="guild_id", schema_class=None, legacy_pk=None):
+    """Return a Collection wired to a mock pymongo collection that finds nothing."""
     mongo_col = MagicMock()
     mongo_col.find_one = AsyncMock(return_value=None)
     mongo_col.replace_one = AsyncMock()
     mongo_col.insert_one = AsyncMock()
     mongo_col.delete_one = AsyncMock(return_value=MagicMock(deleted_count=1))
     mongo_col.count_documents = AsyncMock(return_value=0)
+    mongo_col.update_one = AsyncMock()
+    mongo_col.bulk_write = AsyncMock()
+    mongo_col.find = MagicMock(return_value=_cursor([]))
+    schema = schema_class or Schemas.AutoModSettings
+    return Collection(mongo_col, primary_key=primary_key, schema_class=schema, legacy_pk=legacy_pk)
 
-    cursor = MagicMock()
-    cursor.limit = MagicMock(return_value=cursor)
-    cursor.to_list = AsyncMock(return_value=docs or [])
-    mongo_col.find = MagicMock(return_value=cursor)
 
+def store_collection(backend, primary_key="guild_id", schema_class=None, docs=None, legacy_pk=None):
+    """Return a Collection over a `backend` store holding `docs`. Its methods are
+    AsyncMocks wrapping the store's, so tests can inspect the calls; the store
+    itself is `collection.store`."""
+    store = LocalClient(backend).data.col
+    keys = [primary_key] if isinstance(primary_key, str) else list(primary_key)
+    run(store.create_index([(key, 1) for key in keys], unique=True, sparse=True))
+    for doc in docs or []:
+        run(store.insert_one(dict(doc)))
+    mongo_col = MagicMock()
+    mongo_col.store = store
+    mongo_col.name = store.name
+    for name in ("find_one", "replace_one", "insert_one", "delete_one", "count_documents",
+                 "estimated_document_count", "update_one", "find_one_and_update", "bulk_write"):
+        setattr(mongo_col, name, AsyncMock(wraps=getattr(store, name)))
+    mongo_col.find = MagicMock(wraps=store.find)
     schema = schema_class or Schemas.AutoModSettings
     return Collection(mongo_col, primary_key=primary_key, schema_class=schema, legacy_pk=legacy_pk)
 
 
+def plain(doc):
+    """`doc` without the `_id` the store assigned."""
+    return doc if doc is None else {k: v for k, v in doc.items() if k != "_id"}
+
+
+def stored(col, query):
+    return plain(run(col.collection.store.find_one(query)))
+
+
+@pytest.fixture(params=STORES)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def make_collection(backend):
+    def make(primary_key="guild_id", schema_class=None, docs=None, legacy_pk=None):
+        return store_collection(backend, primary_key, schema_class, docs, legacy_pk)
+    return make
+
+
 @pytest.fixture
-def col():
+def col(make_collection):
     return make_collection()
 
 
 # ── get ───────────────────────────────────────────────────────────────────────
 
 class TestGet:
-    def test_cache_miss_hits_mongo(self, col):
-        doc = {"guild_id": 1, "log_channel": 100}
-        col.collection.find_one = AsyncMock(return_value=doc)
+    def test_cache_miss_hits_mongo(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1, "log_channel": 100}])
         result = run(col.get(1))
         assert isinstance(result, Schemas.AutoModSettings)
         assert result.log_channel == 100
@@ -55,66 +105,154 @@ class TestGet:
         col.collection.find_one.assert_not_called()
 
     def test_mongo_none_returns_none(self, col):
-        col.collection.find_one = AsyncMock(return_value=None)
         assert run(col.get(99)) is None
 
-    def test_result_cached(self, col):
-        doc = {"guild_id": 2}
-        col.collection.find_one = AsyncMock(return_value=doc)
+    def test_result_cached(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 2}])
         run(col.get(2))
-        assert col.cache.get_one({"guild_id": 2}) == doc
+        assert plain(col.cache.get_one({"guild_id": 2})) == {"guild_id": 2}
 
-    def test_extra_filters_bypass_cache(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema)
+    def test_extra_filters_bypass_cache(self, make_collection):
         doc = {"user_id": 7, "guild_id": 8, "warns": []}
-        col.collection.find_one = AsyncMock(return_value=doc)
+        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema, docs=[doc])
         col.cache.add(doc)
         run(col.get(7, guild_id=8))
         col.collection.find_one.assert_called_once()
 
+    def test_miss_cached_as_absent(self, col):
+        assert run(col.get(3)) is None
+        assert run(col.get(3)) is None
+        col.collection.find_one.assert_called_once()
+        assert col.cache.negative_hits == 1
+
+    def test_save_invalidates_absent(self, col):
+        run(col.get(3))
+        run(col.save(Schemas.AutoModSettings(guild_id=3, log_channel=5)))
+        assert run(col.get(3)).log_channel == 5
+
+    def test_delete_invalidates_absent(self, col):
+        run(col.get(3))
+        run(col.delete(3))
+        # Written by another process
+        run(col.collection.store.insert_one({"guild_id": 3}))
+        assert run(col.get(3)) is not None
+
+    def test_extra_filter_miss_not_cached(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema)
+        run(col.get(7, guild_id=8))
+        assert len(col.cache._absent) == 0
+
 
 # ── all ───────────────────────────────────────────────────────────────────────
 
 class TestAll:
-    def test_returns_schema_objects(self):
-        docs = [{"guild_id": i, "log_channel": i * 10} for i in range(3)]
-        col = make_collection(docs=docs)
-        col.collection.find.return_value.to_list = AsyncMock(return_value=docs)
+    def test_returns_schema_objects(self, make_collection):
+        col = make_collection(docs=[{"guild_id": i, "log_channel": i * 10} for i in range(3)])
         results = run(col.all())
         assert len(results) == 3
         assert all(isinstance(r, Schemas.AutoModSettings) for r in results)
 
-    def test_limit_applied(self, col):
-        run(col.all(limit=50))
-        col.collection.find.return_value.limit.assert_called_once_with(50)
+    def test_limit_applied(self, make_collection):
+        col = make_collection(docs=[{"guild_id": i} for i in range(60)])
+        assert len(run(col.all(limit=50))) == 50
 
     def test_empty_collection(self, col):
-        col.collection.find.return_value.to_list = AsyncMock(return_value=[])
         assert run(col.all()) == []
 
 
+class TestIter:
+    def _collect(self, col, **kwargs):
+        async def go():
+            return [obj async for obj in col.iter(**kwargs)]
+        return run(go())
+
+    def test_streams_every_batch(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1, "log_channel": 5}, {"guild_id": 2, "log_channel": 5},
+                                    {"guild_id": 3, "log_channel": 5}, {"guild_id": 4, "log_channel": 6}])
+        results = self._collect(col, filter={"log_channel": 5}, batch_size=2)
+        assert [r.guild_id for r in results] == [1, 2, 3]
+        col.collection.find.assert_called_once_with({"log_channel": 5}, None, batch_size=2)
+
+    def test_fills_cache(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}])
+        self._collect(col)
+        assert plain(col.cache.get_one({"guild_id": 1})) == {"guild_id": 1}
+
+    def test_skip_cache_fill(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}])
+        self._collect(col, fill_cache=False)
+        assert col.cache.stats()["entries"] == 0
+
+    def test_decodes_lazily(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}, {"guild_id": 2}])
+
+        async def first():
+            async for obj in col.iter(batch_size=1):
+                return obj
+            return None
+        assert run(first()).guild_id == 1
+        # The second batch was never fetched
+        assert col.cache.get_one({"guild_id": 2}) is None
+
+    def test_yields_unflushed_saves(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1, "log_channel": 1}])
+        col._write_behind = 60
+        run(col.save(Schemas.AutoModSettings(guild_id=1, log_channel=2)))
+        assert self._collect(col)[0].log_channel == 2
+        col._flush_task.cancel()
+
+
 # ── save ──────────────────────────────────────────────────────────────────────
 
 class TestSave:
-    def test_insert_when_not_found(self, col):
-        col.collection.find_one = AsyncMock(return_value=None)
+    def test_upsert_when_no_legacy_pk(self, col):
         schema = Schemas.AutoModSettings(guild_id=5, log_channel=999)
         run(col.save(schema))
-        col.collection.insert_one.assert_called_once()
-        args = col.collection.insert_one.call_args[0][0]
-        assert args["guild_id"] == 5
-
-    def test_replace_when_existing(self, col):
-        existing = {"guild_id": 5, "_id": "abc123"}
-        col.collection.find_one = AsyncMock(return_value=existing)
-        schema = Schemas.AutoModSettings(guild_id=5, log_channel=42)
+        col.collection.replace_one.assert_called_once_with({"guild_id": 5}, schema.to_dict(), upsert=True)
+        col.collection.find_one.assert_not_called()
+        col.collection.insert_one.assert_not_called()
+        assert stored(col, {"guild_id": 5}) == schema.to_dict()
+
+    def test_migrated_keys_only_tracked_with_legacy_pk(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}, {"guild_id": 2}])
+        run(col.get(1))
+        run(col.get_many([2]))
+        run(col.save(Schemas.AutoModSettings(guild_id=3)))
+        assert col._migrated == set()
+
+    def test_unmigrated_key_tries_plain_replace_first(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"user_id": "7", "wallet": 0}])
+        schema = Schemas.Currency(user_id="7", wallet=1)
+        run(col.save(schema))
+        col.collection.replace_one.assert_called_once_with({"user_id": "7"}, schema.to_dict())
+        col.collection.find_one.assert_not_called()
+        assert stored(col, {"user_id": "7"}) == schema.to_dict()
+
+    def test_upsert_when_nothing_exists(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID")
+        schema = Schemas.Currency(user_id="7", wallet=1)
         run(col.save(schema))
+        assert col.collection.replace_one.call_args_list[-1] == (({"user_id": "7"}, schema.to_dict()), {"upsert": True})
+        assert stored(col, {"user_id": "7"}) == schema.to_dict()
+
+    def test_migrated_key_takes_one_round_trip(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"user_id": "7", "wallet": 1}])
+        run(col.get("7"))
+        col.collection.find_one.reset_mock()
+        run(col.save(Schemas.Currency(user_id="7", wallet=2)))
+        col.collection.find_one.assert_not_called()
         col.collection.replace_one.assert_called_once()
-        filter_arg = col.collection.replace_one.call_args[0][0]
-        assert filter_arg == {"_id": "abc123"}
+        assert col.collection.replace_one.call_args[1] == {"upsert": True}
+
+    def test_duplicate_key_race_is_retried(self):
+        col = mock_collection()
+        col.collection.replace_one = AsyncMock(side_effect=[DuplicateKeyError("dup"), MagicMock()])
+        run(col.save(Schemas.AutoModSettings(guild_id=5)))
+        assert col.collection.replace_one.call_count == 2
 
     def test_cache_updated_after_save(self, col):
-        col.collection.find_one = AsyncMock(return_value=None)
         schema = Schemas.AutoModSettings(guild_id=10, log_channel=1)
         run(col.save(schema))
         cached = col.cache.get_one({"guild_id": 10})
@@ -125,29 +263,31 @@ class TestSave:
 # ── delete ────────────────────────────────────────────────────────────────────
 
 class TestDelete:
-    def test_mongo_delete_called(self, col):
+    def test_mongo_delete_called(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}])
         run(col.delete(1))
         col.collection.delete_one.assert_called_once_with({"guild_id": 1})
+        assert stored(col, {"guild_id": 1}) is None
 
     def test_cache_entry_removed(self, col):
         col.cache.add({"guild_id": 1})
         run(col.delete(1))
         assert col.cache.get_one({"guild_id": 1}) is None
 
-    def test_extra_filters(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema)
-        col.collection.delete_one = AsyncMock(return_value=MagicMock(deleted_count=0))
+    def test_extra_filters(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema,
+                              docs=[{"user_id": 7, "guild_id": 9}])
         run(col.delete(7, guild_id=8))
         assert col.collection.delete_one.call_count == 1
+        assert stored(col, {"user_id": 7}) is not None
 
 
 # ── legacy_pk fallback ────────────────────────────────────────────────────────
 
 class TestLegacyPk:
-    def test_get_falls_back_to_legacy_field(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID")
-        legacy_doc = {"userID": "7", "wallet": "1200", "bank": "0"}
-        col.collection.find_one = AsyncMock(side_effect=[None, legacy_doc])
+    def test_get_falls_back_to_legacy_field(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"userID": "7", "wallet": "1200", "bank": "0"}])
         result = run(col.get("7"))
         assert result is not None
         assert result.wallet == 1200
@@ -155,58 +295,54 @@ class TestLegacyPk:
         assert calls[0][0][0] == {"user_id": "7"}
         assert calls[1][0][0] == {"userID": "7"}
 
-    def test_get_legacy_not_cached_under_new_pk(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID")
-        legacy_doc = {"userID": "7", "wallet": "100", "bank": "0"}
-        col.collection.find_one = AsyncMock(side_effect=[None, legacy_doc])
+    def test_get_legacy_not_cached_under_new_pk(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"userID": "7", "wallet": "100", "bank": "0"}])
         run(col.get("7"))
         assert col.cache.get_one({"user_id": "7"}) is None
 
-    def test_save_migrates_legacy_doc(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID")
-        legacy_doc = {"_id": "abc", "userID": "7", "wallet": "1200", "bank": "0"}
-        col.collection.find_one = AsyncMock(side_effect=[None, legacy_doc])
+    def test_save_migrates_legacy_doc(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"_id": "abc", "userID": "7", "wallet": "1200", "bank": "0"}])
         schema = Schemas.Currency(user_id="7", wallet=1200, bank=0)
         run(col.save(schema))
-        col.collection.replace_one.assert_called_once_with({"_id": "abc"}, schema.to_dict())
+        col.collection.find_one.assert_called_once_with({"userID": "7"})
+        assert col.collection.replace_one.call_args_list[-1][0] == ({"_id": "abc"}, schema.to_dict())
         col.collection.insert_one.assert_not_called()
+        assert "7" in col._migrated
+        assert run(col.collection.store.find_one({"user_id": "7"}))["_id"] == "abc"
+        assert stored(col, {"userID": "7"}) is None
 
-    def test_delete_falls_back_to_legacy_field(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID")
-        col.collection.delete_one = AsyncMock(side_effect=[
-            MagicMock(deleted_count=0),
-            MagicMock(deleted_count=1),
-        ])
+    def test_delete_falls_back_to_legacy_field(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"userID": "7"}])
         run(col.delete("7"))
         assert col.collection.delete_one.call_count == 2
         assert col.collection.delete_one.call_args_list[1][0][0] == {"userID": "7"}
+        assert stored(col, {"userID": "7"}) is None
 
 
 # ── query_one / query_many ────────────────────────────────────────────────────
 
 class TestQueryEscapeHatches:
-    def test_query_one_returns_schema(self):
-        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema)
-        doc = {"user_id": 5, "guild_id": 6, "warns": [{"id": "abc"}]}
-        col.collection.find_one = AsyncMock(return_value=doc)
+    def test_query_one_returns_schema(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema,
+                              docs=[{"user_id": 5, "guild_id": 6, "warns": [{"id": "abc"}]}])
         result = run(col.query_one({"warns.id": "abc"}))
         assert isinstance(result, Schemas.WarnSchema)
         assert result.user_id == 5
 
     def test_query_one_none_when_not_found(self, col):
-        col.collection.find_one = AsyncMock(return_value=None)
         assert run(col.query_one({"complex": "filter"})) is None
 
-    def test_query_many_returns_list_of_schemas(self):
-        docs = [{"user_id": i, "announce_level": 3} for i in range(5)]
+    def test_query_many_returns_list_of_schemas(self, make_collection):
+        docs = [{"user_id": i, "announce_level": 3 if i < 5 else 1} for i in range(7)]
         col = make_collection(primary_key="user_id", schema_class=Schemas.UserConfig, docs=docs)
-        col.collection.find.return_value.to_list = AsyncMock(return_value=docs)
         results = run(col.query_many({"announce_level": {"$gte": 3}}))
         assert len(results) == 5
         assert all(isinstance(r, Schemas.UserConfig) for r in results)
 
     def test_query_many_empty_result(self, col):
-        col.collection.find.return_value.to_list = AsyncMock(return_value=[])
         results = run(col.query_many({"x": 1}))
         assert results == []
 
@@ -214,15 +350,638 @@ class TestQueryEscapeHatches:
 # ── exists / count ────────────────────────────────────────────────────────────
 
 class TestExistsCount:
-    def test_exists_true_when_found(self, col):
-        col.collection.find_one = AsyncMock(return_value={"guild_id": 1})
+    def test_exists_true_when_found(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}])
         assert run(col.exists(1)) is True
 
     def test_exists_false_when_not_found(self, col):
-        col.collection.find_one = AsyncMock(return_value=None)
         assert run(col.exists(99)) is False
 
-    def test_count_calls_mongo(self, col):
-        col.collection.count_documents = AsyncMock(return_value=7)
+    def test_count_calls_mongo(self, make_collection):
+        col = make_collection(docs=[{"guild_id": i} for i in range(7)])
         result = run(col.count())
         assert result == 7
+
+    def test_count_cached_until_a_write(self, make_collection):
+        col = make_collection(docs=[{"guild_id": i, "log_channel": 5} for i in range(7)])
+        assert run(col.count(log_channel=5)) == run(col.count(log_channel=5)) == 7
+        col.collection.count_documents.assert_awaited_once_with({"log_channel": 5})
+        run(col.count(log_channel=6))
+        assert col.collection.count_documents.await_count == 2
+        run(col.save(Schemas.AutoModSettings(guild_id=7, log_channel=5)))
+        assert run(col.count(log_channel=5)) == 8
+        assert col.collection.count_documents.await_count == 3
+
+    def test_count_cache_expires(self, col):
+        col.count_ttl = 0
+        run(col.count())
+        run(col.count())
+        assert col.collection.count_documents.await_count == 2
+
+    def test_write_during_count_is_not_cached(self):
+        col = mock_collection()
+
+        async def slow_count(filter):
+            await asyncio.sleep(0.01)
+            return 1
+        col.collection.count_documents = AsyncMock(side_effect=slow_count)
+
+        async def race():
+            pending = asyncio.ensure_future(col.count())
+            await asyncio.sleep(0)
+            await col.delete(1)
+            await pending
+
+        run(race())
+        assert col._counts == {}
+
+    def test_estimated_uses_metadata(self, make_collection):
+        col = make_collection(docs=[{"guild_id": i} for i in range(42)])
+        assert run(col.count(estimated=True)) == 42
+        assert run(col.count(estimated=True)) == 42
+        col.collection.estimated_document_count.assert_awaited_once()
+        col.collection.count_documents.assert_not_awaited()
+        with pytest.raises(ValueError):
+            run(col.count(estimated=True, log_channel=5))
+
+    def test_counts_stored_documents(self, col):
+        for guild_id, log_channel in ((1, 5), (2, 5), (3, 6)):
+            run(col.save(Schemas.AutoModSettings(guild_id=guild_id, log_channel=log_channel)))
+        assert run(col.count(log_channel=5)) == 2
+        assert run(col.count(estimated=True)) == 3
+        run(col.delete(1))
+        assert run(col.count(log_channel=5)) == 1
+
+
+# ── single-flight get ─────────────────────────────────────────────────────────
+
+class TestSingleFlight:
+    @staticmethod
+    def _slow_find_one(result=None, error=None):
+        async def find_one(query):
+            await asyncio.sleep(0.01)
+            if error is not None:
+                raise error
+            return result
+        return AsyncMock(side_effect=find_one)
+
+    def test_concurrent_gets_share_one_query(self):
+        col = mock_collection()
+        col.collection.find_one = self._slow_find_one({"guild_id": 1, "log_channel": 5})
+
+        async def burst():
+            return await asyncio.gather(*(col.get(1) for _ in range(10)))
+
+        results = run(burst())
+        assert all(r.log_channel == 5 for r in results)
+        col.collection.find_one.assert_called_once()
+        assert col._inflight == {}
+
+    def test_concurrent_gets_share_legacy_fallback(self):
+        col = mock_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID")
+        col.collection.find_one = AsyncMock(side_effect=[None, {"userID": "7", "wallet": 3}])
+
+        async def burst():
+            return await asyncio.gather(col.get("7"), col.get("7"))
+
+        results = run(burst())
+        assert [r.wallet for r in results] == [3, 3]
+        assert col.collection.find_one.call_count == 2
+
+    def test_error_reaches_every_waiter_and_is_not_cached(self):
+        col = mock_collection()
+        col.collection.find_one = self._slow_find_one(error=RuntimeError("db down"))
+
+        async def burst():
+            return await asyncio.gather(*(col.get(1) for _ in range(3)), return_exceptions=True)
+
+        results = run(burst())
+        assert all(isinstance(r, RuntimeError) for r in results)
+        col.collection.find_one.assert_called_once()
+        assert col.cache.lookup({"guild_id": 1}) == (False, None)
+        assert col._inflight == {}
+
+    def test_write_during_fetch_skips_cache_fill(self):
+        col = mock_collection()
+        col.collection.find_one = self._slow_find_one({"guild_id": 1, "log_channel": 5})
+
+        async def race():
+            pending = asyncio.ensure_future(col.get(1))
+            await asyncio.sleep(0)
+            await col.delete(1)
+            await pending
+
+        run(race())
+        assert col.cache.lookup({"guild_id": 1}) == (False, None)
+
+
+# ── get_many ──────────────────────────────────────────────────────────────────
+
+class TestGetMany:
+    def test_fetches_misses_with_one_in_query(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}, {"guild_id": 2}])
+        results = run(col.get_many([1, 2, 3]))
+        assert set(results) == {1, 2}
+        assert all(isinstance(r, Schemas.AutoModSettings) for r in results.values())
+        col.collection.find.assert_called_once_with({"guild_id": {"$in": [1, 2, 3]}}, None)
+
+    def test_cache_hits_served_locally(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 2}, {"guild_id": 3}])
+        col.cache.add({"guild_id": 1, "log_channel": 10})
+        col.cache.add_absent({"guild_id": 2})
+        results = run(col.get_many([1, 2, 3]))
+        assert set(results) == {1, 3}
+        col.collection.find.assert_called_once_with({"guild_id": {"$in": [3]}}, None)
+
+    def test_no_query_when_everything_cached(self, col):
+        col.cache.add({"guild_id": 1})
+        run(col.get_many([1, 1]))
+        col.collection.find.assert_not_called()
+
+    def test_fills_cache_and_absent_markers(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1}])
+        run(col.get_many([1, 2]))
+        found, doc = col.cache.lookup({"guild_id": 1})
+        assert found and plain(doc) == {"guild_id": 1}
+        assert col.cache.lookup({"guild_id": 2}) == (True, None)
+
+    def test_chunks_large_key_sets(self, col):
+        run(col.get_many(range(25), chunk_size=10))
+        assert col.collection.find.call_count == 3
+
+    def test_legacy_fallback_for_leftovers(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"user_id": "1", "wallet": 1}, {"userID": "2", "wallet": 2}])
+        results = run(col.get_many(["1", "2"]))
+        assert results["2"].wallet == 2
+        assert col.collection.find.call_args_list[1][0][0] == {"userID": {"$in": ["2"]}}
+        # legacy docs are not cached under the new pk
+        assert col.cache.lookup({"user_id": "2"}) == (False, None)
+
+
+# ── update ────────────────────────────────────────────────────────────────────
+
+class TestUpdate:
+    def test_single_upsert(self, col):
+        result = run(col.update(1, inc={"count": 1}, set={"log_channel": 5}))
+        assert result is None
+        col.collection.update_one.assert_called_once_with(
+            {"guild_id": 1}, {"$inc": {"count": 1}, "$set": {"log_channel": 5}}, upsert=True)
+        col.collection.find_one.assert_not_called()
+        assert stored(col, {"guild_id": 1}) == {"guild_id": 1, "count": 1, "log_channel": 5}
+
+    def test_requires_an_operator(self, col):
+        with pytest.raises(ValueError):
+            run(col.update(1))
+
+    def test_applies_change_to_cached_copy(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1, "whitelist": [1]}])
+        col.cache.add({"guild_id": 1, "whitelist": [1]})
+        run(col.update(1, push={"whitelist": 2}))
+        assert run(col.get(1)).whitelist == [1, 2]
+        assert stored(col, {"guild_id": 1})["whitelist"] == [1, 2]
+
+    def test_clears_absent_marker(self, col):
+        col.cache.add_absent({"guild_id": 1})
+        run(col.update(1, set={"log_channel": 5}))
+        assert col.cache.lookup({"guild_id": 1}) == (False, None)
+
+    def test_return_document(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency,
+                              docs=[{"user_id": "7", "wallet": 10}])
+        result = run(col.update("7", inc={"wallet": 5}, return_document=True))
+        assert result.wallet == 15
+        assert col.collection.find_one_and_update.call_args[1]["upsert"] is True
+        assert plain(col.cache.get_one({"user_id": "7"})) == {"user_id": "7", "wallet": 15}
+
+    def test_extra_filters_invalidate_cache(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.WarnSchema)
+        col.cache.add({"user_id": 7, "guild_id": 1, "warns": []})
+        run(col.update(7, push={"warns": {"id": "a"}}, guild_id=2))
+        assert col.collection.update_one.call_args[0][0] == {"user_id": 7, "guild_id": 2}
+        assert col.cache.get_one({"user_id": 7}) is None
+
+    def test_migrates_legacy_key_first(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"userID": "7", "wallet": 1}])
+        run(col.update("7", inc={"wallet": 1}))
+        run(col.update("7", inc={"wallet": 1}))
+        calls = col.collection.update_one.call_args_list
+        assert calls[0][0] == ({"userID": "7", "user_id": {"$exists": False}},
+                               {"$set": {"user_id": "7"}, "$unset": {"userID": ""}})
+        assert len(calls) == 3
+        assert stored(col, {"user_id": "7"}) == {"user_id": "7", "wallet": 3}
+
+    def test_overlapping_updates_drop_cached_copy(self):
+        col = mock_collection(primary_key="user_id", schema_class=Schemas.Currency)
+        replies = [{"user_id": "7", "wallet": 1}, {"user_id": "7", "wallet": 2}]
+
+        async def find_one_and_update(*args, **kwargs):
+            reply = replies.pop(0)
+            if reply["wallet"] == 1:
+                # The first write's reply arrives after the second's
+                for _ in range(3):
+                    await asyncio.sleep(0)
+            return reply
+
+        async def both():
+            await asyncio.gather(col.update("7", inc={"wallet": 1}, return_document=True),
+                                 col.update("7", inc={"wallet": 1}, return_document=True))
+
+        col.collection.find_one_and_update = AsyncMock(side_effect=find_one_and_update)
+        run(both())
+        assert col.cache.get_one({"user_id": "7"}) is None
+
+    def test_update_if_applies_when_condition_holds(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency,
+                              docs=[{"user_id": "7", "wallet": 10}])
+        result = run(col.update_if("7", {"wallet": {"$gte": 5}}, inc={"wallet": -5}))
+        assert result.wallet == 5
+        call = col.collection.find_one_and_update.call_args
+        assert call[0][0] == {"user_id": "7", "wallet": {"$gte": 5}}
+        assert "upsert" not in call[1]
+        assert col.cache.get_one({"user_id": "7"})["wallet"] == 5
+
+    def test_update_if_declined_drops_cached_copy(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency,
+                              docs=[{"user_id": "7", "wallet": 3}])
+        col.cache.add({"user_id": "7", "wallet": 100})
+        assert run(col.update_if("7", {"wallet": {"$gte": 5}}, inc={"wallet": -5})) is None
+        assert col.cache.get_one({"user_id": "7"}) is None
+        assert stored(col, {"user_id": "7"})["wallet"] == 3
+
+    def test_inc_many_is_one_bulk_write(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency,
+                              docs=[{"user_id": "7", "wallet": 1}])
+        col.cache.add({"user_id": "7", "wallet": 1})
+        col.cache.add_absent({"user_id": "8"})
+        run(col.inc_many({"7": {"wallet": 5}, "8": {"wallet": 5}, "9": {}}))
+        col.collection.bulk_write.assert_awaited_once()
+        ops = col.collection.bulk_write.call_args[0][0]
+        assert [(op._filter, op._doc, op._upsert) for op in ops] == [
+            ({"user_id": "7"}, {"$inc": {"wallet": 5}}, True), ({"user_id": "8"}, {"$inc": {"wallet": 5}}, True)]
+        assert col.cache.get_one({"user_id": "7"})["wallet"] == 6
+        assert col.cache.lookup({"user_id": "8"}) == (False, None)
+        assert stored(col, {"user_id": "8"}) == {"user_id": "8", "wallet": 5}
+
+    def test_inc_many_migrates_legacy_keys_together(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"userID": "7", "wallet": 1}])
+        run(col.inc_many({"7": {"wallet": 1}, "8": {"wallet": 1}}))
+        run(col.inc_many({"7": {"wallet": 1}}))
+        calls = col.collection.bulk_write.call_args_list
+        assert [op._filter for op in calls[0][0][0]] == [{"userID": "7", "user_id": {"$exists": False}},
+                                                          {"userID": "8", "user_id": {"$exists": False}}]
+        assert len(calls) == 3
+        assert stored(col, {"user_id": "7"}) == {"user_id": "7", "wallet": 3}
+
+
+# ── write-behind ──────────────────────────────────────────────────────────────
+
+class TestWriteBehind:
+    @pytest.fixture
+    def wb(self, make_collection):
+        col = make_collection(primary_key="guild_id", schema_class=Schemas.MusicQueue)
+        col._write_behind = 0.01
+        return col
+
+    def test_saves_are_coalesced_into_one_bulk_write(self, wb):
+        async def burst():
+            for volume in (0.1, 0.2, 0.3):
+                await wb.save(Schemas.MusicQueue(guild_id=1, volume=volume))
+            await wb.save(Schemas.MusicQueue(guild_id=2))
+            await asyncio.sleep(0.05)
+
+        run(burst())
+        wb.collection.bulk_write.assert_called_once()
+        ops = wb.collection.bulk_write.call_args[0][0]
+        assert [op._doc["volume"] for op in ops if op._filter == {"guild_id": 1}] == [0.3]
+        assert len(ops) == 2
+        stats = wb.write_stats()
+        assert stats["buffered_writes"] == 4
+        assert stats["flushed_writes"] == 2
+        assert stats["coalescing_ratio"] == 2.0
+        wb.collection.replace_one.assert_not_called()
+        assert stored(wb, {"guild_id": 1})["volume"] == 0.3
+
+    def test_reads_see_pending_writes(self, wb):
+        run(wb.save(Schemas.MusicQueue(guild_id=1, volume=0.7)))
+        wb.cache.clear()
+        assert run(wb.get(1)).volume == 0.7
+        assert run(wb.get_many([1]))[1].volume == 0.7
+        wb.collection.find_one.assert_not_called()
+        run(wb.flush())
+
+    def test_queries_flush_first(self, wb):
+        wb._write_behind = 60
+        run(wb.save(Schemas.MusicQueue(guild_id=1, volume=0.7)))
+        assert [q.guild_id for q in run(wb.query_many({"volume": 0.7}))] == [1]
+        wb.collection.bulk_write.assert_awaited_once()
+        run(wb.save(Schemas.MusicQueue(guild_id=2, volume=0.4)))
+        assert run(wb.query_one({"volume": 0.4})).guild_id == 2
+        run(wb.save(Schemas.MusicQueue(guild_id=3, volume=0.2)))
+        assert run(wb.get(3, volume=0.2)).guild_id == 3
+        assert wb.collection.bulk_write.await_count == 3
+
+    def test_delete_flushes_first(self, wb):
+        run(wb.save(Schemas.MusicQueue(guild_id=1)))
+        run(wb.delete(1))
+        wb.collection.bulk_write.assert_awaited_once()
+        run(wb.flush())
+        # Flushed after the delete, the save would have brought the document back
+        assert stored(wb, {"guild_id": 1}) is None
+
+    def test_flush_migrates_legacy_keys_in_one_write(self, make_collection):
+        col = make_collection(primary_key="user_id", schema_class=Schemas.Currency, legacy_pk="userID",
+                              docs=[{"userID": "7", "wallet": 1}, {"userID": "8", "wallet": 1}])
+        col._write_behind = 60
+        run(col.save(Schemas.Currency(user_id="7", wallet=2)))
+        run(col.save(Schemas.Currency(user_id="8", wallet=3)))
+        run(col.flush())
+        col.collection.update_one.assert_not_called()
+        assert col.collection.bulk_write.await_count == 2
+        assert stored(col, {"user_id": "7"}) == {"user_id": "7", "wallet": 2}
+        assert stored(col, {"userID": "8"}) is None
+
+    def test_failed_flush_keeps_documents(self):
+        wb = mock_collection(primary_key="guild_id", schema_class=Schemas.MusicQueue)
+        wb._write_behind = 0.01
+        wb.collection.bulk_write = AsyncMock(side_effect=RuntimeError("db down"))
+        run(wb.save(Schemas.MusicQueue(guild_id=1)))
+        with pytest.raises(RuntimeError):
+            run(wb.flush())
+        assert 1 in wb._pending
+        wb.collection.bulk_write = AsyncMock()
+        run(wb.flush())
+        assert wb._pending == {}
+
+
+# ── decoded-object cache ──────────────────────────────────────────────────────
+
+class TestDecodedCache:
+    def test_hits_reuse_one_decode(self, col):
+        col.cache.add({"guild_id": 1, "whitelist": [1]})
+        with patch.object(Schemas.AutoModSettings, "from_dict", wraps=Schemas.AutoModSettings.from_dict) as decode:
+            col.cache._decode = decode
+            for _ in range(5):
+                run(col.get(1))
+        assert decode.call_count == 1
+
+    def test_mutating_result_does_not_touch_cache(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1, "whitelist": [1]}])
+        run(col.get(1)).whitelist.append(2)
+        run(col.get(1)).whitelist.append(3)
+        assert run(col.get(1)).whitelist == [1]
+
+    def test_mutating_saved_schema_does_not_touch_cache(self, make_collection):
+        col = make_collection(schema_class=Schemas.AutoRoleSettings)
+        schema = Schemas.AutoRoleSettings(guild_id=1, roles=[{"id": 2, "delay": 0}])
+        run(col.save(schema))
+        schema.roles[0]["delay"] = 99
+        assert run(col.get(1)).roles == [{"id": 2, "delay": 0}]
+
+    def test_cache_update_redecodes(self, make_collection):
+        col = make_collection(docs=[{"guild_id": 1, "log_channel": 1}])
+        run(col.get(1))
+        run(col.update(1, set={"log_channel": 2}))
+        assert run(col.get(1)).log_channel == 2
+
+    def test_readonly_returns_shared_frozen_instance(self, col):
+        col.cache.add({"guild_id": 1, "whitelist": [1]})
+        first = run(col.get(1, readonly=True))
+        assert run(col.get(1, readonly=True)) is first
+        with pytest.raises(AttributeError):
+            first.log_channel = 5
+        run(col.get(1)).log_channel = 5
+        assert run(col.get(1)).log_channel is None
+
+    def test_get_many_readonly(self, col):
+        col.cache.add({"guild_id": 1})
+        first = run(col.get_many([1], readonly=True))[1]
+        assert run(col.get_many([1], readonly=True))[1] is first
+        assert run(col.get_many([1]))[1] is not first
+
+
+class TestStaleWhileRevalidate:
+    def _expired(self, col, by):
+        col.cache.add({"guild_id": 1, "log_channel": 1})
+        col.cache._store[1]["ts"] -= 300 + by
+
+    @pytest.fixture
+    def col(self, make_collection):
+        # Changed to log_channel 2 behind the cache's back
+        return make_collection(docs=[{"guild_id": 1, "log_channel": 2}])
+
+    def test_serves_stale_and_refreshes_in_background(self, col):
+        col.cache.set_staleness(stale_ttl=30)
+        self._expired(col, 10)
+        assert run(col.get(1)).log_channel == 1
+        run(asyncio.sleep(0))
+        assert run(col.get(1)).log_channel == 2
+        col.collection.find_one.assert_awaited_once()
+
+    def test_waits_once_past_stale_window(self, col):
+        col.cache.set_staleness(stale_ttl=30)
+        self._expired(col, 60)
+        assert run(col.get(1)).log_channel == 2
+
+    def test_serves_stale_when_database_unreachable(self):
+        col = mock_collection()
+        col.cache.set_staleness(stale_ttl=30, stale_if_error=600)
+        self._expired(col, 60)
+        col.collection.find_one = AsyncMock(side_effect=ServerSelectionTimeoutError("down"))
+        assert run(col.get(1)).log_channel == 1
+
+    def test_error_raised_without_stale_copy(self):
+        col = mock_collection()
+        self._expired(col, 10)
+        col.collection.find_one = AsyncMock(side_effect=ServerSelectionTimeoutError("down"))
+        with pytest.raises(ServerSelectionTimeoutError):
+            run(col.get(1))
+
+    def test_write_drops_stale_entry(self, col):
+        col.cache.set_staleness(stale_ttl=30)
+        self._expired(col, 10)
+        run(col.update(1, set={"log_channel": 5}))
+        assert col.cache.lookup_stale({"guild_id": 1}) is None
+
+    def test_refresh_ahead_for_hot_entries(self, col):
+        col.cache.set_staleness(refresh_ahead=0.8)
+        col.cache.add({"guild_id": 1, "log_channel": 1})
+        for _ in range(3):
+            run(col.get(1))
+        col.cache._store[1]["ts"] -= 250
+        assert run(col.get(1)).log_channel == 1
+        run(asyncio.sleep(0))
+        col.collection.find_one.assert_awaited_once()
+        assert run(col.get(1)).log_channel == 2
+
+    def test_cold_entries_not_refreshed_ahead(self, col):
+        col.cache.set_staleness(refresh_ahead=0.8)
+        col.cache.add({"guild_id": 1, "log_channel": 1})
+        col.cache._store[1]["ts"] -= 250
+        run(col.get(1))
+        run(asyncio.sleep(0))
+        col.collection.find_one.assert_not_awaited()
+
+
+class TestCompoundKey:
+    @pytest.fixture
+    def warnings(self, make_collection):
+        return make_collection(primary_key=("user_id", "guild_id"), schema_class=Schemas.WarnSchema)
+
+    def test_get_is_cached_per_guild(self, make_collection):
+        warnings = make_collection(primary_key=("user_id", "guild_id"), schema_class=Schemas.WarnSchema,
+                                   docs=[{"user_id": 1, "guild_id": 10, "warns": [{"id": "a"}]},
+                                         {"user_id": 1, "guild_id": 20, "warns": [{"id": "b"}]}])
+        for _ in range(2):
+            assert run(warnings.get(1, guild_id=10)).warns == [{"id": "a"}]
+            assert run(warnings.get(1, guild_id=20)).warns == [{"id": "b"}]
+        assert warnings.collection.find_one.await_count == 2
+        warnings.collection.find_one.assert_any_await({"user_id": 1, "guild_id": 10})
+
+    def test_save_upserts_on_full_key(self, warnings):
+        schema = Schemas.WarnSchema(user_id=1, guild_id=10, warns=[{"id": "a"}])
+        run(warnings.save(schema))
+        warnings.collection.replace_one.assert_awaited_once_with(
+            {"user_id": 1, "guild_id": 10}, schema.to_dict(), upsert=True)
+
+    def test_save_does_not_collide_across_guilds(self, warnings):
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=10, warns=[{"id": "a"}])))
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=20, warns=[{"id": "b"}])))
+        assert run(warnings.get(1, guild_id=10)).warns == [{"id": "a"}]
+        warnings.collection.find_one.assert_not_awaited()
+        assert run(warnings.collection.store.count_documents({"user_id": 1})) == 2
+
+    def test_save_needs_every_key_field(self, warnings):
+        with pytest.raises(ValueError):
+            run(warnings.save(Schemas.WarnSchema(user_id=1)))
+
+    def test_partial_key_bypasses_cache(self, warnings):
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=10)))
+        run(warnings.get(1))
+        warnings.collection.find_one.assert_awaited_once_with({"user_id": 1})
+
+    def test_push_updates_cached_doc(self, warnings):
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=10, warns=[{"id": "a"}])))
+        run(warnings.update(1, push={"warns": {"id": "b"}}, guild_id=10))
+        warnings.collection.update_one.assert_awaited_once_with(
+            {"user_id": 1, "guild_id": 10}, {"$push": {"warns": {"id": "b"}}}, upsert=True)
+        assert run(warnings.get(1, guild_id=10)).warns == [{"id": "a"}, {"id": "b"}]
+        assert stored(warnings, {"user_id": 1, "guild_id": 10})["warns"] == [{"id": "a"}, {"id": "b"}]
+
+    def test_returned_document_is_cached(self, warnings):
+        run(warnings.update(1, push={"warns": {"id": "a"}}, return_document=True, guild_id=10))
+        assert run(warnings.get(1, guild_id=10)).warns == [{"id": "a"}]
+        warnings.collection.find_one.assert_not_awaited()
+
+    def test_delete_only_drops_that_guild(self, warnings):
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=10)))
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=20)))
+        run(warnings.delete(1, guild_id=10))
+        warnings.collection.delete_one.assert_awaited_once_with({"user_id": 1, "guild_id": 10})
+        assert run(warnings.get(1, guild_id=20)) is not None
+        run(warnings.get(1, guild_id=10))
+        warnings.collection.find_one.assert_awaited_once_with({"user_id": 1, "guild_id": 10})
+
+    def test_partial_key_write_clears_cache(self, warnings):
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=10)))
+        run(warnings.delete(1))
+        assert warnings.cache.stats()["entries"] == 0
+
+    def test_get_many_rejects_short_keys(self, warnings):
+        with pytest.raises(ValueError):
+            run(warnings.get_many([(1,)]))
+        warnings.collection.find.assert_not_called()
+
+    def test_get_many_with_tuples(self, warnings):
+        run(warnings.save(Schemas.WarnSchema(user_id=1, guild_id=10)))
+        run(warnings.collection.store.insert_one({"user_id": 2, "guild_id": 10}))
+        result = run(warnings.get_many([(1, 10), (2, 10), (3, 10)]))
+        assert set(result) == {(1, 10), (2, 10)}
+        warnings.collection.find.assert_called_once_with(
+            {"$or": [{"user_id": 2, "guild_id": 10}, {"user_id": 3, "guild_id": 10}]}, None)
+        assert run(warnings.get(3, guild_id=10)) is None
+        warnings.collection.find_one.assert_not_awaited()
+
+
+class TestProjection:
+    @pytest.fixture
+    def col(self, make_collection):
+        return make_collection(docs=[{"guild_id": 1, "log_channel": 5, "whitelist": [1]}])
+
+    def test_get_miss_fetches_only_fields(self, col):
+        obj = run(col.get(1, fields=["log_channel"]))
+        assert obj.log_channel == 5 and obj.is_partial
+        assert obj.whitelist is None
+        col.collection.find_one.assert_awaited_once_with(
+            {"guild_id": 1}, {"log_channel": 1, "guild_id": 1, "guild": 1, "_id": 0})
+        assert col.cache.stats()["entries"] == 0
+
+    def test_get_hit_uses_full_cached_doc(self, col):
+        col.cache.add({"guild_id": 1, "log_channel": 5, "whitelist": [1]})
+        obj = run(col.get(1, fields=["log_channel"]))
+        assert obj.whitelist == [1] and not obj.is_partial
+        col.collection.find_one.assert_not_awaited()
+
+    def test_get_miss_caches_absence(self, col):
+        assert run(col.get(2, fields=["log_channel"])) is None
+        assert run(col.get(2)) is None
+        col.collection.find_one.assert_awaited_once()
+
+    def test_partial_schema_cannot_be_saved(self, col):
+        obj = run(col.get(1, fields=["log_channel"]))
+        with pytest.raises(ValueError):
+            run(col.save(obj))
+        with pytest.raises(ValueError):
+            run(col.save(obj.copy()))
+        col.collection.replace_one.assert_not_awaited()
+
+    def test_query_one_and_many(self, col):
+        assert run(col.query_one({"log_channel": 5}, fields=["log_channel"])).is_partial
+        col.collection.find_one.assert_awaited_once_with(
+            {"log_channel": 5}, {"log_channel": 1, "guild_id": 1, "guild": 1, "_id": 0})
+        assert all(o.is_partial for o in run(col.query_many({}, fields=["log_channel"])))
+
+    def test_projection_reads_aliased_fields(self, make_collection):
+        col = make_collection(schema_class=Schemas.AutoRoleSettings,
+                              docs=[{"guild": 1, "BotsGetRoles": True, "roles": []}], legacy_pk="guild")
+        obj = run(col.get(1, fields=["bots_get_roles"]))
+        assert obj.guild_id == 1 and obj.bots_get_roles is True and obj.roles is None
+
+    def test_get_many_projects_misses_only(self, col):
+        col.cache.add({"guild_id": 3, "log_channel": 7, "whitelist": [2]})
+        result = run(col.get_many([1, 2, 3], fields=["log_channel"]))
+        assert result[1].is_partial and result[1].log_channel == 5 and result[1].whitelist is None
+        assert not result[3].is_partial and result[3].whitelist == [2]
+        col.collection.find.assert_called_once_with(
+            {"guild_id": {"$in": [1, 2]}}, {"log_channel": 1, "guild_id": 1, "guild": 1, "_id": 0})
+        assert run(col.get(2)) is None
+        col.collection.find_one.assert_not_awaited()
+        assert col.cache.stats()["entries"] == 1
+
+    def test_iter_with_fields_skips_cache(self, col):
+        async def go():
+            return [o async for o in col.iter(fields=["log_channel"])]
+        assert run(go())[0].is_partial
+        assert col.cache.stats()["entries"] == 0
+
+
+class TestWarmUp:
+    def test_loads_guild_settings_into_cache(self, make_collection):
+        db = Database("mongodb://unused")
+        db.automodsettings = make_collection(docs=[{"guild_id": 1, "log_channel": 5}])
+        db.autorolesettings = make_collection(schema_class=Schemas.AutoRoleSettings)
+        db.guild_config = make_collection(schema_class=Schemas.GuildConfig)
+        db.serverbans = make_collection(primary_key="id", schema_class=Schemas.ServerBans, docs=[{"id": 2}])
+
+        run(db.warm_up([1, 2], chunk_size=1))
+
+        db.automodsettings.collection.find.assert_any_call({"guild_id": {"$in": [1]}}, None)
+        assert db.automodsettings.collection.find.call_count == 2
+        # Found and missing guilds are both answered from the cache afterwards
+        assert run(db.automodsettings.get(1)).log_channel == 5
+        assert run(db.automodsettings.get(2)) is None
+        assert run(db.serverbans.get(2)) is not None
+        for col in (db.automodsettings, db.serverbans):
+            col.collection.find_one.assert_not_awaited()
@@ -0,0 +1,91 @@
+"""Tests for cogs/economy.py's UserProfile snapshot, against the in-memory storage backend."""
+import pytest
+import sys, pathlib
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+from tests.conftest import run
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from cogs.economy import Item, UserProfile
+from utils.transactions import TransactionDeclined, Transactions
+
+
+@pytest.fixture
+def db(db):
+    store = db.currency.collection
+    for name in ("find_one", "update_one", "find_one_and_update"):
+        setattr(store, name, AsyncMock(wraps=getattr(store, name)))
+    return db
+
+
+def make_profile(db, user_id=1):
+    bot = SimpleNamespace(database=db, transactions=Transactions(db))
+    return UserProfile(bot, db, SimpleNamespace(id=user_id, display_name="someone"))
+
+
+def calls(db):
+    store = db.currency.collection
+    return store.find_one.await_count + store.update_one.await_count + store.find_one_and_update.await_count
+
+
+class TestUserProfile:
+    def test_reads_come_from_one_snapshot(self, db):
+        run(Transactions(db).credit("1", wallet=10, bank=5, items={"cookie": 2}))
+        db.currency.cache.clear()
+        profile = make_profile(db)
+        before = calls(db)
+        run(profile.async_init())
+        assert (profile.wallet, profile.bank, profile.inventory) == (10, 5, {"cookie": 2})
+        assert profile.wallet + profile.bank == 15
+        assert calls(db) - before == 1
+
+    def test_missing_document_reads_as_empty(self, db):
+        profile = make_profile(db)
+        run(profile.async_init())
+        assert (profile.wallet, profile.bank, profile.inventory, profile.doc) == (0, 0, {}, None)
+
+    def test_changes_are_queued_and_committed_in_one_write(self, db):
+        run(Transactions(db).credit("1", wallet=100))
+        profile = make_profile(db)
+        run(profile.async_init())
+        profile.add_currency(-30, "wallet")
+        profile.add_currency(30, "bank")
+        profile.add_item(Item("cookie", "Cookie", 10, "", True))
+        assert (profile.wallet, profile.bank, profile.inventory) == (70, 30, {"cookie": 1})
+
+        before = calls(db)
+        run(profile.commit())
+        assert calls(db) - before == 1
+        assert not profile.has_changes
+        assert (profile.doc.wallet, profile.doc.bank, profile.doc.inventory) == (70, 30, {"cookie": 1})
+
+    def test_guarded_commit_declines_and_empties_queue(self, db):
+        profile = make_profile(db)
+        run(profile.async_init())
+        profile.remove_item("padlock")
+        with pytest.raises(TransactionDeclined):
+            run(profile.commit())
+        assert not profile.has_changes
+        profile.add_currency(-50, "wallet")
+        run(profile.commit(guarded=False))
+        assert profile.wallet == -50
+
+    def test_refresh_sees_other_writes_and_keeps_queue(self, db):
+        profile = make_profile(db)
+        run(profile.async_init())
+        profile.add_currency(5, "wallet")
+        run(Transactions(db).credit("1", wallet=10))
+        assert profile.wallet == 5
+        run(profile.refresh())
+        assert profile.wallet == 15
+
+    def test_repairs_non_dict_inventory(self, db):
+        run(db.currency.collection.insert_one({"user_id": "1", "wallet": 1, "inventory": []}))
+        profile = make_profile(db)
+        run(profile.async_init())
+        assert profile.inventory == {}
+        profile.add_item(Item("cookie", "Cookie", 10, "", True))
+        run(profile.commit())
+        assert profile.inventory == {"cookie": 1}
@@ -0,0 +1,128 @@
+"""Tests for utils/leaderboard.py, against the in-memory storage backend."""
+import random
+import pytest
+import sys, pathlib
+from unittest.mock import AsyncMock
+
+from tests.conftest import run
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from utils.leaderboard import NET_WORTH_MIGRATION, Leaderboard
+from utils.migrations import FIELD_MIGRATIONS, MigrationRunner
+from utils.transactions import TransactionDeclined, Transactions
+
+
+@pytest.fixture
+def db(db):
+    db.currency.query_many = AsyncMock(wraps=db.currency.query_many)
+    return db
+
+
+def seed(db, worths):
+    tx = Transactions(db)
+    for i, worth in enumerate(worths):
+        run(tx.credit(str(i), wallet=worth))
+
+
+def make(db, size):
+    board = Leaderboard(db, size=size)
+    run(board.rebuild())
+    db.currency.query_many.reset_mock()
+    return board, Transactions(db, board)
+
+
+def expected(db, members=None):
+    docs = run(db.currency.collection.find({}).to_list())
+    return sorted((d["net_worth"] for d in docs if members is None or d["user_id"] in members), reverse=True)
+
+
+class TestLeaderboard:
+    def test_pages_inside_the_list_need_no_query(self, db):
+        seed(db, [5, 50, 20, 10])
+        board, _ = make(db, size=3)
+        assert run(board.page(0, per_page=3)) == [("1", 50), ("2", 20), ("3", 10)]
+        db.currency.query_many.assert_not_called()
+
+    def test_pages_past_the_list_read_the_index(self, db):
+        seed(db, [5, 50, 20, 10, 1])
+        board, _ = make(db, size=2)
+        assert run(board.page(1, per_page=2)) == [("3", 10), ("0", 5)]
+        assert db.currency.query_many.call_args.kwargs["skip"] == 2
+
+    def test_small_collection_is_complete(self, db):
+        seed(db, [5, 50])
+        board, tx = make(db, size=10)
+        assert board.complete
+        run(tx.credit("9", wallet=1))
+        assert run(board.page(0)) == [("1", 50), ("0", 5), ("9", 1)]
+        db.currency.query_many.assert_not_called()
+
+    def test_not_complete_until_net_worth_migration_finishes(self, db):
+        seed(db, [5, 50])
+        run(db.currency.collection.insert_one({"user_id": "legacy", "wallet": 70}))
+        db.finished_migrations.discard(NET_WORTH_MIGRATION)
+        board, _ = make(db, size=10)
+        assert not board.complete
+        run(db.client.data.migrations.delete_one({"_id": NET_WORTH_MIGRATION}))
+        migration = next(m for m in FIELD_MIGRATIONS if m.name == NET_WORTH_MIGRATION)
+        run(MigrationRunner(db.client.data, migrations=(migration,), pause=0).run(db._migration_complete))
+        run(board._rebuild_task)
+        assert board.complete
+        assert run(board.page(0)) == [("legacy", 70), ("1", 50), ("0", 5)]
+
+    def test_writes_update_the_list(self, db):
+        seed(db, [5, 50, 20, 10])
+        board, tx = make(db, size=3)
+        run(tx.credit("0", wallet=100))
+        run(tx.transfer("1", "3", 45))
+        assert run(board.page(0, per_page=3)) == [("0", 105), ("3", 55), ("2", 20)]
+        db.currency.query_many.assert_not_called()
+
+    def test_thinned_list_is_rebuilt(self, db):
+        seed(db, [50, 40, 30, 20, 10])
+        board, tx = make(db, size=4)
+        for user in ("0", "1", "2"):
+            run(tx.credit(user, wallet=-45))
+        assert run(board.page(0, per_page=3)) == [("3", 20), ("4", 10), ("0", 5)]
+        assert db.currency.query_many.called
+
+    def test_guild_page(self, db):
+        seed(db, [5, 50, 20, 10, 1])
+        board, _ = make(db, size=3)
+        assert run(board.guild_page([1, 3], 0)) == [("1", 50), ("3", 10)]
+        db.currency.query_many.assert_not_called()
+        # "0" and "4" rank below the list, so the index answers
+        assert run(board.guild_page([0, 4, 1], 0, per_page=2)) == [("1", 50), ("0", 5)]
+        assert set(db.currency.query_many.call_args.args[0]["user_id"]["$in"]) == {"0", "1", "4"}
+
+    def test_discard(self, db):
+        seed(db, [5, 50])
+        board, _ = make(db, size=10)
+        run(db.currency.delete("1"))
+        board.discard("1")
+        assert run(board.page(0)) == [("0", 5)]
+
+    def test_legacy_document_gets_net_worth(self, db):
+        run(db.currency.collection.insert_one({"user_id": "7", "wallet": 30, "bank": 12}))
+        board, tx = make(db, size=10)
+        assert run(tx.credit("7", wallet=1)).net_worth == 43
+        assert run(board.page(0)) == [("7", 43)]
+
+    def test_random_writes_match_a_full_sort(self, db):
+        rng = random.Random(3)
+        seed(db, [rng.randint(0, 500) for _ in range(40)])
+        board, tx = make(db, size=10)
+        guild = {str(i) for i in range(0, 40, 3)}
+        for _ in range(300):
+            user = str(rng.randrange(40))
+            try:
+                if rng.random() < 0.5:
+                    run(tx.credit(user, wallet=rng.randint(-100, 100)))
+                else:
+                    run(tx.transfer(user, str(rng.randrange(40)), rng.randint(1, 200)))
+            except (TransactionDeclined, ValueError):
+                pass
+            page = rng.randrange(3)
+            assert [w for _, w in run(board.page(page, per_page=5))] == expected(db)[page * 5:page * 5 + 5]
+            assert [w for _, w in run(board.guild_page(guild, 0, per_page=5))] == expected(db, guild)[:5]
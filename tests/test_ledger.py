@@ -0,0 +1,151 @@
+"""Tests for utils/ledger.py, against the in-memory storage backend."""
+import asyncio
+import random
+import pytest
+import sys, pathlib
+from unittest.mock import AsyncMock
+
+from tests.conftest import run
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from pymongo.errors import AutoReconnect
+
+from utils.ledger import Ledger
+from utils.transactions import TransactionDeclined, Transactions
+
+
+@pytest.fixture
+def db(db):
+    db.ledger_entries.insert_many = AsyncMock(wraps=db.ledger_entries.insert_many)
+    return db
+
+
+@pytest.fixture
+def ledger(db):
+    ledger = Ledger(db, flush_interval=60, keep=0)
+    yield ledger
+    run(ledger.close())
+
+
+@pytest.fixture
+def tx(db, ledger):
+    return Transactions(db, ledger=ledger)
+
+
+def replayed(ledger, user_id):
+    snapshot = run(ledger.balance(user_id))
+    return snapshot.wallet or 0, snapshot.bank or 0, {k: v for k, v in (snapshot.inventory or {}).items() if v}
+
+
+def stored(db, user_id):
+    doc = run(db.currency.get(user_id))
+    return doc.wallet or 0, doc.bank or 0, {k: v for k, v in (doc.inventory or {}).items() if v}
+
+
+def entries(db):
+    return run(db.ledger_entries.find({}).to_list(None))
+
+
+class TestLedger:
+    def test_entries_are_written_in_one_batch(self, db, ledger, tx):
+        for i in range(20):
+            run(tx.credit(str(i % 3), wallet=1, reason="beg"))
+        assert entries(db) == []
+        run(ledger.flush())
+        assert db.ledger_entries.insert_many.await_count == 1
+        assert len(entries(db)) == 20
+        assert {e["reason"] for e in entries(db)} == {"beg"}
+
+    def test_full_batch_flushes_without_waiting(self, db, ledger, tx):
+        ledger.batch_size = 5
+
+        async def credit_five():
+            for _ in range(5):
+                await tx.credit("1", wallet=1)
+            await asyncio.sleep(0)
+
+        run(credit_five())
+        assert len(entries(db)) == 5
+
+    def test_declined_change_is_not_recorded(self, db, ledger, tx):
+        run(tx.credit("1", wallet=10))
+        with pytest.raises(TransactionDeclined):
+            run(tx.deposit("1", 11))
+        run(ledger.flush())
+        assert len(entries(db)) == 1
+
+    def test_transfer_records_both_sides(self, db, ledger, tx):
+        run(tx.credit("1", wallet=10))
+        run(tx.transfer("1", "2", 4, "wallet", "bank"))
+        run(ledger.flush())
+        transfer = [(e["user_id"], e.get("wallet"), e.get("bank"), e["counterparty"])
+                    for e in entries(db) if e.get("reason") == "transfer"]
+        assert transfer == [("1", -4, None, "2"), ("2", None, 4, "1")]
+
+    def test_balance_includes_buffered_entries(self, ledger, tx):
+        run(tx.credit("1", wallet=10, items={"cookie": 2}))
+        run(ledger.flush())
+        run(tx.use_item("1", "cookie"))
+        assert replayed(ledger, "1") == (10, 0, {"cookie": 1})
+
+    def test_compaction_folds_into_snapshot(self, db, ledger, tx):
+        run(tx.credit("1", wallet=10, bank=5, items={"cookie": 1}))
+        run(tx.transfer("1", "2", 3))
+        assert run(ledger.compact()) == 3
+        assert entries(db) == []
+        snapshot = run(db.ledger_snapshots.get("1"))
+        assert (snapshot.wallet, snapshot.bank, snapshot.inventory) == (7, 5, {"cookie": 1})
+        run(tx.credit("1", wallet=1))
+        assert replayed(ledger, "1") == stored(db, "1") == (8, 5, {"cookie": 1})
+        run(ledger.compact())
+        assert replayed(ledger, "1") == (8, 5, {"cookie": 1})
+
+    def test_interrupted_compaction_is_not_folded_twice(self, db, ledger, tx):
+        run(tx.credit("1", wallet=10))
+        delete_many = db.ledger_entries.delete_many
+        db.ledger_entries.delete_many = AsyncMock(side_effect=AutoReconnect("connection reset"))
+        with pytest.raises(AutoReconnect):
+            run(ledger.compact())
+        db.ledger_entries.delete_many = delete_many
+        run(tx.credit("1", wallet=1))
+        run(ledger.compact())
+        assert entries(db) == []
+        assert replayed(ledger, "1") == (11, 0, {})
+
+    def test_failed_flush_is_retried_without_duplicates(self, db, ledger, tx):
+        insert_many = db.ledger_entries.insert_many
+
+        async def insert_then_fail(documents, **kwargs):
+            await insert_many(documents[:2], **kwargs)
+            raise AutoReconnect("connection reset")
+
+        for _ in range(4):
+            run(tx.credit("1", wallet=1))
+        db.ledger_entries.insert_many = insert_then_fail
+        with pytest.raises(AutoReconnect):
+            run(ledger.flush())
+        db.ledger_entries.insert_many = insert_many
+        run(ledger.flush())
+        assert len(entries(db)) == 4
+
+    def test_replay_matches_balances(self, db, ledger, tx):
+        rng = random.Random(5)
+        users = [str(i) for i in range(6)]
+        for step in range(300):
+            user = rng.choice(users)
+            try:
+                action = rng.randrange(4)
+                if action == 0:
+                    run(tx.credit(user, wallet=rng.randint(-20, 50), bank=rng.randint(0, 20)))
+                elif action == 1:
+                    run(tx.transfer(user, rng.choice(users), rng.randint(1, 40)))
+                elif action == 2:
+                    run(tx.buy(user, "padlock", rng.randint(0, 30), max_quantity=2))
+                else:
+                    run(tx.use_item(user, "padlock"))
+            except (TransactionDeclined, ValueError):
+                pass
+            if step % 50 == 0:
+                run(ledger.compact())
+        assert {u: replayed(ledger, u) for u in users} == {u: stored(db, u) for u in users}
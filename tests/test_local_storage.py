@@ -0,0 +1,187 @@
+"""Tests for utils/local_storage.py — the embedded MongoDB stand-ins."""
+import asyncio
+import pytest
+import sys, pathlib
+
+_loop = asyncio.new_event_loop()
+def run(coro):
+    return _loop.run_until_complete(coro)
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from utils.database import Database, Schemas
+from utils.local_storage import LocalClient, apply_update, matches
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def client(request, tmp_path):
+    client = LocalClient(request.param, str(tmp_path / "kidney.sqlite3"))
+    yield client
+    run(client.close())
+
+
+@pytest.fixture
+def col(client):
+    col = client.data.currency
+    run(col.create_index("user_id", unique=True, sparse=True))
+    return col
+
+
+class TestMatches:
+    def test_equality_reaches_into_arrays(self):
+        doc = {"warns": [{"id": "a"}, {"id": "b"}], "roles": [1, 2]}
+        assert matches(doc, {"warns.id": "b"})
+        assert matches(doc, {"roles": 2})
+        assert not matches(doc, {"warns.id": "c"})
+
+    def test_operators(self):
+        doc = {"wallet": 10, "name": "x"}
+        assert matches(doc, {"wallet": {"$gte": 10, "$lt": 11}})
+        assert matches(doc, {"name": {"$in": ["x", "y"]}, "bank": {"$exists": False}})
+        assert matches(doc, {"$or": [{"wallet": 1}, {"name": "x"}]})
+        assert not matches(doc, {"wallet": {"$ne": 10}})
+
+    def test_missing_field_equals_none(self):
+        assert matches({}, {"log_channel": None})
+        assert not matches({}, {"log_channel": {"$ne": None}})
+
+    def test_bool_is_not_int(self):
+        assert not matches({"enabled": True}, {"enabled": 1})
+
+    def test_comparisons_skip_other_types(self):
+        assert not matches({"wallet": "10"}, {"wallet": {"$gt": 5}})
+
+    def test_unknown_operator(self):
+        with pytest.raises(OperationFailure):
+            matches({}, {"name": {"$regex": "x"}})
+
+
+class TestApplyUpdate:
+    def test_operators(self):
+        doc = {"wallet": 1, "warns": [{"id": "a"}, {"id": "b"}], "old": 1}
+        apply_update(doc, {"$inc": {"wallet": 2, "bank": 5}, "$set": {"a.b": 1}, "$unset": {"old": ""},
+                           "$pull": {"warns": {"id": "a"}}, "$push": {"roles": 3}})
+        assert doc == {"wallet": 3, "bank": 5, "a": {"b": 1}, "warns": [{"id": "b"}], "roles": [3]}
+
+    def test_inc_on_non_number(self):
+        with pytest.raises(OperationFailure):
+            apply_update({"wallet": "1"}, {"$inc": {"wallet": 1}})
+
+    def test_replacement_rejected(self):
+        with pytest.raises(ValueError):
+            apply_update({}, {"wallet": 1})
+
+
+class TestCollection:
+    def test_upsert_seeds_from_filter(self, col):
+        run(col.update_one({"user_id": "1"}, {"$inc": {"wallet": 5}}, upsert=True))
+        assert run(col.find_one({"user_id": "1"}, {"_id": 0})) == {"user_id": "1", "wallet": 5}
+
+    def test_replace_keeps_id(self, col):
+        run(col.insert_one({"user_id": "1", "wallet": 1}))
+        before = run(col.find_one({"user_id": "1"}))
+        result = run(col.replace_one({"user_id": "1"}, {"user_id": "1", "wallet": 2}))
+        assert result.modified_count == 1
+        assert run(col.find_one({"user_id": "1"})) == {**before, "wallet": 2}
+
+    def test_unique_index(self, col):
+        run(col.insert_one({"user_id": "1"}))
+        with pytest.raises(DuplicateKeyError):
+            run(col.insert_one({"user_id": "1"}))
+        # sparse: documents without the field don't collide
+        run(col.insert_one({"userID": "2"}))
+        run(col.insert_one({"userID": "3"}))
+
+    def test_find_one_and_update(self, col):
+        doc = run(col.find_one_and_update({"user_id": "1"}, {"$inc": {"wallet": 3}},
+                                          upsert=True, return_document=ReturnDocument.AFTER))
+        assert doc["wallet"] == 3
+        before = run(col.find_one_and_update({"user_id": "1"}, {"$inc": {"wallet": 3}}))
+        assert before["wallet"] == 3
+
+    def test_returned_documents_are_copies(self, col):
+        run(col.insert_one({"user_id": "1", "items": [1]}))
+        run(col.find_one({"user_id": "1"}))["items"].append(2)
+        assert run(col.find_one({"user_id": "1"}))["items"] == [1]
+
+    def test_find_pages_sorts_and_projects(self, col):
+        run(col.insert_many([{"user_id": str(i), "wallet": i} for i in range(5)]))
+        cursor = col.find({"wallet": {"$gte": 1}}, {"wallet": 1, "_id": 0}, sort=[("wallet", -1)])
+        assert run(cursor.to_list(length=2)) == [{"wallet": 4}, {"wallet": 3}]
+        assert run(cursor.to_list(length=None)) == [{"wallet": 2}, {"wallet": 1}]
+        assert len(run(col.find({"user_id": {"$in": ["1", "2", "9"]}}).to_list())) == 2
+
+    def test_bulk_write(self, col):
+        run(col.insert_one({"user_id": "1", "wallet": 1}))
+        result = run(col.bulk_write([
+            UpdateOne({"user_id": "1"}, {"$inc": {"wallet": 1}}),
+            ReplaceOne({"user_id": "2"}, {"user_id": "2", "wallet": 7}, upsert=True),
+        ], ordered=False))
+        assert (result.modified_count, result.upserted_count) == (1, 1)
+        assert run(col.count_documents({"wallet": {"$gt": 1}})) == 2
+
+    def test_bulk_write_reports_duplicates(self, col):
+        run(col.insert_one({"userID": "1", "_id": "legacy"}))
+        run(col.insert_one({"user_id": "1"}))
+        with pytest.raises(BulkWriteError) as e:
+            run(col.bulk_write([UpdateOne({"_id": "legacy"}, {"$set": {"user_id": "1"}})], ordered=False))
+        assert len(e.value.details["writeErrors"]) == 1
+
+    def test_delete_and_counts(self, col):
+        run(col.insert_many([{"user_id": "1"}, {"user_id": "2"}]))
+        assert run(col.delete_one({"user_id": "1"})).deleted_count == 1
+        assert run(col.delete_one({"user_id": "1"})).deleted_count == 0
+        assert run(col.count_documents({})) == run(col.estimated_document_count()) == 1
+
+    def test_index_conflict_and_drop(self, col):
+        with pytest.raises(OperationFailure) as e:
+            run(col.create_index("user_id"))
+        assert e.value.code == 85
+        run(col.drop_index("user_id_1"))
+        run(col.create_index("user_id"))
+
+
+class TestSQLite:
+    def test_documents_and_indexes_persist(self, tmp_path):
+        path = str(tmp_path / "kidney.sqlite3")
+        client = LocalClient("sqlite", path)
+        run(client.data.warnings.create_index([("user_id", 1), ("guild_id", 1)], unique=True))
+        run(client.data.warnings.insert_one({"user_id": 1, "guild_id": 2, "warns": [{"id": "a"}]}))
+        run(client.close())
+
+        client = LocalClient("sqlite", path)
+        assert run(client.data.warnings.find_one({"warns.id": "a"}))["guild_id"] == 2
+        with pytest.raises(DuplicateKeyError):
+            run(client.data.warnings.insert_one({"user_id": 1, "guild_id": 2}))
+        assert run(client.data.list_collection_names()) == ["warnings"]
+        run(client.close())
+
+    def test_wal_mode_and_key_lookups_use_the_index(self, tmp_path):
+        client = LocalClient("sqlite", str(tmp_path / "kidney.sqlite3"))
+        run(client.data.currency.create_index("user_id", unique=True))
+        conn = client._conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        plan = conn.execute('EXPLAIN QUERY PLAN SELECT doc FROM "data.currency" '
+                            "WHERE json_extract(doc, '$.user_id') = ?", ("1",)).fetchall()
+        assert "USING INDEX" in plan[0][-1]
+        run(client.close())
+
+
+class TestDatabase:
+    @pytest.mark.parametrize("storage", ["memory", "sqlite"])
+    def test_connect_and_round_trip(self, storage, tmp_path):
+        db = Database("", storage=storage, storage_path=str(tmp_path / "kidney.sqlite3"))
+
+        async def scenario():
+            await db.connect()
+            await db.currency.save(Schemas.Currency(user_id="1", wallet=5))
+            await db.currency.flush()
+            db.currency.cache.clear()
+            wallet = (await db.currency.get("1")).wallet
+            await db.close()
+            return wallet
+
+        assert run(scenario()) == 5
@@ -0,0 +1,120 @@
+"""Tests for utils/migrations.py — batched, resumable legacy field rewrites."""
+import asyncio
+import sys, pathlib
+from unittest.mock import AsyncMock, MagicMock
+
+_loop = asyncio.new_event_loop()
+def run(coro):
+    return _loop.run_until_complete(coro)
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from pymongo.errors import BulkWriteError
+
+from utils.database import Collection, Schemas
+from utils.local_storage import LocalClient
+from utils.migrations import FIELD_MIGRATIONS, ComputedFieldMigration, FieldMigration, MigrationRunner
+
+MIGRATION = FieldMigration("currency", "userID", "user_id")
+
+
+def make_db(batches, progress=None):
+    """Return a mock database whose `currency.find` yields the given batches in order."""
+    source = MagicMock()
+    cursors = []
+    for batch in [*batches, []]:
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=batch)
+        cursors.append(cursor)
+    source.find = MagicMock(side_effect=cursors)
+    source.bulk_write = AsyncMock(side_effect=lambda ops, ordered: MagicMock(modified_count=len(ops)))
+
+    db = MagicMock()
+    db.__getitem__ = MagicMock(return_value=source)
+    db.migrations.find_one = AsyncMock(return_value=progress)
+    db.migrations.update_one = AsyncMock()
+    return db, source
+
+
+def runner(db, batch_size=2):
+    return MigrationRunner(db, migrations=(MIGRATION,), batch_size=batch_size, pause=0)
+
+
+class TestMigrationRunner:
+    def test_rewrites_legacy_documents_in_batches(self):
+        db, source = make_db([[{"_id": 1, "userID": "a"}, {"_id": 2, "userID": "b"}], [{"_id": 3, "userID": "c"}]])
+        done = []
+        run(runner(db).run(done.append))
+
+        assert source.bulk_write.call_count == 2
+        op = source.bulk_write.call_args_list[0][0][0][0]
+        assert op._filter == {"_id": 1}
+        assert op._doc == {"$set": {"user_id": "a"}, "$unset": {"userID": ""}}
+        assert done == [MIGRATION]
+        final = db.migrations.update_one.call_args_list[-1][0]
+        assert final == ({"_id": MIGRATION.name}, {"$set": {"done": True, "migrated": 3}})
+
+    def test_resumes_after_recorded_id(self):
+        db, source = make_db([], progress={"_id": MIGRATION.name, "last_id": 7, "migrated": 10})
+        run(runner(db).run(lambda m: None))
+        query = source.find.call_args[0][0]
+        assert query == {"userID": {"$exists": True}, "_id": {"$gt": 7}}
+
+    def test_records_progress_after_each_batch(self):
+        db, _ = make_db([[{"_id": 1, "userID": "a"}]])
+        run(runner(db).run(lambda m: None))
+        first = db.migrations.update_one.call_args_list[0][0]
+        assert first[1] == {"$set": {"last_id": 1, "migrated": 1}}
+
+    def test_finished_migration_is_skipped(self):
+        db, source = make_db([], progress={"_id": MIGRATION.name, "done": True})
+        done = []
+        run(runner(db).run(done.append))
+        source.find.assert_not_called()
+        assert done == [MIGRATION]
+
+    def test_existing_new_field_only_unsets_legacy(self):
+        update = MIGRATION.update_for({"_id": 1, "userID": "a", "user_id": "a"})
+        assert update == ({"_id": 1}, {"$unset": {"userID": ""}})
+
+    def test_conflicts_do_not_stop_the_migration(self):
+        db, source = make_db([[{"_id": 1, "userID": "a"}]])
+        source.bulk_write = AsyncMock(side_effect=BulkWriteError({"nModified": 0, "writeErrors": [{"code": 11000}]}))
+        done = []
+        run(runner(db).run(done.append))
+        assert done == [MIGRATION]
+
+    def test_failure_does_not_report_completion(self):
+        db, source = make_db([])
+        source.find = MagicMock(side_effect=RuntimeError("db down"))
+        done = []
+        run(runner(db).run(done.append))
+        assert done == []
+
+
+class TestComputedFieldMigration:
+    NET_WORTH = next(m for m in FIELD_MIGRATIONS if isinstance(m, ComputedFieldMigration))
+
+    def test_backfills_missing_field(self):
+        db = LocalClient("memory").data
+        run(db.currency.insert_many([{"_id": 1, "user_id": "a", "wallet": 5, "bank": 7},
+                                     {"_id": 2, "user_id": "b", "wallet": "12"},
+                                     {"_id": 3, "user_id": "c", "wallet": 1, "net_worth": 1}]))
+        run(MigrationRunner(db, migrations=(self.NET_WORTH,), batch_size=2, pause=0).run(lambda m: None))
+        docs = run(db.currency.find({}, {"net_worth": 1}, sort=[("_id", 1)]).to_list())
+        assert [d["net_worth"] for d in docs] == [12, 0, 1]
+
+    def test_skips_documents_changed_since_read(self):
+        condition, update = self.NET_WORTH.update_for({"_id": 1, "wallet": 5})
+        assert condition == {"_id": 1, "net_worth": {"$exists": False}, "wallet": 5, "bank": None}
+        assert update == {"$set": {"net_worth": 5}}
+
+
+class TestDisableLegacyPk:
+    def test_get_stops_querying_legacy_field(self):
+        mongo_col = MagicMock()
+        mongo_col.find_one = AsyncMock(return_value=None)
+        col = Collection(mongo_col, "user_id", Schemas.Currency, legacy_pk="userID")
+        col.disable_legacy_pk()
+        assert run(col.get("7")) is None
+        mongo_col.find_one.assert_called_once_with({"user_id": "7"})
@@ -0,0 +1,82 @@
+"""Tests for utils/query_metrics.py"""
+import logging
+import pytest
+from types import SimpleNamespace
+
+import sys, pathlib
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from utils.query_metrics import LatencyHistogram, QueryMetrics
+
+
+def started(request_id, command_name, command):
+    return SimpleNamespace(request_id=request_id, command_name=command_name, command=command)
+
+
+def finished(request_id, ms):
+    return SimpleNamespace(request_id=request_id, duration_micros=int(ms * 1000))
+
+
+@pytest.fixture
+def metrics():
+    return QueryMetrics(slow_query_ms=100)
+
+
+class TestQueryMetrics:
+    def test_records_per_collection_and_command(self, metrics):
+        metrics.started(started(1, "find", {"find": "currency", "filter": {"user_id": "1"}}))
+        metrics.succeeded(finished(1, 3))
+        metrics.started(started(2, "update", {"update": "currency", "updates": [{"q": {"user_id": "1"}}]}))
+        metrics.succeeded(finished(2, 7))
+        ops = metrics.stats()["operations"]
+        assert ops["currency.find"]["count"] == 1
+        assert ops["currency.find"]["avg_ms"] == pytest.approx(3)
+        assert ops["currency.update"]["max_ms"] == pytest.approx(7)
+
+    def test_getmore_uses_collection_field(self, metrics):
+        metrics.started(started(1, "getMore", {"getMore": 123, "collection": "warnings"}))
+        metrics.succeeded(finished(1, 1))
+        assert "warnings.getMore" in metrics.stats()["operations"]
+
+    def test_admin_commands_ignored(self, metrics):
+        metrics.started(started(1, "hello", {"hello": 1}))
+        metrics.succeeded(finished(1, 1))
+        assert metrics.stats()["commands"] == 0
+
+    def test_failures_counted(self, metrics):
+        metrics.started(started(1, "insert", {"insert": "exceptions"}))
+        metrics.failed(finished(1, 2))
+        assert metrics.stats()["operations"]["exceptions.insert"]["failures"] == 1
+
+    def test_slow_query_logged(self, metrics, caplog):
+        metrics.started(started(1, "find", {"find": "currency", "filter": {"user_id": "1"}}))
+        with caplog.at_level(logging.WARNING):
+            metrics.succeeded(finished(1, 250))
+        assert metrics.slow_queries == 1
+        assert "currency" in caplog.text and "user_id" in caplog.text
+
+    def test_commands_per_second(self, metrics):
+        for i in range(5):
+            metrics.started(started(i, "find", {"find": "currency"}))
+            metrics.succeeded(finished(i, 1))
+        assert metrics.stats()["commands"] == 5
+        assert metrics.commands_per_second() > 0
+
+    def test_reset(self, metrics):
+        metrics.started(started(1, "find", {"find": "currency"}))
+        metrics.succeeded(finished(1, 1))
+        metrics.reset()
+        assert metrics.stats()["operations"] == {}
+
+
+class TestLatencyHistogram:
+    def test_percentiles_use_bucket_bounds(self):
+        histogram = LatencyHistogram()
+        for ms in [0.5] * 90 + [40] * 9 + [700]:
+            histogram.record(ms)
+        assert histogram.percentile(0.5) == 1
+        assert histogram.percentile(0.95) == 50
+        assert histogram.percentile(1.0) == 700
+
+    def test_empty(self):
+        assert LatencyHistogram().stats()["p95_ms"] == 0.0
@@ -172,3 +172,88 @@ class TestSchemaStrRepr:
         obj = Schemas.GuildConfig(guild_id=1)
         pairs = dict(obj)
         assert pairs["guild_id"] == 1
+
+
+class TestSchemaCopy:
+    def test_copy_is_equal(self):
+        obj = Schemas.AutoRoleSettings(guild_id=1, roles=[{"id": 2, "delay": 0}], bots_get_roles=True)
+        assert obj.copy().to_dict() == obj.to_dict()
+        assert type(obj.copy()) is Schemas.AutoRoleSettings
+
+    def test_nested_containers_are_independent(self):
+        obj = Schemas.AutoRoleSettings(guild_id=1, roles=[{"id": 2, "delay": 0}])
+        clone = obj.copy()
+        clone.roles[0]["delay"] = 60
+        clone.roles.append({"id": 3, "delay": 0})
+        assert obj.roles == [{"id": 2, "delay": 0}]
+
+    def test_copy_of_frozen_borrows_containers_until_touched(self):
+        frozen = Schemas.AutoRoleSettings(guild_id=1, roles=[{"id": 2, "delay": 0}]).freeze()
+        clone = frozen.copy()
+        assert clone._shared
+        clone.roles[0]["delay"] = 60
+        clone.roles.append({"id": 3, "delay": 0})
+        assert frozen.roles == [{"id": 2, "delay": 0}]
+        assert not clone._shared
+
+    def test_assigning_a_borrowed_container_unshares(self):
+        frozen = Schemas.MusicQueue(guild_id=1, current={"title": "a"}, queue=[{"title": "b"}]).freeze()
+        clone = frozen.copy()
+        queue = [{"title": "c"}]
+        clone.queue = queue
+        clone.current["title"] = "z"
+        assert frozen.current == {"title": "a"}
+        assert clone.queue is queue
+
+    def test_frozen_copy_of_untouched_copy_stays_readable(self):
+        frozen = Schemas.AutoModSettings(guild_id=1, whitelist=[1]).freeze()
+        refrozen = frozen.copy().freeze()
+        assert refrozen.whitelist == [1]
+        assert refrozen.copy().to_dict() == {"guild_id": 1, "whitelist": [1]}
+
+    def test_freeze_blocks_assignment(self):
+        obj = Schemas.GuildConfig(guild_id=1).freeze()
+        assert isinstance(obj, Schemas.GuildConfig)
+        with pytest.raises(AttributeError):
+            obj.guild_id = 2
+
+    def test_copy_of_frozen_is_modifiable(self):
+        clone = Schemas.GuildConfig(guild_id=1).freeze().copy()
+        assert type(clone) is Schemas.GuildConfig
+        clone.guild_id = 2
+        assert clone.guild_id == 2
+
+
+class TestDeclarativeSchemas:
+    def test_instances_are_slotted(self):
+        obj = Schemas.Currency(user_id="1", wallet=1)
+        assert not hasattr(obj, "__dict__")
+        with pytest.raises(AttributeError):
+            obj.not_a_field = 1
+
+    def test_positional_arguments_follow_declaration_order(self):
+        obj = Schemas.ExceptionSchema(5, True)
+        assert (obj.user_id, obj.always_report_errors) == (5, True)
+
+    def test_new_field_name_wins_over_alias(self):
+        obj = Schemas.AutoRoleSettings.from_dict({"guild_id": 1, "bots_get_roles": False, "BotsGetRoles": True})
+        assert obj.bots_get_roles is False
+        assert Schemas.AutoRoleSettings.from_dict({"BotsGetRoles": True}).bots_get_roles is True
+
+    def test_bad_value_raises(self):
+        with pytest.raises(ValueError):
+            Schemas.Currency.from_dict({"user_id": "1", "wallet": "lots"})
+
+    def test_container_fields_are_copied_on_decode(self):
+        doc = {"guild_id": 1, "whitelist": [1]}
+        Schemas.AutoModSettings.from_dict(doc).whitelist.append(2)
+        assert doc["whitelist"] == [1]
+
+    def test_copy_keeps_projection(self):
+        obj = Schemas.GuildConfig(guild_id=1)
+        obj._projection = frozenset({"guild_id"})
+        assert obj.copy().is_partial
+
+    def test_fields_are_declared(self):
+        assert list(Schemas.ScammerList._fields) == ["user_id", "time", "reason"]
+        assert Schemas.ScammerList._fields["user_id"].aliases == ("user",)
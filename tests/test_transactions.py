@@ -0,0 +1,218 @@
+"""Tests for utils/transactions.py, against the in-memory storage backend."""
+import asyncio
+import random
+import pytest
+import sys, pathlib
+from unittest.mock import AsyncMock, MagicMock
+
+from tests.conftest import run
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / "kidney-bot"))
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from utils.transactions import TransactionDeclined, Transactions
+
+
+class Laggy:
+    """Proxy for a collection that yields to the event loop around every call,
+    like a network round-trip would, so concurrent commands interleave."""
+
+    def __init__(self, target, rng):
+        self._target = target
+        self._rng = rng
+        self.fail_next_upsert = False
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            for _ in range(self._rng.randint(0, 3)):
+                await asyncio.sleep(0)
+            if self.fail_next_upsert and kwargs.get("upsert"):
+                self.fail_next_upsert = False
+                raise AutoReconnect("connection reset")
+            result = await attr(*args, **kwargs)
+            for _ in range(self._rng.randint(0, 3)):
+                await asyncio.sleep(0)
+            return result
+        return call
+
+
+@pytest.fixture
+def tx(db):
+    return Transactions(db)
+
+
+async def gather(coros):
+    return await asyncio.gather(*coros)
+
+
+def balances(db):
+    docs = run(db.currency.collection.find({}).to_list())
+    return {d["user_id"]: (d.get("wallet", 0), d.get("bank", 0)) for d in docs}
+
+
+class TestCharge:
+    def test_credit_creates_document(self, tx):
+        doc = run(tx.credit("1", wallet=5, items={"cookie": 1}))
+        assert (doc.wallet, doc.inventory) == (5, {"cookie": 1})
+
+    def test_declined_charge_writes_nothing(self, db, tx):
+        run(tx.credit("1", wallet=10))
+        with pytest.raises(TransactionDeclined):
+            run(tx.deposit("1", 11))
+        with pytest.raises(TransactionDeclined):
+            run(tx.withdraw("2", 1))
+        assert balances(db) == {"1": (10, 0)}
+
+    def test_deposit_and_withdraw(self, tx):
+        run(tx.credit("1", wallet=10))
+        run(tx.deposit("1", 10))
+        assert (run(tx.withdraw("1", 4)).wallet, run(tx.withdraw("1", 0)).bank) == (4, 6)
+
+    def test_buy_respects_price_and_limit(self, tx):
+        run(tx.credit("1", wallet=250))
+        assert run(tx.buy("1", "phone", 100, max_quantity=1)).inventory == {"phone": 1}
+        with pytest.raises(TransactionDeclined):
+            run(tx.buy("1", "phone", 100, max_quantity=1))
+        run(tx.buy("1", "cookie", 100))
+        with pytest.raises(TransactionDeclined):
+            run(tx.buy("1", "cookie", 100))
+        assert run(tx.credit("1")).wallet == 50
+
+    def test_use_item(self, tx):
+        run(tx.credit("1", items={"padlock": 1}))
+        assert run(tx.use_item("1", "padlock"))
+        assert not run(tx.use_item("1", "padlock"))
+        assert run(tx.credit("1")).inventory == {"padlock": 0}
+
+
+class TestReward:
+    def test_one_bulk_write_for_everyone(self, db, tx):
+        run(tx.credit("1", wallet=10))
+        db.currency.collection.bulk_write = AsyncMock(wraps=db.currency.collection.bulk_write)
+        docs = run(tx.reward({"1": 5, "2": 5, "3": 0}))
+        assert db.currency.collection.bulk_write.await_count == 1
+        assert {u: (d.wallet, d.net_worth) for u, d in docs.items()} == {"1": (15, 15), "2": (5, 5)}
+        assert balances(db) == {"1": (15, 0), "2": (5, 0)}
+
+    def test_reports_to_leaderboard_and_ledger(self, db):
+        leaderboard, ledger = MagicMock(), MagicMock()
+        run(Transactions(db, leaderboard, ledger).reward({"1": 7, "2": 3}, "bank", reason="bean_bomb"))
+        assert sorted(c.args for c in leaderboard.record.call_args_list) == [("1", 7), ("2", 3)]
+        assert ledger.record.call_args_list[0].kwargs["bank"] == 7
+        assert ledger.record.call_args_list[0].kwargs["reason"] == "bean_bomb"
+
+
+class TestTransfer:
+    def test_moves_money(self, db, tx):
+        run(tx.credit("1", wallet=10))
+        source, target = run(tx.transfer("1", "2", 7))
+        assert (source.wallet, target.wallet) == (3, 7)
+        with pytest.raises(TransactionDeclined):
+            run(tx.transfer("1", "2", 4))
+        assert balances(db) == {"1": (3, 0), "2": (7, 0)}
+
+    def test_rejects_bad_arguments(self, tx):
+        with pytest.raises(ValueError):
+            run(tx.transfer("1", "2", 0))
+        with pytest.raises(ValueError):
+            run(tx.transfer("1", "1", 5))
+
+    def test_rejects_unknown_location_before_writing(self, db, tx):
+        run(tx.credit("1", wallet=10))
+        with pytest.raises(ValueError):
+            run(tx.transfer("1", "2", 5, target_location="pocket"))
+        assert balances(db) == {"1": (10, 0)}
+
+    def test_failed_credit_is_refunded(self, db, tx):
+        run(tx.credit("1", wallet=10))
+        db.currency.collection = Laggy(db.currency.collection, random.Random(0))
+        db.currency.collection.fail_next_upsert = True
+        with pytest.raises(AutoReconnect):
+            run(tx.transfer("1", "2", 10))
+        assert balances(db) == {"1": (10, 0)}
+
+    def test_concurrent_commands_conserve_money(self, db, tx):
+        rng = random.Random(1)
+        db.currency.collection = Laggy(db.currency.collection, rng)
+        users = [str(i) for i in range(10)]
+        run(gather(tx.credit(u, wallet=100, bank=100) for u in users))
+        declined = 0
+
+        async def command(i):
+            nonlocal declined
+            source, target = rng.sample(users, 2)
+            amount = rng.randint(1, 80)
+            try:
+                if i % 4 == 0:
+                    await tx.transfer(source, target, amount)
+                elif i % 4 == 1:
+                    await tx.transfer(source, target, amount, "bank", "wallet")
+                elif i % 4 == 2:
+                    await tx.deposit(source, amount)
+                else:
+                    await tx.withdraw(source, amount)
+            except TransactionDeclined:
+                declined += 1
+
+        run(gather(command(i) for i in range(1000)))
+        final = balances(db)
+        assert sum(wallet + bank for wallet, bank in final.values()) == 2000
+        assert all(wallet >= 0 and bank >= 0 for wallet, bank in final.values())
+        assert declined > 0
+        docs = run(db.currency.collection.find({}).to_list())
+        assert all(d["net_worth"] == d["wallet"] + d["bank"] for d in docs)
+        # The cache agrees with what was stored
+        db.currency.collection = db.currency.collection._target
+        assert {u: (run(db.currency.get(u)).wallet, run(db.currency.get(u)).bank) for u in users} == final
+
+
+class FakeSession:
+    def __init__(self, error=None):
+        self.error = error
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def with_transaction(self, callback):
+        if self.error is not None:
+            raise self.error
+        return await callback(self)
+
+
+class TestMongoTransactions:
+    @pytest.fixture
+    def db(self, db):
+        db.supports_transactions = True
+        db.currency.collection.find_one_and_update = AsyncMock(wraps=db.currency.collection.find_one_and_update)
+        run(Transactions(db).credit("1", wallet=10))
+        return db
+
+    def test_both_updates_share_the_session(self, db, tx):
+        session = FakeSession()
+        db.client.start_session = lambda: session
+        run(tx.transfer("1", "2", 4))
+        assert [c.kwargs.get("session") for c in db.currency.collection.find_one_and_update.call_args_list[-2:]] \
+            == [session, session]
+        assert balances(db) == {"1": (6, 0), "2": (4, 0)}
+
+    def test_declined_inside_transaction(self, db, tx):
+        db.client.start_session = lambda: FakeSession()
+        db.currency.cache.add({"user_id": "1", "wallet": 50})
+        with pytest.raises(TransactionDeclined):
+            run(tx.transfer("1", "2", 20))
+        assert db.currency.cache.get_one({"user_id": "1"}) is None
+
+    def test_standalone_server_falls_back(self, db, tx):
+        db.client.start_session = lambda: FakeSession(OperationFailure("Transaction numbers are only allowed "
+                                                                       "on a replica set member", code=20))
+        run(tx.transfer("1", "2", 4))
+        assert not db.supports_transactions
+        assert balances(db) == {"1": (6, 0), "2": (4, 0)}